@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import numpy as np
+import readmixcastep as rc
+import mixmap
+import phonons_VCA as pVCA
+import synthcastep
+
+"""
+Benchmarks of parsing, mapping, writing and phonon assembly over a sweep of
+synthetic structure sizes (see synthcastep), e.g.
+
+benchmark.py -n 64 256 1024 -o benchmark.json
+benchmark.py -n 64 256 1024 --compare benchmark.json
+
+Every operation is timed (best of --repeat calls) for each size: readcas on
+geometry, single point and continuation .castep files and its getters,
+readcell, get_mixkey, mixmap set up and conversions, castext and casprint,
+and gen_perturbations and calc_phonons (up to --phonon-max ions). The results
+are written as JSON with the log-log scaling exponent of every operation over
+the sweep, and --compare reports operations that have become slower than in
+an earlier results file (the exit status is then 1).
+"""
+
+sizes_default = [32, 128, 512]
+
+
+def timeit(func, repeat=3):
+    """ returns
+    float seconds : best wall time of repeat calls of func()
+    result : what the last call returned """
+    best = np.inf
+    for r in range(max(1, repeat)):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def castep_ops(cas):
+    """ returns
+    dict ops : {name: function} of the readcas getters to time """
+    ops = {'get_kpoints': cas.get_kpoints, 'get_psps': cas.get_psps,
+           'get_ext_press': cas.get_ext_press,
+           'get_cell_constrs': cas.get_cell_constrs,
+           'check_complete': cas.check_complete,
+           'get_posns': cas.get_posns, 'get_cell': cas.get_cell,
+           'extract_struc': cas.extract_struc,
+           'get_energy': cas.get_energy, 'get_forces': cas.get_forces,
+           'get_stresses': cas.get_stresses,
+           'get_final_spin': cas.get_final_spin,
+           'get_mixkey': cas.get_mixkey,
+           'get_mixkey_compact': lambda: cas.get_mixkey(compact=True)}
+    if cas.task == 'geometry':
+        ops['get_enthalpy'] = cas.get_enthalpy
+        ops['get_posns_first'] = lambda: cas.get_posns(iteration=0)
+        ops['get_forces_first'] = lambda: cas.get_forces(iteration=0)
+    return ops
+
+
+def bench_castep(casfile, repeat=3):
+    """ returns
+    dict seconds : {operation: best time} for a .castep file """
+    seconds = {}
+    seconds['readcas'], cas = timeit(lambda: rc.readcas(casfile), repeat)
+    for name, op in castep_ops(cas).items():
+        seconds[name], result = timeit(op, repeat)
+    return seconds
+
+
+def bench_cell(cellfile, repeat=3):
+    """ returns
+    dict seconds : {operation: best time} for a .cell file """
+    seconds = {}
+    seconds['readcell'], cas = timeit(lambda: rc.readcell(cellfile), repeat)
+    for name in ['get_kpoints', 'get_psps', 'get_init_spin',
+                 'get_ext_press', 'get_cell_constrs', 'get_mixkey']:
+        seconds[name], result = timeit(getattr(cas, name), repeat)
+    return seconds
+
+
+def bench_mixmap(casfile, folder, repeat=3):
+    """ returns
+    dict seconds : {operation: best time} of mixmap for a .castep file """
+    cas = rc.readcas(casfile)
+    mixatoms = cas.extract_struc()
+    mixkey = cas.get_mixkey()
+    forces = cas.get_forces()
+    seconds = {}
+    seconds['mixmap'], mapping = timeit(
+        lambda: mixmap.mixmap(mixatoms, mixkey), repeat)
+    seconds['mix2pure'], pureatoms = timeit(
+        lambda: mapping.mix2pure(mixatoms), repeat)
+    seconds['pure2mix'], result = timeit(
+        lambda: mapping.pure2mix(pureatoms), repeat)
+    seconds['mix2pure_forces'], result = timeit(
+        lambda: mapping.mix2pure_forces(forces), repeat)
+    seconds['castext'], result = timeit(
+        lambda: mapping.castext(mixatoms), repeat)
+    cellfile = os.path.join(folder, 'casprint.cell')
+    seconds['casprint'], result = timeit(
+        lambda: mapping.casprint(mixatoms, cellfile), repeat)
+    seconds['casprint_pure'], result = timeit(
+        lambda: mapping.casprint(pureatoms, cellfile, pure=True), repeat)
+    return seconds
+
+
+def bench_phonons(casfile, repeat=1):
+    """ returns
+    dict seconds : {operation: best time} of writing the displacements of a
+    single point .castep file and assembling its Gamma phonons (the
+    displaced .castep files are synthetic) """
+    seconds = {}
+    seconds['gen_perturbations'], result = timeit(
+        lambda: pVCA.gen_perturbations(casfile), repeat)
+    chem = casfile.replace('.castep', '')
+    for displ in pVCA.read_manifest(chem)['displacements']:
+        cellfile = os.path.join(os.path.dirname(casfile), displ['cellfile'])
+        synthcastep.castep_from_cell(cellfile, seed=displ['index'])
+    for method in [3, 2]:
+        seconds['calc_phonons_' + str(method)], result = timeit(
+            lambda: pVCA.calc_phonons(casfile, method=method), repeat)
+    return seconds
+
+
+def run(sizes=None, mixed=0.25, Niterations=10, Nsegments=3, repeat=3,
+        phonon_max=64, folder=None, verbose=True):
+    """ Time every operation over a sweep of synthetic structure sizes
+
+    list sizes : numbers of ions
+    float mixed : fraction of sites that are mixtures
+    int Niterations : geometry optimisation iterations
+    int Nsegments : continuation runs of the continuation file
+    int repeat : calls of each operation (the best time is kept)
+    int phonon_max : largest structure to time phonons of
+    str folder : directory for the synthetic files (default a temporary
+    directory that is removed)
+
+    returns
+    dict results : 'meta' data, 'results' [{case, operation, Nions, Nmixed,
+    Niterations, seconds}] and the 'scaling' exponent of each operation """
+    if sizes is None:
+        sizes = sizes_default
+    cleanup = folder is None
+    if folder is None:
+        folder = tempfile.mkdtemp(prefix='vcabench')
+    os.makedirs(folder, exist_ok=True)
+    records = []
+    try:
+        for Nions in sizes:
+            Nmixed = int(round(Nions*mixed/(1.0 + mixed)))
+            files = {
+                'geometry': synthcastep.write_castep(
+                    os.path.join(folder, 'geom' + str(Nions) + '.castep'),
+                    Nions, Nmixed, task='geometry', Niterations=Niterations),
+                'continuation': synthcastep.write_castep(
+                    os.path.join(folder, 'cont' + str(Nions) + '.castep'),
+                    Nions, Nmixed, task='geometry', Niterations=Niterations,
+                    Nsegments=Nsegments),
+                'single': synthcastep.write_castep(
+                    os.path.join(folder, 'single' + str(Nions) + '.castep'),
+                    Nions, Nmixed, task='single')}
+            cellfile = synthcastep.write_cell(
+                os.path.join(folder, 'cell' + str(Nions) + '.cell'), Nions,
+                Nmixed)
+            cases = [(case, bench_castep(casfile, repeat))
+                     for case, casfile in files.items()]
+            cases += [('cell', bench_cell(cellfile, repeat)),
+                      ('mixmap', bench_mixmap(files['geometry'], folder,
+                                              repeat))]
+            if Nions <= phonon_max:
+                phonfolder = os.path.join(folder, 'phonons' + str(Nions))
+                os.makedirs(phonfolder, exist_ok=True)
+                casfile = shutil.copy(files['single'], phonfolder)
+                cases += [('phonons', bench_phonons(casfile))]
+            for case, seconds in cases:
+                for operation, t in seconds.items():
+                    records += [{'case': case, 'operation': operation,
+                                 'Nions': Nions, 'Nmixed': Nmixed,
+                                 'Niterations': Niterations,
+                                 'seconds': t}]
+            if verbose:
+                print('timed ' + str(Nions) + ' ions', file=sys.stderr,
+                      flush=True)
+    finally:
+        if cleanup:
+            shutil.rmtree(folder, ignore_errors=True)
+    meta = {'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'node': platform.node(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'repeat': repeat,
+            'mixed': mixed, 'Nsegments': Nsegments}
+    return {'meta': meta, 'results': records, 'scaling': scaling(records)}
+
+
+def scaling(records):
+    """ returns
+    dict exponents : {'case/operation': p} where the time grows as Nions**p
+    (least squares over the sizes, only if more than one size was run) """
+    series = {}
+    for record in records:
+        key = record['case'] + '/' + record['operation']
+        series.setdefault(key, []).append((record['Nions'],
+                                           record['seconds']))
+    exponents = {}
+    for key, points in series.items():
+        N, t = np.array(points).T
+        if len(set(N)) > 1 and np.all(t > 0):
+            exponents[key] = round(float(np.polyfit(np.log(N), np.log(t),
+                                                    1)[0]), 3)
+    return exponents
+
+
+def table(results):
+    """ returns
+    str table : seconds of every operation (rows) for every size (columns) """
+    sizes = sorted(set([r['Nions'] for r in results['results']]))
+    rows = {}
+    for r in results['results']:
+        key = r['case'] + '/' + r['operation']
+        rows.setdefault(key, {})[r['Nions']] = r['seconds']
+    width = max([len(key) for key in rows] + [9])
+    lines = [' '*width + ''.join(['{0:>11d}'.format(N) for N in sizes])
+             + '    scaling']
+    for key, times in rows.items():
+        lines += ['{0:<{w}s}'.format(key, w=width)
+                  + ''.join(['{0:11.2e}'.format(times[N]) if N in times
+                             else ' '*11 for N in sizes])
+                  + '{0:>11s}'.format(str(results['scaling'].get(key, '')))]
+    return '\n'.join(lines)
+
+
+def compare(results, previous, tolerance=1.5, floor=1e-4):
+    """ returns
+    list regressions : (case/operation, Nions, old, new seconds) of
+    operations at least tolerance times slower than in previous (times below
+    floor seconds are too noisy to compare) """
+    old = {(r['case'], r['operation'], r['Nions']): r['seconds']
+           for r in previous['results']}
+    regressions = []
+    for r in results['results']:
+        key = (r['case'], r['operation'], r['Nions'])
+        if key in old and max(old[key], r['seconds']) > floor and \
+                r['seconds'] > tolerance*old[key]:
+            regressions += [(r['case'] + '/' + r['operation'], r['Nions'],
+                             old[key], r['seconds'])]
+    return regressions
+
+
+##########################################################################
+
+if __name__ == '__main__':
+    """ Run from the command line: benchmark.py [options] """
+    parser = argparse.ArgumentParser(
+        description='Time parsing, mapping and writing over structure sizes.')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+',
+                        default=sizes_default, help='numbers of ions')
+    parser.add_argument('-k', '--mixed', type=float, default=0.25,
+                        help='fraction of sites that are mixtures')
+    parser.add_argument('-m', '--iterations', type=int, default=10,
+                        help='geometry optimisation iterations')
+    parser.add_argument('-c', '--segments', type=int, default=3,
+                        help='continuation runs of the continuation file')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-p', '--phonon-max', type=int, default=64,
+                        help='largest structure to time phonons of')
+    parser.add_argument('-d', '--folder', default=None,
+                        help='keep the synthetic files in this directory')
+    parser.add_argument('-o', '--output', default='benchmark.json')
+    parser.add_argument('--compare', default=None,
+                        help='earlier results file to check for slow downs')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='slow down (ratio) reported by --compare')
+    args = parser.parse_args()
+    previous = None
+    if args.compare is not None:
+        previous = json.load(open(args.compare, 'r'))
+    results = run(args.sizes, mixed=args.mixed, Niterations=args.iterations,
+                  Nsegments=args.segments, repeat=args.repeat,
+                  phonon_max=args.phonon_max, folder=args.folder)
+    mixmap.atomic_write(json.dumps(results, indent=1), args.output)
+    print(table(results))
+    if previous is not None:
+        regressions = compare(results, previous, tolerance=args.tolerance)
+        for key, Nions, old, new in regressions:
+            print('slower: {0} ({1} ions) {2:.2e} -> {3:.2e} s'.format(
+                key, Nions, old, new))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,193 @@
+import itertools
+import copy
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import mixmap
+
+"""
+Module to generate CASTEP .cell files for a grid of solid solution
+compositions of a single template structure, e.g. Ca(3-x)Sr(x)Ti2O7 for
+x = 0.0, 0.05, ... 3.0:
+
+def mixkeyfn(x):
+    return {'Ca': {'Ca': 1.0-x/3, 'Sr': x/3}, 'Ti': {'Ti': 1.0}, 'O': {'O': 1.0}}
+
+sweep = compsweep(pureatoms, mixkeyfn, {'x': np.arange(0.0, 3.01, 0.05)})
+for point, cellfile in sweep.write('CaSrTiO_{x:.2f}.cell'):
+    print(cellfile)
+
+The mixed structure and mapping are built once (for every element that
+appears on each site anywhere on the grid) and only the MIXTURE weights change
+between compositions. Elements with zero weight are dropped from that .cell
+file and sites left with a single element are written without a mixture.
+"""
+
+
+class compsweep():
+    """ Class to write .cell files over a grid of compositions """
+
+    def __init__(self, pureatoms, mixkeyfn, grid, wttol=0.0001,
+                 **cellparams):
+        """
+        ase.Atoms pureatoms : template structure (one atom per site)
+        function mixkeyfn : mixkeyfn(**point) returns the (site or elem)
+        mixkey for a composition point, or None to skip that point
+        dict grid : {name: values} composition parameters, all combinations
+        of which are generated (multi-dimensional grids)
+        float wttol : weights below this are treated as absent elements
+        cellparams : passed on to mixmap.setcellparams (kpoints etc.)
+        """
+        self.wttol = wttol
+        self.names = list(grid.keys())
+        self.points = []
+        keys = []
+        for values in itertools.product(*[grid[name] for name in self.names]):
+            point = dict(zip(self.names, values))
+            mixkey = mixkeyfn(**point)
+            if mixkey is None:
+                continue
+            key = mixmap.MixKey.from_dict(mixkey)
+            key.check_wts(wttol)
+            self.points += [point]
+            keys += [key]
+        if not keys:
+            raise ValueError('No compositions to sweep over.')
+
+        # Build the mixed structure and mapping for all elements on each site
+        self.unionkey = self.union_mixkey(keys)
+        self.mixatoms = mixmap.create_mixture(pureatoms, self.unionkey)
+        self.mapping = mixmap.mixmap(self.mixatoms, self.unionkey)
+        self.mapping.setcellparams(**cellparams)
+        self.setup_atomsites()
+
+        # Weights of every mix atom at every composition point
+        self.pointwts = np.array([self.atomwts(key) for key in keys])
+
+    @staticmethod
+    def union_mixkey(keys):
+        """ MixKey with (equal weights of) every element that appears on
+        each site in any of the MixKeys keys (which must share sites) """
+        key0 = keys[0]
+        sitewts = [{} for i in range(key0.Nsites)]
+        for key in keys:
+            if (key.Nsites != key0.Nsites or
+                    any(key.pureelems != key0.pureelems)):
+                raise ValueError('All mixkeys in a sweep must have the same '
+                                 + 'sites in the same order.')
+            for i in range(key.Nsites):
+                for elem in key.sitewts(i):
+                    sitewts[i][elem] = 1.0
+        for wts in sitewts:
+            for elem in wts:
+                wts[elem] = 1.0/len(wts)
+        return mixmap.MixKey.from_sites(key0.pureelems, sitewts,
+                                        posns=key0.posns, postol=key0.postol)
+
+    def setup_atomsites(self):
+        """ Site (row of unionkey), element (column of unionkey) and pure
+        index of every atom in the mixed structure """
+        Nmix = self.mapping.mixions
+        self.atompure = np.zeros(Nmix, dtype=int)
+        for p in range(self.mapping.pureions):
+            for elem, (wt, j) in self.mapping.pure2mix_map[p].items():
+                self.atompure[j] = p
+        fracs = self.mixatoms.get_scaled_positions(wrap=False)
+        cell = np.array(self.mixatoms.get_cell())
+        elems = self.mixatoms.get_chemical_symbols()
+        self.atomrow = np.array([self.mapping.siteindex(elems[j], fracs[j],
+                                                        cell)
+                                 for j in range(Nmix)], dtype=int)
+        self.atomcol = np.array([self.unionkey.species.index(elem)
+                                 for elem in elems], dtype=int)
+
+    def atomwts(self, key):
+        """ returns
+        np.array(mixions) wts : weight of each mix atom for MixKey key """
+        W = np.zeros((self.unionkey.Nsites, len(self.unionkey.species)))
+        cols = [self.unionkey.species.index(elem) for elem in key.species]
+        dense = key.wts.toarray()
+        W[:, cols] = dense
+        return W[self.atomrow, self.atomcol]
+
+    def pointcell(self, n):
+        """ Mixed structure and mapping (with weights) for point index n
+        returns
+        ase.Atoms atoms : mixed structure without absent (zero weight) atoms
+        mixmap.mixmap mapping : mapping with this point's mixture weights """
+        wts = self.pointwts[n]
+        keep = np.where(wts > self.wttol)[0]
+        nkept = np.bincount(self.atompure[keep],
+                            minlength=self.mapping.pureions)
+        mixed = nkept > 1
+        labels = np.cumsum(mixed)  # CASTEP mixture label of each pure site
+        mapping = copy.copy(self.mapping)
+        mapping.mixsitemixes = {}
+        for k, j in enumerate(keep):
+            p = self.atompure[j]
+            if mixed[p]:
+                mapping.mixsitemixes[k] = (int(labels[p]), float(wts[j]))
+            else:
+                mapping.mixsitemixes[k] = (0, 1.0)
+        mapping.spins = [self.mapping.spins[j] for j in keep]
+        if self.mapping.ion_constrs is not None:
+            mapping.ion_constrs = np.asarray(self.mapping.ion_constrs)[keep]
+        return self.mixatoms[keep], mapping
+
+    def cellfiles(self, cellfmt):
+        """ list of filenames, cellfmt formatted with each point """
+        return [cellfmt.format(**point) for point in self.points]
+
+    def write(self, cellfmt, nprocs=1):
+        """ Write a .cell file for every composition on the grid (generator)
+
+        str cellfmt : filename pattern formatted with each point, e.g.
+        'CaSr_{x:.3f}.cell'
+        int nprocs : number of worker processes to format and write with
+
+        yields
+        tuple (dict point, str cellfile) : as each file is written """
+        cellfiles = self.cellfiles(cellfmt)
+        if nprocs is None or nprocs <= 1:
+            for n, cellfile in enumerate(cellfiles):
+                sweepwrite((self, n, cellfile))
+                yield self.points[n], cellfile
+        else:
+            jobs = [(None, n, cellfile) for n, cellfile in
+                    enumerate(cellfiles)]
+            chunksize = max(1, len(jobs)//(4*nprocs))
+            with ProcessPoolExecutor(max_workers=nprocs,
+                                     initializer=sweepinit,
+                                     initargs=(self,)) as pool:
+                for n in pool.map(sweepwrite, jobs, chunksize=chunksize):
+                    yield self.points[n], cellfiles[n]
+
+    def mixkey(self, n):
+        """ returns
+        dict elem_mixkey : weights for point index n (elem format) """
+        wts = self.pointwts[n]
+        elem_mixkey = {}
+        for p in range(self.mapping.pureions):
+            sitedict = {}
+            for elem, (wt, j) in self.mapping.pure2mix_map[p].items():
+                if wts[j] > self.wttol:
+                    sitedict[elem] = float(wts[j])
+            elem_mixkey.setdefault(self.mapping.pureelems[p], sitedict)
+        return elem_mixkey
+
+
+sweepstate = {}
+
+
+def sweepinit(sweep):
+    """ Worker initialiser: the sweep is sent to each process only once """
+    sweepstate['sweep'] = sweep
+
+
+def sweepwrite(args):
+    """ Worker: (sweep or None, point index, cellfile) -> point index """
+    sweep, n, cellfile = args
+    if sweep is None:
+        sweep = sweepstate['sweep']
+    atoms, mapping = sweep.pointcell(n)
+    mapping.casprint(atoms, cellfile)
+    return n
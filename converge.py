@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import numpy as np
+import mixmap
+import readmixcastep as rc
+import strindices as stri
+import jobrunner
+
+"""
+Module to converge k-point grids (or plane wave cut-offs) of a (mixed)
+structure with as few CASTEP runs as possible, e.g.
+
+conv = convergence('CaSrTiO.cell', 'kpoints', etol=1e-3, ftol=0.05,
+                   command='castep.serial {seed}')
+result = conv.run()
+print(result['converged'])  # e.g. [6, 6, 2]
+
+Runs are made in order of increasing k-point density (or cut-off) and stop as
+soon as two consecutive runs agree within the tolerances on the energy per
+(pure) atom, every force and every stress component: the lower setting is
+then converged. Each run is written (seed_k6x6x2.cell or seed_cut600.cell
+with a copy of seed.param) only when the runs before it have not converged,
+and any run already complete on disk is reused. Without a command the next
+files to run are written and run() returns, so it can be called again once
+they have finished (e.g. on a cluster).
+"""
+
+
+def kpoint_grids(cell, lengths=None):
+    """ MP grids of increasing density (distinct grids only)
+
+    np.array(3, 3) cell : unit cell vectors (Ang)
+    list lengths : k-point lengths (Ang), each gives the grid
+    ceil(length/|a_i|) along every lattice vector i (default 10 to 80 Ang)
+
+    returns
+    list grids : [k1, k2, k3] for each distinct grid """
+    if lengths is None:
+        lengths = np.arange(10.0, 80.1, 5.0)
+    norms = np.linalg.norm(np.array(cell), axis=1)
+    grids = []
+    for length in lengths:
+        grid = [int(k) for k in np.maximum(1, np.ceil(length/norms - 1e-8))]
+        if grid not in grids:
+            grids += [grid]
+    return grids
+
+
+def read_offset(cas):
+    """ returns
+    list offset : kpoints_mp_offset of a readcell (zero, CASTEP's default, if
+    the .cell has none) """
+    for line in cas.celllines:
+        words = line.replace('=', ' ').replace(':', ' ').split()
+        if words and words[0].lower() in ['kpoints_mp_offset',
+                                          'kpoint_mp_offset']:
+            return [float(o) for o in words[1:4]]
+    return [0.0, 0.0, 0.0]
+
+
+def kpoint_offset(kgrid, kgrid0=None, offset0=None):
+    """ returns
+    list offset : MP offset of kgrid in the convention of offset0, the offset
+    of the grid kgrid0 of the input cell: 1/(2k) on odd grids (as
+    readcell.get_kpoints) if offset0 follows that rule (or is not given),
+    otherwise offset0 unchanged (e.g. zero for a Gamma centred grid) """
+    rule = [0.0 if k % 2 == 0 else 1.0/(2*k) for k in kgrid]
+    if offset0 is None or np.allclose(offset0, kpoint_offset(kgrid0)):
+        return rule
+    return list(offset0)
+
+
+def read_param(paramfile):
+    """ returns
+    list paramlines : lines of a CASTEP .param file (empty if missing) """
+    if paramfile is None or not os.path.exists(paramfile):
+        return []
+    return open(paramfile, 'r').readlines()
+
+
+def set_cutoff(paramlines, cutoff):
+    """ returns
+    str text : .param text with cut_off_energy set to cutoff (eV) """
+    lines = [line for line in paramlines
+             if not line.lower().strip().startswith('cut_off_energy')]
+    return ''.join(lines) + 'cut_off_energy : {0:g} eV\n'.format(cutoff)
+
+
+def read_result(casfile):
+    """ returns
+    dict result : final energy (eV), forces (eV/Ang) and stresses (GPa) of a
+    complete casfile (stresses are None if CASTEP did not compute them) """
+    cas = rc.readcas(casfile)
+    result = {'energy': cas.get_energy(), 'forces': cas.get_forces(),
+              'stresses': None}
+    if stri.strindices(cas.caslines, ['* Stress Tensor *',
+                                      '* Symmetrised Stress Tensor *'],
+                       either=True):
+        result['stresses'] = cas.get_stresses()
+    return result
+
+
+def differences(result1, result2, Natoms):
+    """ returns
+    tuple (dE, dF, dS) : change in energy per atom (eV), largest change of a
+    force component (eV/Ang) and of a stress component (GPa) """
+    dE = abs(result2['energy'] - result1['energy'])/Natoms
+    dF = np.max(np.abs(result2['forces'] - result1['forces']))
+    if result1['stresses'] is None or result2['stresses'] is None:
+        dS = 0.0
+    else:
+        dS = np.max(np.abs(result2['stresses'] - result1['stresses']))
+    return dE, dF, dS
+
+
+class convergence():
+    """ Class to converge k-points or cut-off with early stopping """
+
+    def __init__(self, cellfile, param='kpoints', values=None, etol=1e-3,
+                 ftol=0.05, stol=0.1, paramfile=None, command=None,
+                 maxjobs=1, dbfile='converge.db'):
+        """
+        str cellfile : .cell file of the structure (may have mixed atoms)
+        str param : 'kpoints' or 'cutoff'
+        list values : k-point grids (default kpoint_grids of the cell) or
+        cut-offs in eV (default 300 to 1200 eV) in increasing order
+        float etol : tolerance on the energy per (pure) atom (eV)
+        float ftol : tolerance on each force component (eV/Ang)
+        float stol : tolerance on each stress component (GPa)
+        str paramfile : .param file copied for every run (default the
+        cellfile's seed.param, if it exists)
+        str command : command to run CASTEP with ({seed}, see jobrunner),
+        if None files are only written
+        int maxjobs : number of runs made at once (more than one runs the
+        next settings ahead of the convergence check, trading compute for
+        time)
+        str dbfile : jobrunner database
+        """
+        if param not in ['kpoints', 'cutoff']:
+            raise ValueError('param must be \'kpoints\' or \'cutoff\'.')
+        self.seed = cellfile.replace('.cell', '')
+        self.param = param
+        self.tols = (etol, ftol, stol)
+        self.command = command
+        self.maxjobs = maxjobs
+        self.dbfile = dbfile
+        if paramfile is None:
+            paramfile = self.seed + '.param'
+        self.paramlines = read_param(paramfile)
+
+        cas = rc.readcell(cellfile)
+        self.mixatoms = cas.extract_struc()
+        self.mapping = mixmap.mixmap(self.mixatoms, cas.get_mixkey())
+        self.kpoints = cas.get_kpoints()[0]
+        self.offset = read_offset(cas)
+        self.cellparams = {'spins': cas.get_init_spin(),
+                           'pressure': cas.get_ext_press(),
+                           'cell_constrs': cas.get_cell_constrs(),
+                           'pseudos': cas.get_psps()}
+        if values is None:
+            if param == 'kpoints':
+                values = kpoint_grids(self.mixatoms.get_cell())
+            else:
+                values = [float(c) for c in np.arange(300.0, 1200.1, 100.0)]
+        self.values = list(values)
+
+    def name(self, value):
+        """ returns
+        str seed : seed of the run for a k-point grid or cut-off """
+        if self.param == 'kpoints':
+            return self.seed + '_k' + 'x'.join([str(k) for k in value])
+        return self.seed + '_cut{0:g}'.format(value)
+
+    def write(self, value):
+        """ Write the .cell (and .param) files of one run (unless they
+        already exist)
+        returns
+        str cellfile : file of the run """
+        seed = self.name(value)
+        if not os.path.exists(seed + '.cell'):
+            kpoints = value if self.param == 'kpoints' else self.kpoints
+            offset = kpoint_offset(kpoints, self.kpoints, self.offset)
+            self.mapping.setcellparams(kpoints=list(kpoints),
+                                       kpoints_offset=offset,
+                                       **self.cellparams)
+            self.mapping.casprint(self.mixatoms, seed + '.cell')
+        if self.param == 'cutoff':
+            text = set_cutoff(self.paramlines, value)
+        else:
+            text = ''.join(self.paramlines)
+        if text and not os.path.exists(seed + '.param'):
+            mixmap.atomic_write(text, seed + '.param')
+        return seed + '.cell'
+
+    def run(self, verbose=False):
+        """ Run (or write) settings in order until two consecutive runs agree
+
+        returns
+        dict result : 'values' run so far, their 'energies', the
+        'differences' (dE, dF, dS) between consecutive runs, the
+        'converged' value (None if not yet converged) and the cellfiles
+        still 'waiting' to be run (without a command) """
+        if self.command is not None:
+            runner = jobrunner.jobrunner(self.dbfile, command=self.command,
+                                         maxjobs=self.maxjobs)
+        results = []
+        output = {'values': [], 'energies': [], 'differences': [],
+                  'converged': None, 'waiting': []}
+        n = 0
+        while n < len(self.values):
+            # Reuse finished runs, otherwise write (and run) the next ones
+            value = self.values[n]
+            casfile = self.name(value) + '.castep'
+            if not jobrunner.castep_complete(casfile):
+                batch = self.values[n:n+max(1, self.maxjobs)]
+                cellfiles = [self.write(v) for v in batch
+                             if not jobrunner.castep_complete(self.name(v)
+                                                    + '.castep')]
+                if self.command is None:
+                    output['waiting'] = cellfiles
+                    break
+                runner.add(cellfiles)
+                runner.run()
+                if not jobrunner.castep_complete(casfile):
+                    raise RuntimeError('Run ' + casfile + ' did not complete.')
+            results += [read_result(casfile)]
+            output['values'] += [value]
+            output['energies'] += [results[-1]['energy']]
+            if len(results) > 1:
+                diff = differences(results[-2], results[-1],
+                                   self.mapping.pureions)
+                output['differences'] += [diff]
+                if verbose:
+                    print(self.name(value) + ': dE = {0:.2e} eV/atom, '
+                          'dF = {1:.2e} eV/A, dS = {2:.2e} GPa'.format(*diff))
+                if all([d <= tol for d, tol in zip(diff, self.tols)]):
+                    output['converged'] = self.values[n-1]
+                    break
+            n += 1
+        if self.command is not None:
+            runner.close()
+        return output
+
+
+##########################################################################
+
+if __name__ == '__main__':
+    """ Run from the command line: converge.py [options] cellfile """
+    parser = argparse.ArgumentParser(
+        description='Converge k-points or cut-off with early stopping.')
+    parser.add_argument('cellfile', help='.cell file to converge')
+    parser.add_argument('-p', '--param', default='kpoints',
+                        choices=['kpoints', 'cutoff'])
+    parser.add_argument('-e', '--etol', type=float, default=1e-3,
+                        help='energy tolerance (eV/atom)')
+    parser.add_argument('-f', '--ftol', type=float, default=0.05,
+                        help='force tolerance (eV/Ang)')
+    parser.add_argument('-s', '--stol', type=float, default=0.1,
+                        help='stress tolerance (GPa)')
+    parser.add_argument('-c', '--command', default=None,
+                        help='command to run CASTEP with ({seed}), '
+                        'otherwise the next runs are only written')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of runs made at once')
+    args = parser.parse_args()
+    conv = convergence(args.cellfile, args.param, etol=args.etol,
+                       ftol=args.ftol, stol=args.stol, command=args.command,
+                       maxjobs=args.jobs)
+    result = conv.run(verbose=True)
+    if result['converged'] is not None:
+        print('Converged: ' + conv.name(result['converged']))
+    elif result['waiting']:
+        print('Run these and call again: ' + ' '.join(result['waiting']))
+    else:
+        print('Not converged over the settings tried.')
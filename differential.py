@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import importlib
+from glob import glob
+import numpy as np
+import synthcastep
+
+"""
+Differential check of the parsers and mappers: everything readcas, readcell,
+strindex/strindices and mixmap extract from a set of files is compared
+between the frozen reference implementation (the reference package) and the
+current modules (or any other candidate with the same interface), e.g.
+
+differential.py                       (examples/ and synthetic files)
+differential.py runs/*.castep -n 64 512 --candidate fastread,mixmap,strindices
+
+Positions, cells, forces, stresses, energies and enthalpies of every
+iteration, k-points, pseudopotentials, pressures, constraints, spins,
+mixkeys, the pure/mix maps and masses of mixmap, mapped structures, forces
+and the text of written .cell files must be exactly equal (or within --atol),
+and the same errors must be raised. The time each implementation takes is
+reported side by side, and the exit status is 1 if anything differs.
+Only element format mixkeys are given to create_mixture, since the reference
+placed site format mixtures at the fractional site coordinates.
+"""
+
+reference_modules = ['reference.readmixcastep', 'reference.mixmap',
+                     'reference.strindices']
+current_modules = ['readmixcastep', 'mixmap', 'strindices']
+
+# strindex/strindices calls made on every file: (strings, keyword arguments)
+queries = [('Total number of ions in cell', {}),
+           ('Element ', {'first': True}),
+           ('finished iteration', {}),
+           ('finished iteration', {'first': True, 'nmin': 10}),
+           (['%BLOCK', '%block'], {'either': True}),
+           (['%BLOCK', 'POSITIONS'], {}),
+           ('Final energy', {'nmin': 5, 'nmax': 200}),
+           ('no such line', {})]
+
+
+def load(names):
+    """ returns
+    tuple (readmixcastep, mixmap, strindices) : implementation modules """
+    return tuple([importlib.import_module(name) for name in names])
+
+
+def attempt(func, *args, **kwargs):
+    """ returns
+    result : func(*args, **kwargs) or, if that raises, the name of the
+    error (so that implementations must raise the same errors) """
+    try:
+        return func(*args, **kwargs)
+    except Exception as error:
+        return 'raised ' + type(error).__name__
+
+
+class timer():
+    """ Accumulates the time spent in named groups of calls """
+
+    def __init__(self):
+        self.seconds = {}
+        self.group = None
+
+    def __call__(self, group):
+        self.group = group
+        return self
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.seconds[self.group] = (self.seconds.get(self.group, 0.0)
+                                    + time.perf_counter() - self.start)
+
+
+def castep_results(rc, casfile, clock):
+    """ returns
+    dict results : everything readcas extracts from casfile (see module) """
+    with clock('parse'):
+        cas = rc.readcas(casfile)
+    out = {}
+    with clock('getters'):
+        for attr in ['task', 'Nions', 'Niterations', 'elems', 'complete']:
+            out[attr] = getattr(cas, attr)
+        for getter in ['get_kpoints', 'get_psps', 'get_ext_press',
+                       'get_cell_constrs', 'get_init_spin', 'get_final_spin',
+                       'check_complete']:
+            out[getter] = attempt(getattr(cas, getter))
+        iterations = range(cas.Niterations) if cas.task == 'geometry' \
+            else [-1]
+        for n in iterations:
+            for getter in ['get_posns', 'get_cell', 'get_energy',
+                           'get_forces', 'get_stresses', 'get_enthalpy']:
+                out[getter + '(' + str(n) + ')'] = attempt(
+                    getattr(cas, getter), iteration=n)
+    with clock('mixkey'):
+        out['get_mixkey'] = attempt(cas.get_mixkey)
+    return cas, out
+
+
+def cell_results(rc, cellfile, clock):
+    """ returns
+    dict results : everything readcell extracts from cellfile """
+    with clock('parse'):
+        cas = rc.readcell(cellfile)
+    out = {}
+    with clock('getters'):
+        for attr in ['Nions', 'elems', 'posns', 'paramlines']:
+            out[attr] = getattr(cas, attr)
+        for getter in ['get_kpoints', 'get_psps', 'get_init_spin',
+                       'get_ext_press', 'get_cell_constrs', 'get_cell',
+                       'get_posns']:
+            out[getter] = attempt(getattr(cas, getter))
+    with clock('mixkey'):
+        out['get_mixkey'] = attempt(cas.get_mixkey)
+    return cas, out
+
+
+def mixmap_results(mm, atoms, mixkey, folder, clock):
+    """ returns
+    dict results : maps of a mixmap of atoms, the structures, spins and
+    forces it maps and the .cell files it writes """
+    out = {}
+    with clock('mixmap'):
+        mapping = mm.mixmap(atoms, mixkey)
+        for attr in ['mixelems', 'mixions', 'mixmasses', 'pureions',
+                     'pureelems', 'puremasses', 'pure2mix_map',
+                     'mix2pure_map', 'mixsitemixes']:
+            out[attr] = getattr(mapping, attr)
+        pureatoms = mapping.mix2pure(atoms)
+        out['mix2pure'] = (pureatoms.get_chemical_symbols(),
+                           pureatoms.get_positions(), pureatoms.get_masses())
+        mixatoms = mapping.pure2mix(pureatoms)
+        out['pure2mix'] = (mixatoms.get_chemical_symbols(),
+                           mixatoms.get_positions())
+        rng = np.random.RandomState(0)
+        out['mix2pure_forces'] = mapping.mix2pure_forces(
+            rng.normal(size=(len(atoms), 3)))
+        out['mix2pure_spins'] = mapping.mix2pure_spins(
+            rng.normal(size=len(atoms)))
+        out['pure2mix_spins'] = mapping.pure2mix_spins(
+            rng.normal(size=mapping.pureions))
+        out['pinch_posns'] = attempt(
+            lambda: mapping.pinch_posns(atoms).get_positions())
+        elemkey = attempt(mm.mixmap.site2elem_mixkey, mixkey)
+        out['site2elem_mixkey'] = elemkey
+        if isinstance(elemkey, dict):
+            mixture = attempt(mm.create_mixture, pureatoms, elemkey)
+            out['create_mixture'] = attempt(
+                lambda: (mixture.get_chemical_symbols(),
+                         mixture.get_positions()))
+    with clock('casprint'):
+        for pure in [False, True]:
+            mapping.setcellparams(kpoints=[3, 4, 5],
+                                  kpoints_offset=[0.0, 0.125, 0.1],
+                                  pressure=[1.5, 1.5, 1.5, 0.0, 0.25, 0.0],
+                                  pseudos={'Ca': 'Ca_00.usp'},
+                                  spins=[0.5*(i % 3) for i in
+                                         range(len(atoms))])
+            cellfile = os.path.join(folder, 'differential.cell')
+            mapping.casprint(pureatoms if pure else atoms, cellfile,
+                             pure=pure)
+            out['casprint' + ('_pure' if pure else '')] = open(
+                cellfile, 'r').read()
+    return out
+
+
+def strindex_results(stri, lines, clock):
+    """ returns
+    dict results : strindex and strindices of the lines for every query """
+    out = {}
+    with clock('strindex'):
+        for strings, kwargs in queries:
+            key = str(strings) + str(sorted(kwargs.items()))
+            out['strindex' + key] = attempt(stri.strindex, lines, strings,
+                                            **kwargs)
+            kwargs = {k: v for k, v in kwargs.items() if k != 'first'}
+            out['strindices' + key] = attempt(stri.strindices, lines, strings,
+                                              **kwargs)
+    return out
+
+
+def results(modules, filename, folder):
+    """ returns
+    dict results : everything extracted from filename by an implementation
+    dict seconds : time taken by each group of calls """
+    rc, mm, stri = modules
+    clock = timer()
+    if filename.endswith('.castep'):
+        cas, out = castep_results(rc, filename, clock)
+        lines = cas.caslines
+    else:
+        cas, out = cell_results(rc, filename, clock)
+        lines = cas.celllines
+    mixkey = out['get_mixkey']
+    if isinstance(mixkey, dict):
+        out.update(mixmap_results(mm, cas.extract_struc(), mixkey, folder,
+                                  clock))
+    out.update(strindex_results(stri, lines, clock))
+    return out, clock.seconds
+
+
+def differences(ref, new, atol=0.0, path=''):
+    """ returns
+    list differences : description of each place ref and new differ (lists
+    and tuples are interchangeable, numbers must agree within atol) """
+    if isinstance(ref, dict) and isinstance(new, dict):
+        diffs = []
+        for key in sorted(set(ref) | set(new), key=str):
+            if key not in new or key not in ref:
+                diffs += [path + '[' + repr(key) + '] only in '
+                          + ('reference' if key in ref else 'candidate')]
+            else:
+                diffs += differences(ref[key], new[key], atol,
+                                     path + '[' + repr(key) + ']')
+        return diffs
+    if isinstance(ref, (str, bytes)) or isinstance(new, (str, bytes)):
+        if ref == new:
+            return []
+        if isinstance(ref, str) and isinstance(new, str) and \
+                '\n' in ref + new:
+            reflines, newlines = ref.splitlines(), new.splitlines()
+            for n in range(max(len(reflines), len(newlines))):
+                refline = reflines[n] if n < len(reflines) else None
+                newline = newlines[n] if n < len(newlines) else None
+                if refline != newline:
+                    return [path + ' line ' + str(n+1) + ': '
+                            + repr(refline) + ' != ' + repr(newline)]
+        return [path + ': ' + repr(ref) + ' != ' + repr(new)]
+    try:
+        refarr = np.asarray(ref)
+        newarr = np.asarray(new)
+        numeric = refarr.dtype.kind in 'biuf' and newarr.dtype.kind in 'biuf'
+    except (ValueError, TypeError):
+        numeric = False
+    if numeric:
+        if refarr.shape != newarr.shape:
+            return [path + ': shape ' + str(refarr.shape) + ' != '
+                    + str(newarr.shape)]
+        if 'f' in refarr.dtype.kind + newarr.dtype.kind:
+            equal = np.isclose(refarr, newarr, rtol=0.0, atol=atol,
+                               equal_nan=True) | (refarr == newarr)
+        else:
+            equal = np.asarray(refarr == newarr)
+        if not np.all(equal):
+            return [path + ': ' + str(int(np.sum(~equal))) + ' of '
+                    + str(equal.size) + ' values differ']
+        return []
+    if isinstance(ref, (list, tuple)) and isinstance(new, (list, tuple)):
+        if len(ref) != len(new):
+            return [path + ': length ' + str(len(ref)) + ' != '
+                    + str(len(new))]
+        diffs = []
+        for n, (r, c) in enumerate(zip(ref, new)):
+            diffs += differences(r, c, atol, path + '[' + str(n) + ']')
+        return diffs
+    if ref != new:
+        return [path + ': ' + repr(ref) + ' != ' + repr(new)]
+    return []
+
+
+def synthetic_files(sizes, folder, mixed=0.25, Niterations=4):
+    """ returns
+    list files : synthetic geometry, continuation, single point and .cell
+    files of each size (see synthcastep) """
+    files = []
+    for Nions in sizes:
+        Nmixed = int(round(Nions*mixed/(1.0 + mixed)))
+        stem = os.path.join(folder, 'synth' + str(Nions))
+        files += [synthcastep.write_castep(stem + '_geom.castep', Nions,
+                                           Nmixed, Niterations=Niterations),
+                  synthcastep.write_castep(stem + '_cont.castep', Nions,
+                                           Nmixed, Niterations=Niterations,
+                                           Nsegments=2, complete=False),
+                  synthcastep.write_castep(stem + '_single.castep', Nions,
+                                           Nmixed, task='single'),
+                  synthcastep.write_cell(stem + '.cell', Nions, Nmixed)]
+    return files
+
+
+def run(files, reference=None, candidate=None, atol=0.0, stream=None):
+    """ Compare the results of two implementations on every file
+
+    list files : .castep and .cell files
+    list reference, candidate : module names of each implementation
+    (readmixcastep, mixmap, strindices), default the reference package and
+    the current modules
+    float atol : numbers may differ by this much
+    file stream : where to report each file (e.g. sys.stdout), if anywhere
+
+    returns
+    dict report : {filename: {'differences': [...], 'reference': seconds,
+    'candidate': seconds}} (seconds of each group of calls) """
+    refmodules = load(reference or reference_modules)
+    newmodules = load(candidate or current_modules)
+    folder = tempfile.mkdtemp(prefix='vcadiff')
+    report = {}
+    try:
+        for filename in files:
+            refout, refsecs = results(refmodules, filename, folder)
+            newout, newsecs = results(newmodules, filename, folder)
+            report[filename] = {'differences': differences(refout, newout,
+                                                           atol),
+                                'reference': refsecs, 'candidate': newsecs}
+            if stream is not None:
+                print(summary_line(filename, report[filename]), file=stream,
+                      flush=True)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return report
+
+
+def summary_line(filename, entry):
+    """ returns
+    str line : verdict and side by side times of one file """
+    reftime = sum(entry['reference'].values())
+    newtime = sum(entry['candidate'].values())
+    verdict = 'same' if not entry['differences'] else \
+        str(len(entry['differences'])) + ' differences'
+    line = '{0:<16s} reference {1:8.4f} s  candidate {2:8.4f} s  {3}'.format(
+        verdict, reftime, newtime, filename)
+    for diff in entry['differences'][:10]:
+        line += '\n    ' + diff
+    return line
+
+
+def timing_table(report):
+    """ returns
+    str table : total time of each group of calls in each implementation """
+    groups = []
+    for entry in report.values():
+        groups += [g for g in entry['reference'] if g not in groups]
+    lines = ['{0:<10s} {1:>12s} {2:>12s} {3:>8s}'.format(
+        'group', 'reference', 'candidate', 'speedup')]
+    for group in groups:
+        ref = sum([e['reference'].get(group, 0.0) for e in report.values()])
+        new = sum([e['candidate'].get(group, 0.0) for e in report.values()])
+        lines += ['{0:<10s} {1:12.4f} {2:12.4f} {3:8.2f}'.format(
+            group, ref, new, ref/new if new > 0 else np.inf)]
+    return '\n'.join(lines)
+
+
+##########################################################################
+
+if __name__ == '__main__':
+    """ Run from the command line: differential.py [options] [files] """
+    parser = argparse.ArgumentParser(
+        description='Compare parsers and mappers with the reference ones.')
+    parser.add_argument('paths', nargs='*',
+                        default=['examples/*.castep', 'examples/*.cell'],
+                        help='.castep/.cell files or globs')
+    parser.add_argument('-n', '--sizes', type=int, nargs='*',
+                        default=[40, 120],
+                        help='numbers of ions of synthetic files')
+    parser.add_argument('--candidate', default=None,
+                        help='modules to check (readmixcastep,mixmap,'
+                        'strindices), default the current ones')
+    parser.add_argument('--atol', type=float, default=0.0)
+    parser.add_argument('-o', '--output', default=None,
+                        help='write the report as JSON')
+    args = parser.parse_args()
+    files = []
+    for path in args.paths:
+        files += [f for f in sorted(glob(path)) if f not in files]
+    synthfolder = tempfile.mkdtemp(prefix='vcasynth')
+    try:
+        files += synthetic_files(args.sizes, synthfolder)
+        candidate = None
+        if args.candidate is not None:
+            candidate = args.candidate.split(',')
+        report = run(files, candidate=candidate, atol=args.atol,
+                     stream=sys.stdout)
+    finally:
+        shutil.rmtree(synthfolder, ignore_errors=True)
+    print('\n' + timing_table(report))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    failed = [f for f, entry in report.items() if entry['differences']]
+    print('\n' + str(len(files) - len(failed)) + ' of ' + str(len(files))
+          + ' files identical')
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import mixmap
+import readmixcastep as rc
+
+"""
+Module to compute elastic constants (Cij) of solid solutions from CASTEP
+stresses of strained (mixed) cells, e.g. for several relaxed compositions:
+
+casfiles = ['CaSr_0.00.castep', 'CaSr_0.50.castep', 'CaSr_1.00.castep']
+for casfile in casfiles:
+    gen_strains(casfile)  # writes CaSr_0.00_elastic_0.cell, ... + manifest
+# ... run CASTEP (geometry optimisation of the ions, see below) ...
+C, rms = fit_compositions(casfiles, nprocs=4)  # C[n] is Cij of casfiles[n]
+
+or as one command (generate, run with jobrunner and fit):
+
+python elastic.py -j 4 -c 'castep.serial {seed}' CaSr_*.castep
+
+The strained cells keep the mixtures (and fractional positions) of the
+relaxed structure and have fixed cell constraints (all zero), so with a
+geometry optimisation .param only the ions relax. Stresses are in GPa with
+CASTEP's sign (tensile positive), so that stress = stress0 + C.strain, with
+Voigt strains (e_xx, e_yy, e_zz, 2e_yz, 2e_xz, 2e_xy).
+"""
+
+voigt = [(0, 0), (1, 1), (2, 2), (1, 2), (0, 2), (0, 1)]
+magnitudes_default = [-0.01, -0.005, 0.005, 0.01]
+
+
+def strain_set(magnitudes=magnitudes_default):
+    """ returns
+    np.array(6*Nmag, 6) strains : each Voigt strain component on its own at
+    each magnitude """
+    return np.array([np.eye(6)[v]*mag for v in range(6)
+                     for mag in magnitudes])
+
+
+def strain_tensor(strains):
+    """ returns
+    np.array(..., 3, 3) eps : symmetric strain tensors of Voigt strains """
+    strains = np.asarray(strains, dtype=float)
+    eps = np.zeros(strains.shape[:-1] + (3, 3))
+    for v, (i, j) in enumerate(voigt):
+        scale = 1.0 if i == j else 0.5
+        eps[..., i, j] = scale*strains[..., v]
+        eps[..., j, i] = scale*strains[..., v]
+    return eps
+
+
+def voigt_stress(stress):
+    """ returns
+    np.array(..., 6) stress : Voigt vectors of (..., 3, 3) stress tensors """
+    stress = np.asarray(stress)
+    return np.stack([stress[..., i, j] for i, j in voigt], axis=-1)
+
+
+def manifest_file(chem):
+    """ returns
+    str filename : manifest of the strained cells written for chem """
+    return chem + '_elastic.json'
+
+
+def gen_strains(casfile, strains=None, nprocs=1, **cellparams):
+    """ Write strained mixed .cell files (chem_elastic_n.cell) of a relaxed
+    structure, and a manifest (chem_elastic.json) of their strains
+
+    str casfile : relaxed .castep file
+    np.array(Nstrains, 6) strains : Voigt strains (default strain_set())
+    int nprocs : number of processes used to write the .cell files
+    cellparams : passed on to mixmap.setcellparams (the k-points, spins and
+    pseudopotentials of casfile are used unless given)
+
+    returns
+    list cellfiles : files written """
+    if strains is None:
+        strains = strain_set()
+    strains = np.atleast_2d(np.asarray(strains, dtype=float)) + 0.0
+    chem = casfile.replace('.castep', '')
+    cas = rc.readcas(casfile)
+    mixatoms = cas.extract_struc()
+    mapping = mixmap.mixmap(mixatoms, cas.get_mixkey())
+    kpoints, offset = cas.get_kpoints()
+    params = {'kpoints': kpoints, 'kpoints_offset': offset,
+              'spins': cas.get_final_spin(), 'pseudos': cas.get_psps()}
+    params.update(cellparams)
+    params['cell_constrs'] = [0]*6
+    mapping.setcellparams(**params)
+
+    # Homogeneous deformation of the cell: fractional positions unchanged
+    cell = np.array(mixatoms.get_cell())
+    deforms = np.eye(3) + strain_tensor(strains)
+    strained = {}
+    for n, deform in enumerate(deforms):
+        atoms = mixatoms.copy()
+        atoms.set_cell(np.dot(cell, deform.T), scale_atoms=True)
+        strained[chem + '_elastic_' + str(n) + '.cell'] = atoms
+    mapping.casprint_many(strained, nprocs=nprocs)
+
+    manifest = {'parent': os.path.basename(casfile),
+                'strains': strains.tolist(),
+                'cellfiles': [os.path.basename(cellfile)
+                              for cellfile in strained]}
+    mixmap.atomic_write(json.dumps(manifest, indent=1), manifest_file(chem))
+    return list(strained.keys())
+
+
+def read_manifest(casfile):
+    """ returns
+    np.array(Nstrains, 6) strains : Voigt strains of the strained cells
+    list casfiles : .castep files of the strained cells """
+    chem = casfile.replace('.castep', '')
+    manifest = json.load(open(manifest_file(chem), 'r'))
+    folder = os.path.dirname(casfile)
+    casfiles = [os.path.join(folder, cellfile.replace('.cell', '.castep'))
+                for cellfile in manifest['cellfiles']]
+    return np.array(manifest['strains']), casfiles
+
+
+def read_stress(casfile):
+    """ Worker: returns the final Voigt stress (GPa) of casfile, or NaNs if
+    the calculation is missing or not complete """
+    if os.path.exists(casfile):
+        cas = rc.readcas(casfile)
+        if cas.check_complete():
+            return voigt_stress(cas.get_stresses())
+    return np.full(6, np.nan)
+
+
+def read_stresses(casfiles, nprocs=1):
+    """ returns
+    np.array(N, 6) stresses : Voigt stresses of casfiles (NaN if missing) """
+    if nprocs is None or nprocs <= 1:
+        stresses = [read_stress(casfile) for casfile in casfiles]
+    else:
+        chunksize = max(1, len(casfiles)//(4*nprocs))
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            stresses = list(pool.map(read_stress, casfiles,
+                                     chunksize=chunksize))
+    return np.array(stresses).reshape(-1, 6)
+
+
+def fit_cij(strains, stresses):
+    """ Least squares fit of stress = stress0 + C.strain for one or many
+    compositions at once (missing stresses, NaN, are left out of the fit)
+
+    np.array(..., Nstrains, 6) strains : Voigt strains
+    np.array(..., Nstrains, 6) stresses : Voigt stresses (GPa)
+
+    returns
+    np.array(..., 6, 6) C : symmetrised elastic constants (GPa), NaN where
+    the strains given (and completed) do not determine every Cij
+    np.array(...) rms : RMS residual of the stresses (GPa) """
+    stresses = np.asarray(stresses, dtype=float)
+    strains = np.broadcast_to(np.asarray(strains, dtype=float),
+                              stresses.shape)
+    A = np.concatenate([np.ones(strains.shape[:-1] + (1,)), strains],
+                       axis=-1)
+    valid = np.all(np.isfinite(stresses), axis=-1)
+    stacked = A.reshape(-1, *A.shape[-2:])
+    if valid.all() and np.all(stacked == stacked[0]):
+        # Same strains for every composition: a single solve with all the
+        # compositions' stresses as right hand sides
+        Nstrains = stresses.shape[-2]
+        Y = np.moveaxis(stresses, -2, 0).reshape(Nstrains, -1)
+        coeffs = np.linalg.lstsq(stacked[0], Y, rcond=None)[0]
+        coeffs = np.moveaxis(coeffs.reshape((7,) + stresses.shape[:-2]
+                                            + (6,)), 0, -2)
+        rank = np.linalg.matrix_rank(stacked[0])
+    else:
+        # Batched over compositions with the missing rows zeroed
+        A = np.where(valid[..., None], A, 0.0)
+        coeffs = np.matmul(np.linalg.pinv(A),
+                           np.where(valid[..., None], stresses, 0.0))
+        rank = np.linalg.matrix_rank(A)
+    fitted = np.matmul(A, coeffs)
+    resid = np.where(valid[..., None], fitted - np.nan_to_num(stresses), 0.0)
+    rms = np.sqrt(np.sum(resid**2, axis=(-2, -1)) /
+                  np.maximum(6*np.sum(valid, axis=-1), 1))
+    C = coeffs[..., 1:, :]
+    C = np.swapaxes(C, -2, -1)  # C[i, j] = dstress_i/dstrain_j
+    C = 0.5*(C + np.swapaxes(C, -2, -1))
+    C = np.where((np.asarray(rank) < 7)[..., None, None], np.nan, C)
+    return C, rms
+
+
+def vrh(C):
+    """ returns
+    tuple (K, G) : Voigt-Reuss-Hill bulk and shear moduli (GPa) of
+    (..., 6, 6) elastic constants """
+    C = np.asarray(C, dtype=float)
+    S = np.linalg.inv(C)
+    d = np.arange(3)
+    o = np.arange(3, 6)
+    KV = (np.sum(C[..., :3, :3], axis=(-2, -1)))/9.0
+    GV = (np.sum(C[..., d, d], axis=-1) - (np.sum(C[..., :3, :3],
+                                                   axis=(-2, -1))
+                                           - np.sum(C[..., d, d], axis=-1))/2
+          + 3*np.sum(C[..., o, o], axis=-1))/15.0
+    KR = 1.0/np.sum(S[..., :3, :3], axis=(-2, -1))
+    GR = 15.0/(4*np.sum(S[..., d, d], axis=-1)
+               - 2*(np.sum(S[..., :3, :3], axis=(-2, -1))
+                    - np.sum(S[..., d, d], axis=-1))
+               + 3*np.sum(S[..., o, o], axis=-1))
+    return 0.5*(KV + KR), 0.5*(GV + GR)
+
+
+def fit_compositions(casfiles, nprocs=1):
+    """ Fit the elastic constants of many compositions (from the manifests
+    written by gen_strains), reading every stress in one parallel pass
+
+    list casfiles : relaxed .castep files that gen_strains was run on
+    int nprocs : number of processes used to read the stresses
+
+    returns
+    np.array(Ncomps, 6, 6) C : elastic constants (GPa)
+    np.array(Ncomps) rms : RMS residual of the stresses (GPa) """
+    manifests = [read_manifest(casfile) for casfile in casfiles]
+    allfiles = [strainfile for strains, strainfiles in manifests
+                for strainfile in strainfiles]
+    stresses = read_stresses(allfiles, nprocs=nprocs)
+    if len(set([len(strains) for strains, strainfiles in manifests])) == 1:
+        strains = np.array([strains for strains, strainfiles in manifests])
+        return fit_cij(strains, stresses.reshape(strains.shape))
+    C, rms = [], []
+    start = 0
+    for strains, strainfiles in manifests:
+        Cn, rmsn = fit_cij(strains, stresses[start:start+len(strains)])
+        start += len(strains)
+        C += [Cn]
+        rms += [rmsn]
+    return np.array(C), np.array(rms)
+
+
+def scan(casfiles, strains=None, command=None, maxjobs=1, nprocs=1,
+         dbfile='elastic.db', verbose=False):
+    """ Whole elastic constant scan: write the strained cells of every
+    composition (unless already written), run them with jobrunner (if a
+    command is given) and fit
+
+    returns as fit_compositions """
+    cellfiles = []
+    for casfile in casfiles:
+        chem = casfile.replace('.castep', '')
+        if os.path.exists(manifest_file(chem)):
+            cellfiles += [strainfile.replace('.castep', '.cell') for
+                          strainfile in read_manifest(casfile)[1]]
+        else:
+            cellfiles += gen_strains(casfile, strains=strains, nprocs=nprocs)
+    if command is not None:
+        import jobrunner
+        runner = jobrunner.jobrunner(dbfile, command=command,
+                                     maxjobs=maxjobs)
+        runner.add(cellfiles)
+        runner.run(verbose=verbose)
+        runner.close()
+    return fit_compositions(casfiles, nprocs=nprocs)
+
+
+##########################################################################
+
+if __name__ == '__main__':
+    """ Run from the command line: elastic.py [options] casfiles """
+    parser = argparse.ArgumentParser(
+        description='Elastic constants of relaxed structures.')
+    parser.add_argument('casfiles', nargs='+', help='relaxed .castep files')
+    parser.add_argument('-c', '--command', default=None,
+                        help='command to run each strained cell with '
+                        '({seed}), otherwise the cells are only written '
+                        'and any completed runs fitted')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of jobs run at once')
+    parser.add_argument('-n', '--nprocs', type=int, default=1,
+                        help='number of processes used to write and read')
+    parser.add_argument('-m', '--magnitudes', type=float, nargs='+',
+                        default=magnitudes_default, help='strain magnitudes')
+    parser.add_argument('-o', '--output', default='elastic_constants.npz',
+                        help='file the elastic constants are saved to')
+    args = parser.parse_args()
+    C, rms = scan(args.casfiles, strains=strain_set(args.magnitudes),
+                  command=args.command, maxjobs=args.jobs,
+                  nprocs=args.nprocs, verbose=True)
+    K, G = vrh(C)
+    np.savez(args.output, casfiles=np.array(args.casfiles), C=C, rms=rms,
+             K=K, G=G)
+    for casfile, Cn, rmsn, Kn, Gn in zip(args.casfiles, C, rms, K, G):
+        print('\n' + casfile + '  (rms {0:.3f} GPa)'.format(rmsn))
+        if np.isnan(Cn).any():
+            print('  incomplete: not every strain has finished')
+            continue
+        for row in Cn:
+            print(''.join(['{0:10.2f}'.format(c) for c in row]))
+        print('  K_VRH = {0:.2f} GPa, G_VRH = {1:.2f} GPa'.format(Kn, Gn))
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+import os
+import copy
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import mixmap
+import readmixcastep as rc
+
+"""
+Module for equations of state (EOS) of solid solutions from pressure (or
+volume) sweeps of each composition, e.g.
+
+casfiles = ['CaSr_0.00.castep', 'CaSr_0.50.castep', 'CaSr_1.00.castep']
+for casfile in casfiles:
+    gen_eos(casfile, pressures=[-5, 0, 5, 10, 15, 20])  # CaSr_0.00_eos_0.cell
+# ... run CASTEP geometry optimisations ...
+results = fit_compositions(casfiles, nprocs=4)
+print(results['V0'], results['B0'])  # arrays indexed by composition
+
+or as one command (generate, run with jobrunner and fit):
+
+python eos.py -j 4 -c 'castep.serial {seed}' -p -5 0 5 10 CaSr_*.castep
+
+Pressure sweeps set external_pressure (GPa) in each .cell file and keep the
+cell constraints of the parent, so the cell relaxes at each pressure. Volume
+sweeps scale the cell isotropically and fix it (cell constraints all zero),
+so only the ions relax. Either way the (internal) energy against volume of
+every composition is fitted to the 3rd order Birch-Murnaghan EOS, which is a
+cubic polynomial in V^(-2/3), so all compositions are fitted in one batched
+least squares solve.
+"""
+
+evang3_to_gpa = 160.21766208
+
+
+def manifest_file(chem):
+    """ returns
+    str filename : manifest of the EOS cells written for chem """
+    return chem + '_eos.json'
+
+
+def gen_eos(casfile, pressures=None, volumes=None, nprocs=1, **cellparams):
+    """ Write the .cell files (chem_eos_n.cell) of a pressure or volume sweep
+    of one composition, and a manifest (chem_eos.json) of the sweep
+
+    str casfile : relaxed .castep (or .cell) file of the composition
+    list pressures : hydrostatic pressures (GPa) of a pressure sweep
+    list volumes : volumes, relative to that of casfile, of a volume sweep
+    int nprocs : number of processes used to write the .cell files
+    cellparams : passed on to mixmap.setcellparams (the k-points, spins, cell
+    constraints and pseudopotentials of casfile are used unless given)
+
+    returns
+    list cellfiles : files written """
+    if (pressures is None) == (volumes is None):
+        raise ValueError('Give either pressures or volumes to sweep over.')
+    if casfile.endswith('.cell'):
+        chem = casfile.replace('.cell', '')
+        cas = rc.readcell(casfile)
+        spins = cas.get_init_spin()
+    else:
+        chem = casfile.replace('.castep', '')
+        cas = rc.readcas(casfile)
+        spins = cas.get_final_spin()
+    mixatoms = cas.extract_struc()
+    mapping = mixmap.mixmap(mixatoms, cas.get_mixkey())
+    kpoints, offset = cas.get_kpoints()
+    constrs = cas.get_cell_constrs()
+    params = {'kpoints': kpoints, 'kpoints_offset': offset, 'spins': spins,
+              'pseudos': cas.get_psps()}
+    if constrs is not None:
+        params['cell_constrs'] = constrs
+    params.update(cellparams)
+
+    cell = np.array(mixatoms.get_cell())
+    sweep = {}
+    if pressures is not None:
+        values = [float(P) for P in pressures]
+        for n, P in enumerate(values):
+            sweep[chem + '_eos_' + str(n) + '.cell'] = ([P]*3 + [0.0]*3,
+                                                        mixatoms)
+    else:
+        values = [float(V) for V in volumes]
+        params['cell_constrs'] = [0]*6
+        for n, V in enumerate(values):
+            atoms = mixatoms.copy()
+            atoms.set_cell(cell*V**(1.0/3), scale_atoms=True)
+            sweep[chem + '_eos_' + str(n) + '.cell'] = ([0.0]*6, atoms)
+
+    # Only the pressure differs between the files of a pressure sweep, so
+    # each gets its own (shallow) copy of the mapping
+    if volumes is not None:
+        mapping.setcellparams(**params)
+        mapping.casprint_many({cellfile: atoms for cellfile, (press, atoms)
+                               in sweep.items()}, nprocs=nprocs)
+    else:
+        jobs = []
+        for cellfile, (press, atoms) in sweep.items():
+            pmapping = copy.copy(mapping)
+            pmapping.setcellparams(pressure=press, **params)
+            jobs += [(pmapping, [(cellfile, atoms)], False)]
+        if nprocs is None or nprocs <= 1:
+            for job in jobs:
+                mixmap.casprint_chunk(job)
+        else:
+            with ProcessPoolExecutor(max_workers=nprocs) as pool:
+                for written in pool.map(mixmap.casprint_chunk, jobs):
+                    pass
+
+    manifest = {'parent': os.path.basename(casfile),
+                'sweep': 'pressure' if pressures is not None else 'volume',
+                'values': values,
+                'cellfiles': [os.path.basename(cellfile)
+                              for cellfile in sweep]}
+    mixmap.atomic_write(json.dumps(manifest, indent=1), manifest_file(chem))
+    return list(sweep.keys())
+
+
+def read_manifest(casfile):
+    """ returns
+    str sweep : 'pressure' or 'volume'
+    np.array(Npoints) values : pressures (GPa) or relative volumes
+    list casfiles : .castep files of the sweep """
+    chem = casfile.replace('.castep', '').replace('.cell', '')
+    manifest = json.load(open(manifest_file(chem), 'r'))
+    folder = os.path.dirname(casfile)
+    casfiles = [os.path.join(folder, cellfile.replace('.cell', '.castep'))
+                for cellfile in manifest['cellfiles']]
+    return manifest['sweep'], np.array(manifest['values']), casfiles
+
+
+def read_point(casfile):
+    """ Worker: returns (volume (Ang^3), energy (eV), enthalpy (eV)) of the
+    final structure of casfile, NaNs if it is missing or not complete (and
+    the enthalpy is NaN for single point calculations) """
+    if not os.path.exists(casfile):
+        return (np.nan, np.nan, np.nan)
+    cas = rc.readcas(casfile)
+    if not cas.check_complete():
+        return (np.nan, np.nan, np.nan)
+    volume = abs(np.linalg.det(cas.get_cell()))
+    energy = cas.get_energy()
+    try:
+        enthalpy = cas.get_enthalpy()
+    except NotImplementedError:
+        enthalpy = np.nan
+    return (volume, energy, enthalpy)
+
+
+def read_points(casfiles, nprocs=1):
+    """ returns
+    np.array(N, 3) points : volume, energy and enthalpy of each casfile """
+    if nprocs is None or nprocs <= 1:
+        points = [read_point(casfile) for casfile in casfiles]
+    else:
+        chunksize = max(1, len(casfiles)//(4*nprocs))
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            points = list(pool.map(read_point, casfiles,
+                                   chunksize=chunksize))
+    return np.array(points, dtype=float).reshape(-1, 3)
+
+
+def birch_murnaghan(volumes, E0, V0, B0, B0p):
+    """ returns
+    np.array energies : 3rd order Birch-Murnaghan energies (eV) at volumes
+    (Ang^3) for B0 in eV/Ang^3 (all arguments broadcast) """
+    eta = (np.asarray(V0)/np.asarray(volumes))**(2.0/3) - 1.0
+    return E0 + 9.0*V0*B0/16.0*(eta**3*B0p + eta**2*(6.0 - 4.0*(eta + 1.0)))
+
+
+def fit_birch_murnaghan(volumes, energies):
+    """ Fit the 3rd order Birch-Murnaghan EOS to one or many compositions at
+    once (points with NaN volume or energy are left out)
+
+    np.array(..., Npoints) volumes : Ang^3
+    np.array(..., Npoints) energies : eV
+
+    returns
+    dict fit : arrays (shaped as volumes without the last axis) of E0 (eV),
+    V0 (Ang^3), B0 (GPa), B0p and rms (eV), NaN where fewer than 4 points
+    are available or the fit has no minimum """
+    volumes = np.asarray(volumes, dtype=float)
+    energies = np.asarray(energies, dtype=float)
+    valid = np.isfinite(volumes) & np.isfinite(energies)
+    x = np.where(valid, np.nan_to_num(volumes, nan=1.0), 1.0)**(-2.0/3)
+
+    # E is a cubic in x = V^(-2/3): batched least squares (missing rows zero)
+    A = x[..., None]**np.arange(4)
+    A = np.where(valid[..., None], A, 0.0)
+    y = np.where(valid, energies, 0.0)
+    c = np.matmul(np.linalg.pinv(A), y[..., None])[..., 0]
+    rms = np.sqrt(np.sum((np.matmul(A, c[..., None])[..., 0] - y)**2,
+                         axis=-1)/np.maximum(np.sum(valid, axis=-1), 1))
+
+    # Minimum: root of p'(x) = c1 + 2c2 x + 3c3 x^2 with p''(x) > 0
+    c0, c1, c2, c3 = np.moveaxis(c, -1, 0)
+    disc = np.sqrt(np.where(4*c2**2 - 12*c1*c3 >= 0, 4*c2**2 - 12*c1*c3,
+                            np.nan))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        roots = np.stack([(-2*c2 + disc)/(6*c3), (-2*c2 - disc)/(6*c3)])
+        curv = 2*c2 + 6*c3*roots
+        x0 = np.where(curv[0] > 0, roots[0], roots[1])
+        x0 = np.where(np.abs(c3) < 1e-12*np.abs(c2), -c1/(2*c2), x0)
+        d2p = 2*c2 + 6*c3*x0
+        V0 = np.where((x0 > 0) & (d2p > 0), x0, np.nan)**(-1.5)
+        E0 = c0 + c1*x0 + c2*x0**2 + c3*x0**3
+
+        # Derivatives of E(V) at V0 (p'(x0) = 0)
+        dx = -2.0/3*V0**(-5.0/3)
+        d2x = 10.0/9*V0**(-8.0/3)
+        E2 = d2p*dx**2
+        E3 = 6*c3*dx**3 + 3*d2p*dx*d2x
+        B0 = V0*E2
+        B0p = -1.0 - V0**2*E3/B0
+    enough = np.sum(valid, axis=-1) >= 4
+    nan = np.where(enough & np.isfinite(V0), 0.0, np.nan)
+    return {'E0': E0 + nan, 'V0': V0 + nan, 'B0': B0*evang3_to_gpa + nan,
+            'B0p': B0p + nan, 'rms': rms + nan}
+
+
+def fit_compositions(casfiles, nprocs=1):
+    """ Read the sweeps of many compositions (from the manifests written by
+    gen_eos) in one parallel pass and fit them all at once
+
+    list casfiles : files that gen_eos was run on (one per composition)
+    int nprocs : number of processes used to read the results
+
+    returns
+    dict results : arrays indexed by composition (first axis), 'values'
+    (pressures or relative volumes), 'volumes', 'energies', 'enthalpies' of
+    every point (NaN if not finished, padded to the longest sweep) and the
+    fitted 'E0', 'V0', 'B0', 'B0p' and 'rms' """
+    manifests = [read_manifest(casfile) for casfile in casfiles]
+    Npoints = max([len(values) for sweep, values, files in manifests])
+    allfiles = [casfile for sweep, values, files in manifests
+                for casfile in files]
+    points = read_points(allfiles, nprocs=nprocs)
+    results = {'values': np.full((len(casfiles), Npoints), np.nan)}
+    data = np.full((len(casfiles), Npoints, 3), np.nan)
+    start = 0
+    for n, (sweep, values, files) in enumerate(manifests):
+        results['values'][n, :len(values)] = values
+        data[n, :len(values)] = points[start:start+len(values)]
+        start += len(values)
+    results['volumes'] = data[:, :, 0]
+    results['energies'] = data[:, :, 1]
+    results['enthalpies'] = data[:, :, 2]
+    results.update(fit_birch_murnaghan(results['volumes'],
+                                       results['energies']))
+    return results
+
+
+def scan(casfiles, pressures=None, volumes=None, command=None, maxjobs=1,
+         nprocs=1, dbfile='eos.db', verbose=False):
+    """ Whole EOS scan: write the sweep of every composition (unless already
+    written), run them with jobrunner (if a command is given) and fit
+
+    returns as fit_compositions """
+    cellfiles = []
+    for casfile in casfiles:
+        chem = casfile.replace('.castep', '').replace('.cell', '')
+        if os.path.exists(manifest_file(chem)):
+            cellfiles += [sweepfile.replace('.castep', '.cell') for
+                          sweepfile in read_manifest(casfile)[2]]
+        else:
+            cellfiles += gen_eos(casfile, pressures=pressures,
+                                 volumes=volumes, nprocs=nprocs)
+    if command is not None:
+        import jobrunner
+        runner = jobrunner.jobrunner(dbfile, command=command,
+                                     maxjobs=maxjobs)
+        runner.add(cellfiles)
+        runner.run(verbose=verbose)
+        runner.close()
+    return fit_compositions(casfiles, nprocs=nprocs)
+
+
+##########################################################################
+
+if __name__ == '__main__':
+    """ Run from the command line: eos.py [options] casfiles """
+    parser = argparse.ArgumentParser(
+        description='Equations of state of relaxed structures.')
+    parser.add_argument('casfiles', nargs='+',
+                        help='relaxed .castep (or .cell) files')
+    parser.add_argument('-p', '--pressures', type=float, nargs='+',
+                        default=None, help='pressures (GPa) to sweep over')
+    parser.add_argument('-v', '--volumes', type=float, nargs='+',
+                        default=None, help='relative volumes to sweep over')
+    parser.add_argument('-c', '--command', default=None,
+                        help='command to run each cell with ({seed}), '
+                        'otherwise the cells are only written and any '
+                        'completed runs fitted')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of jobs run at once')
+    parser.add_argument('-n', '--nprocs', type=int, default=1,
+                        help='number of processes used to write and read')
+    parser.add_argument('-o', '--output', default='eos.npz',
+                        help='file the results are saved to')
+    args = parser.parse_args()
+    if args.pressures is None and args.volumes is None:
+        args.pressures = [-5.0, 0.0, 5.0, 10.0, 15.0, 20.0]
+    results = scan(args.casfiles, pressures=args.pressures,
+                   volumes=args.volumes, command=args.command,
+                   maxjobs=args.jobs, nprocs=args.nprocs, verbose=True)
+    np.savez(args.output, casfiles=np.array(args.casfiles), **results)
+    print('\n{0:40s} {1:>12s} {2:>10s} {3:>9s} {4:>6s}'.format(
+        'composition', 'E0 (eV)', 'V0 (A^3)', 'B0 (GPa)', "B0'"))
+    for n, casfile in enumerate(args.casfiles):
+        print('{0:40s} {1:12.4f} {2:10.3f} {3:9.2f} {4:6.2f}'.format(
+            casfile, results['E0'][n], results['V0'][n], results['B0'][n],
+            results['B0p'][n]))
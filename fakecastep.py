@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import numpy as np
+from ase.data import atomic_numbers, covalent_radii
+import mixmap
+import readmixcastep as rc
+
+"""
+Stand-in for the CASTEP executable, used to test job scripts (e.g. jobrunner)
+without CASTEP. Run as CASTEP would be, from the directory of seed.cell:
+
+python fakecastep.py seed [delay]
+
+A seed.castep file is written that readmixcastep.readcas can parse (cell,
+positions, mixtures, k-points, pressure, energies, forces, stresses and
+populations). The numbers come from a Morse pair potential between the
+(mixture weighted) atoms, plus small k-point and cut-off dependent errors so
+that convergence tests behave sensibly. If seed.param asks for a geometry
+optimisation the cell is scaled isotropically until the internal pressure
+matches the external pressure. The final 'Total time' line (which marks the
+calculation as complete) is only written after delay seconds.
+"""
+
+# Parameters of the stand-in physics
+morse_depth = 0.5  # eV
+morse_alpha = 1.5  # 1/Ang
+morse_cutoff = 7.0  # Ang
+evang3_to_gpa = 160.21766208
+
+
+def morse(r, r0):
+    """ returns
+    tuple (V, dV/dr) : Morse potential (eV) and its derivative (eV/Ang) """
+    e = np.exp(-morse_alpha*(r - r0))
+    return (morse_depth*((1.0 - e)**2 - 1.0),
+            2*morse_depth*morse_alpha*e*(1.0 - e))
+
+
+def model(cell, fracs, elems, wts, kpoints=(5, 5, 1), cutoff=500.0):
+    """ Energy, forces and stress of the stand-in model
+
+    np.array(3, 3) cell : unit cell vectors (Ang)
+    np.array(N, 3) fracs : fractional positions
+    list elems : element of each atom
+    np.array(N) wts : mixture weight of each atom (1.0 if not mixed)
+    list kpoints : MP grid, float cutoff : plane wave cut-off (eV)
+
+    returns
+    float energy : eV
+    np.array(N, 3) forces : eV/Ang (the total force on each site is given to
+    every atom on that site, as CASTEP reports for mixtures)
+    np.array(3, 3) stress : GPa """
+    cell = np.array(cell, dtype=float)
+    posns = np.dot(fracs, cell)
+    N = len(posns)
+    volume = abs(np.linalg.det(cell))
+    radii = np.array([covalent_radii[atomic_numbers[elem]]
+                      for elem in elems])
+
+    # Periodic images within the cut-off
+    heights = volume/np.linalg.norm(np.cross(cell[[1, 2, 0]],
+                                             cell[[2, 0, 1]]), axis=1)
+    nmax = np.ceil(morse_cutoff/heights).astype(int)
+    images = np.array([[i, j, k] for i in range(-nmax[0], nmax[0]+1)
+                       for j in range(-nmax[1], nmax[1]+1)
+                       for k in range(-nmax[2], nmax[2]+1)])
+    shifts = np.dot(images, cell)
+
+    energy = 0.0
+    forces = np.zeros((N, 3))
+    virial = np.zeros((3, 3))
+    site = np.arange(N)
+    for i in range(N):
+        d = posns[None, :, :] + shifts[:, None, :] - posns[i]
+        r = np.linalg.norm(d, axis=2)
+        if i > 0:  # atoms on the same site share a site label
+            same = np.where(r[np.all(images == 0, axis=1)][0][:i] < 0.1)[0]
+            if len(same):
+                site[i] = site[same[0]]
+        mask = (r > 0.1) & (r < morse_cutoff)
+        V, dV = morse(r[mask], (radii[i] + radii)[None, :].repeat(
+            len(images), axis=0)[mask])
+        ww = wts[i]*np.broadcast_to(wts[None, :], r.shape)[mask]
+        energy += 0.5*np.sum(ww*V)
+        dvec = d[mask]*(ww*dV/r[mask])[:, None]
+        forces[i] = np.sum(dvec, axis=0)
+        virial += 0.5*np.dot(dvec.T, d[mask])
+    stress = virial/volume*evang3_to_gpa
+    for s in np.unique(site):
+        forces[site == s] = np.sum(forces[site == s], axis=0)
+
+    # Basis set errors (decay with k-point density and cut-off)
+    kdensity = min([k*np.linalg.norm(a) for k, a in zip(kpoints, cell)])
+    kerr = np.exp(-kdensity/4.0)
+    cerr = np.exp(-cutoff/80.0)
+    Nsites = len(np.unique(site))
+    energy += Nsites*(0.05*kerr*np.cos(kdensity) + 2.0*cerr)
+    forces *= 1.0 + 0.05*kerr
+    stress += np.eye(3)*(0.5*kerr*np.cos(kdensity) - 20.0*cerr)
+    return energy, forces, stress
+
+
+def fmtrow(values, fmt):
+    """ Format a row of numbers with a single format string """
+    return ''.join([fmt.format(v) for v in values])
+
+
+class castext():
+    """ Builder of the text of a synthetic .castep file """
+
+    def __init__(self, elems, mixlabels, wts, task='single', kpoints=(5, 5, 1),
+                 pressure=(0.0,)*6, cell_constrs=(1, 2, 3, 4, 5, 6),
+                 pseudos=None):
+        """
+        list elems : element of each atom
+        list mixlabels : CASTEP mixture label of each atom (0 if not mixed)
+        list wts : mixture weight of each atom
+        str task : 'single', 'geometry' or 'molecular'
+        """
+        self.elems = list(elems)
+        self.mixlabels = list(mixlabels)
+        self.wts = list(wts)
+        self.task = task
+        self.lines = []
+        # CASTEP numbers atoms within each species
+        counts = {}
+        self.numbers = []
+        for elem in self.elems:
+            counts[elem] = counts.get(elem, 0) + 1
+            self.numbers += [counts[elem]]
+        self.header(kpoints, pressure, cell_constrs, pseudos)
+
+    def header(self, kpoints, pressure, cell_constrs, pseudos):
+        """ Parameters written once at the top of the file """
+        tasks = {'single': 'single point energy',
+                 'geometry': 'geometry optimization',
+                 'molecular': 'molecular dynamics'}
+        self.lines += [' Stand-in CASTEP output (fakecastep.py)', '',
+                       ' type of calculation                            : '
+                       + tasks[self.task], '']
+        self.kpoints = kpoints
+        self.pressure = pressure
+        self.cell_constrs = cell_constrs
+        self.pseudos = pseudos
+
+    def structure(self, cell, fracs):
+        """ Unit cell, cell contents and mixtures """
+        cell = np.array(cell)
+        recip = 2*np.pi*np.linalg.inv(cell).T
+        self.lines += ['                           ' + '-'*31,
+                       '                                      Unit Cell',
+                       '                           ' + '-'*31,
+                       '        Real Lattice(A)                      '
+                       'Reciprocal Lattice(1/A)']
+        self.lines += [fmtrow(cell[i], '{0:12.7f}') + '    '
+                       + fmtrow(recip[i], '{0:12.7f}') for i in range(3)]
+        self.lines += ['', '                       Current cell volume = '
+                       + '{0:12.6f}'.format(abs(np.linalg.det(cell)))
+                       + '       A**3', '',
+                       '                         Total number of ions in '
+                       'cell = ' + '{0:4d}'.format(len(self.elems)), '']
+        self.lines += ['            ' + 'x'*60,
+                       '            x  Element    Atom        Fractional '
+                       'coordinates of atoms  x',
+                       '            x            Number           u       '
+                       '   v          w      x',
+                       '            x' + '-'*58 + 'x']
+        self.lines += ['            x  {0:<2s}   {1:9d}   '.format(elem, n)
+                       + fmtrow(f, '{0:11.6f}') + '   x'
+                       for elem, n, f in zip(self.elems, self.numbers, fracs)]
+        self.lines += ['            ' + 'x'*60, '']
+        labels = sorted(set([m for m in self.mixlabels if m > 0]))
+        if labels:
+            self.lines += ['        ' + 'x'*68,
+                           '        x  Mixture   Fractional coordinates of '
+                           'atoms  Components  Weights  x',
+                           '        x   atoms       u          v          w  '
+                           '                          x',
+                           '        x' + '-'*66 + 'x']
+            for m in labels:
+                atoms = [i for i, label in enumerate(self.mixlabels)
+                         if label == m]
+                for k, i in enumerate(atoms):
+                    if k == 0:
+                        self.lines += ['        x {0:4d}     '.format(m)
+                                       + fmtrow(fracs[i], '{0:11.6f}')
+                                       + '   {0:<2s}   {1:14.6f}  x'.format(
+                                           self.elems[i], self.wts[i])]
+                    else:
+                        self.lines += ['        x' + ' '*46
+                                       + ' {0:<2s}   {1:14.6f}  x'.format(
+                                           self.elems[i], self.wts[i])]
+            self.lines += ['        ' + 'x'*68, '']
+
+    def parameters(self):
+        """ Pseudopotentials, k-points, constraints and pressure """
+        if self.pseudos:
+            self.lines += ['                          Files used for '
+                           'pseudopotentials:']
+            self.lines += ['                                    ' + elem + ' '
+                           + psp for elem, psp in self.pseudos.items()]
+            self.lines += ['']
+        self.lines += ['                       MP grid size for SCF '
+                       'calculation is ' + fmtrow(self.kpoints, '{0:3d}'), '',
+                       '                         Cell constraints are: '
+                       + ' '.join([str(c) for c in self.cell_constrs]), '']
+        p = self.pressure
+        self.lines += ['                         External pressure/stress '
+                       '(GPa)',
+                       '                      ' + fmtrow([p[0], p[5], p[4]],
+                                                         '{0:10.5f}'),
+                       '                                ' +
+                       fmtrow([p[1], p[3]], '{0:10.5f}'),
+                       '                                          ' +
+                       fmtrow([p[2]], '{0:10.5f}'), '']
+
+    def results(self, energy, forces, stress):
+        """ Energy, forces and stress of one SCF calculation """
+        self.lines += ['Final energy, E             =  '
+                       + '{0:.8f}'.format(energy) + '     eV', '',
+                       ' ' + '*'*35 + ' Forces ' + '*'*35,
+                       ' *' + ' '*76 + '*',
+                       ' *                        Cartesian components (eV/A)'
+                       '                         *',
+                       ' * ' + '-'*74 + ' *',
+                       ' *                   x                    y         '
+                       '           z              *',
+                       ' *' + ' '*76 + '*']
+        for elem, n, m, f in zip(self.elems, self.numbers, self.mixlabels,
+                                 forces):
+            mixed = ' (mixed)' if m > 0 else '        '
+            self.lines += [' * {0:<2s} {1:8d} '.format(elem, n)
+                           + ''.join(['{0:13.5f}'.format(x) + mixed
+                                      for x in f]) + ' *']
+        self.lines += [' *' + ' '*76 + '*', ' ' + '*'*78, '',
+                       ' ' + '*'*17 + ' Stress Tensor ' + '*'*17,
+                       ' *' + ' '*47 + '*',
+                       ' *          Cartesian components (GPa)           *',
+                       ' * ' + '-'*45 + ' *',
+                       ' *             x             y             z     *',
+                       ' *' + ' '*47 + '*']
+        self.lines += [' *  ' + 'xyz'[i] + ' ' + fmtrow(stress[i],
+                                                        '{0:14.6f}') + '  *'
+                       for i in range(3)]
+        self.lines += [' *' + ' '*47 + '*',
+                       ' *  Pressure: ' + '{0:10.4f}'.format(
+                           -np.trace(stress)/3) + ' '*24 + '*',
+                       ' *' + ' '*47 + '*', ' ' + '*'*49, '']
+
+    def iteration(self, n, enthalpy):
+        """ End of a geometry optimisation iteration """
+        self.lines += [' BFGS: finished iteration {0:5d} with enthalpy= '
+                       '{1:.8E} eV'.format(n, enthalpy), '']
+
+    def mdstep(self, n, time, potential, kinetic, temperature):
+        """ End of a molecular dynamics step """
+        self.lines += [' ' + 'x'*62,
+                       ' x            MD Data:' + ' '*40 + 'x',
+                       ' x            time            :   {0:14.6f}        '
+                       '    ps   x'.format(time),
+                       ' x            Potential Energy:   {0:14.6f}        '
+                       '    eV   x'.format(potential),
+                       ' x            Kinetic   Energy:   {0:14.6f}        '
+                       '    eV   x'.format(kinetic),
+                       ' x            Temperature     :   {0:14.6f}        '
+                       '     K   x'.format(temperature),
+                       ' ' + 'x'*62,
+                       ' ' + '=' * 62,
+                       ' Starting MD iteration {0:10d} ...'.format(n + 1), '']
+
+    def populations(self):
+        """ Mulliken populations (no spins) """
+        self.lines += ['     Atomic Populations (Mulliken)',
+                       '     -----------------------------',
+                       'Species   Ion     s      p      d      f     Total  '
+                       'Charge (e)', '=' * 62]
+        self.lines += ['  {0:<2s} {1:8d}     0.00   0.00   0.00   0.00   '
+                       '0.00     0.00'.format(elem, n)
+                       for elem, n in zip(self.elems, self.numbers)]
+        self.lines += ['=' * 62, '']
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def read_param(paramfile):
+    """ returns
+    dict params : keyword: value pairs of a CASTEP .param file (lower case)
+    """
+    params = {}
+    if os.path.exists(paramfile):
+        for line in open(paramfile, 'r'):
+            line = line.split('!')[0].split('#')[0]
+            for sep in [':', '=']:
+                if sep in line:
+                    key, value = line.split(sep, 1)
+                    params[key.strip().lower()] = value.strip().lower()
+                    break
+    return params
+
+
+def run(seed, delay=0.0, maxiter=8, ptol=0.01):
+    """ Write seed.castep for seed.cell (and seed.param if it exists)
+
+    str seed : path of the calculation without extension
+    float delay : seconds to wait before the calculation is marked complete
+    int maxiter : maximum geometry optimisation iterations
+    float ptol : pressure tolerance (GPa) of the geometry optimisation """
+    start = time.time()
+    params = read_param(seed + '.param')
+    task = params.get('task', 'singlepoint').replace('_', '')
+    task = 'geometry' if task.startswith('geometry') else 'single'
+    cutoff = float(params.get('cut_off_energy', '500').split()[0])
+
+    cas = rc.readcell(seed + '.cell')
+    atoms = cas.extract_struc()
+    elems = atoms.get_chemical_symbols()
+    fracs = atoms.get_scaled_positions()
+    cell = np.array(atoms.get_cell())
+    mapping = mixmap.mixmap(atoms, cas.get_mixkey())
+    mixlabels = [mapping.mixsitemixes[i][0] for i in range(len(elems))]
+    wts = np.array([mapping.mixsitemixes[i][1] for i in range(len(elems))])
+    kpoints, offset = cas.get_kpoints()
+    pressure = cas.get_ext_press()
+    constrs = cas.get_cell_constrs()
+
+    out = castext(elems, mixlabels, wts, task=task, kpoints=kpoints,
+                  pressure=pressure, cell_constrs=constrs,
+                  pseudos=cas.get_psps())
+    out.structure(cell, fracs)
+    out.parameters()
+    target = np.mean(pressure[:3])
+    for n in range(maxiter if task == 'geometry' else 1):
+        if n > 0:
+            out.structure(cell, fracs)
+        energy, forces, stress = model(cell, fracs, elems, wts,
+                                       kpoints=kpoints, cutoff=cutoff)
+        out.results(energy, forces, stress)
+        if task == 'single':
+            break
+        volume = abs(np.linalg.det(cell))
+        enthalpy = energy + target*volume/evang3_to_gpa
+        out.iteration(n, enthalpy)
+        internal = -np.trace(stress)/3
+        if abs(internal - target) < ptol or not any(constrs):
+            break
+        # Isotropic step towards the target pressure (bulk modulus estimate)
+        step = 1e-3
+        e2, f2, s2 = model(cell*(1 + step), fracs, elems, wts,
+                           kpoints=kpoints, cutoff=cutoff)
+        bulk = -(-np.trace(s2)/3 - internal)/(3*step)
+        scale = 1 + (internal - target)/(3*bulk) if bulk > 0 else 1.01
+        cell = cell*min(max(scale, 0.9), 1.1)
+    if task == 'geometry':
+        out.lines += [' BFGS: Final Enthalpy     = '
+                      '{0:.8E} eV'.format(enthalpy), '']
+    out.populations()
+    text = out.text()
+
+    # Write everything but the completion line, then finish after delay
+    casfile = seed + '.castep'
+    with open(casfile, 'w') as f:
+        f.write(text)
+        f.flush()
+        if delay:
+            time.sleep(delay)
+        f.write('Total time          = {0:9.2f} s\n'.format(
+            time.time() - start))
+
+
+##########################################################################
+
+if __name__ == '__main__':
+    """ Run from the command line (as CASTEP): fakecastep.py seed [delay] """
+    seed = sys.argv[1].replace('.cell', '')
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    run(seed, delay=delay)
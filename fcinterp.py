@@ -0,0 +1,281 @@
+import numpy as np
+import ase
+from ase.data import atomic_masses, atomic_numbers
+import phonopy
+import mixmap
+import phonons_VCA as pVCA
+from vegard import matchorder, siteweights
+
+"""
+Module to interpolate force constants between solid solution compositions of
+the same parent structure, from force constants saved by phonons_VCA (with
+calc_phonons(..., fcfile=...) or cache=True), e.g.
+
+fi = fcinterp(['CaSr_0.00_phonons.npz', 'CaSr_0.50_phonons.npz',
+               'CaSr_1.00_phonons.npz'])
+phonons = fi.predict({'Ca': {'Ca': 0.75, 'Sr': 0.25},
+                      'Ge': {'Ge': 1.0}, 'O': {'O': 1.0}})
+freqs, eigvecs = phonons.frequencies([[0.0, 0.0, 0.0]])
+print(fi.errors())  # leave-one-out error of each composition
+
+Force constant blocks between two atoms are fitted per pair of (pure)
+elements, as linear or quadratic functions of the mixture weights on the
+sublattices (all of them, or with local=True only the pair's own two). Masses
+of each site are averaged over the mixture weights (as mixmap.puremasses) and
+the cell and positions are fitted as in vegard.
+"""
+
+
+def fcweights(phonons):
+    """ returns
+    list sitewts : {elem: wt} mixture of each pure site of a saved fcset """
+    if not hasattr(phonons, 'mixelems'):
+        raise ValueError('Force constants were saved without a mixmap, so '
+                         + 'their composition is unknown.')
+    sitewts = [{} for i in range(len(phonons.masses))]
+    for elem, p, wt in zip(phonons.mixelems, phonons.mixpure,
+                           phonons.mixwts):
+        sitewts[p][elem] = float(wt)
+    return sitewts
+
+
+def sitemasses(sitewts):
+    """ returns
+    np.array(Nsites) masses : mixture weighted masses (as mixmap.puremasses)
+    """
+    return np.array([sum([wt*atomic_masses[atomic_numbers[elem]]
+                          for elem, wt in wts.items()]) for wts in sitewts])
+
+
+class fcinterp():
+    """ Class to fit and predict force constants as a function of
+    composition """
+
+    def __init__(self, fcfiles, deg=1, local=False):
+        """
+        list fcfiles : saved force constants (.npz) of the same parent
+        structure (and supercell) at different compositions
+        int deg : 1 (linear) or 2 (quadratic) in the sublattice weights
+        bool local : if True the blocks of each element pair depend only on
+        the weights of those two sublattices, otherwise on all sublattices
+        (so that changes with the lattice parameter are also captured)
+        """
+        if deg not in [1, 2]:
+            raise ValueError('deg must be 1 (linear) or 2 (quadratic).')
+        self.deg = deg
+        self.local = local
+        self.fcfiles = list(fcfiles)
+        sets = [pVCA.load_phonons(fcfile) for fcfile in self.fcfiles]
+
+        # The first set gives the atom order and supercell for all others
+        ref = sets[0]
+        self.ref = ref
+        self.refelems = ref.pureatoms.get_chemical_symbols()
+        self.reffracs = ref.pureatoms.get_scaled_positions()
+        self.superelems = ref.phonopy().supercell.get_chemical_symbols()
+        self.elems = sorted(set(self.refelems))
+        self.species = sorted(set([elem for phonons in sets
+                                   for wts in fcweights(phonons)
+                                   for elem in wts]))
+        gamma = len(self.superelems) == len(self.refelems)
+        cells, fracs, fcs, subs, masses = [], [], [], [], []
+        for phonons in sets:
+            if not np.array_equal(phonons.supercell, ref.supercell):
+                raise ValueError('All force constants must use the same '
+                                 + 'supercell.')
+            cell = np.array(phonons.pureatoms.get_cell())
+            order = matchorder(self.reffracs,
+                               phonons.pureatoms.get_scaled_positions(), cell)
+            fc = phonons.force_constants
+            if any(order != np.arange(len(order))):
+                if not gamma:
+                    raise ValueError('Atoms of supercell force constants '
+                                     + 'must be in the same order.')
+                fc = fc[order][:, order]
+            diff = phonons.pureatoms.get_scaled_positions()[order] - \
+                self.reffracs
+            cells += [cell]
+            fracs += [self.reffracs + diff - np.round(diff)]
+            fcs += [fc]
+            sitewts = fcweights(phonons)
+            sitewts = [sitewts[i] for i in order]
+            subs += [self.sublattices(sitewts)]
+            masses += [sitemasses(sitewts)]
+        self.cells = np.array(cells)
+        self.fracs = np.array(fracs)
+        self.fcs = np.array(fcs)  # (Nsets, Nsuper, Nsuper, 3, 3)
+        self.subs = np.array(subs)  # (Nsets, Nelems, Nspecies)
+        self.masses = np.array(masses)
+
+        # Blocks of the force constants for each pair of elements (the full
+        # supercell force constants are saved, so rows and columns are both
+        # supercell atoms)
+        elemidx = {elem: e for e, elem in enumerate(self.elems)}
+        cols = np.array([elemidx[elem] for elem in self.superelems])
+        rows = cols
+        self.pairs = {}
+        for a in range(len(self.elems)):
+            for b in range(len(self.elems)):
+                mask = (rows[:, None] == a) & (cols[None, :] == b)
+                if mask.any():
+                    self.pairs[(a, b)] = mask
+        self.model = self.fit()
+
+    def sublattices(self, sitewts):
+        """ returns
+        np.array(Nelems, Nspecies) subs : mean weights on the sites of each
+        pure element (its sublattice) """
+        subs = np.zeros((len(self.elems), len(self.species)))
+        counts = np.zeros(len(self.elems))
+        for pureelem, wts in zip(self.refelems, sitewts):
+            e = self.elems.index(pureelem)
+            counts[e] += 1
+            for elem, wt in wts.items():
+                if elem not in self.species:
+                    raise KeyError('Element ' + elem + ' does not appear in '
+                                   + 'any of the fitted compositions.')
+                subs[e, self.species.index(elem)] += wt
+        return subs/counts[:, None]
+
+    def variables(self, subs, use, lattices):
+        """ Columns of the sublattice weights that vary over the fitted sets
+        np.array(Nsets, Nelems, Nspecies) subs : sublattice weights
+        np.array(int) use : sets the fit is made to
+        list lattices : sublattices (element indices) included """
+        x = subs[:, lattices, :].reshape(len(subs), -1)
+        varies = np.where(np.ptp(x[use], axis=0) > 1e-8)[0]
+        unique, index = np.unique(x[use][:, varies], axis=1,
+                                  return_index=True)
+        return varies[np.sort(index)]
+
+    def design(self, subs, lattices, cols):
+        """ Design matrix (polynomial features of the varying weights) """
+        x = subs[:, lattices, :].reshape(len(subs), -1)[:, cols]
+        feats = [np.ones(len(x))] + [x[:, i] for i in range(x.shape[1])]
+        if self.deg == 2:
+            for i in range(x.shape[1]):
+                for j in range(i, x.shape[1]):
+                    feats += [x[:, i]*x[:, j]]
+        return np.array(feats).T
+
+    def fit(self, use=None):
+        """ Least squares fits of the structure and of the force constant
+        blocks of every element pair (each a single solve with many right
+        hand sides)
+
+        np.array(int) use : sets to fit to (default all)
+
+        returns
+        dict model : {key: (lattices, cols, coeffs)} for 'structure' and each
+        element pair """
+        if use is None:
+            use = np.arange(len(self.fcs))
+        model = {}
+        lattices = list(range(len(self.elems)))
+        y = np.concatenate([self.cells.reshape(len(self.cells), -1),
+                            self.fracs.reshape(len(self.fracs), -1)], axis=1)
+        cols = self.variables(self.subs, use, lattices)
+        A = self.design(self.subs[use], lattices, cols)
+        model['structure'] = (lattices, cols,
+                              np.linalg.lstsq(A, y[use], rcond=None)[0])
+        for (a, b), mask in self.pairs.items():
+            if self.local:
+                lattices = sorted(set([a, b]))
+            cols = self.variables(self.subs, use, lattices)
+            A = self.design(self.subs[use], lattices, cols)
+            y = self.fcs[use][:, mask].reshape(len(use), -1)
+            model[(a, b)] = (lattices, cols,
+                             np.linalg.lstsq(A, y, rcond=None)[0])
+        return model
+
+    def predict_subs(self, subs, masses, model=None):
+        """ Predicted force constants for sublattice weights
+        np.array(Nelems, Nspecies) subs : sublattice weights
+        np.array(Natoms) masses : mass of each site
+
+        returns
+        phonons_VCA.fcset phonons : predicted force constants """
+        if model is None:
+            model = self.model
+        subs = subs[None, :, :]
+        lattices, cols, coeffs = model['structure']
+        y = np.dot(self.design(subs, lattices, cols), coeffs)[0]
+        cell = y[:9].reshape(3, 3)
+        fracs = y[9:].reshape(-1, 3) % 1.0
+        fc = np.zeros(self.fcs.shape[1:])
+        for (a, b), mask in self.pairs.items():
+            lattices, cols, coeffs = model[(a, b)]
+            y = np.dot(self.design(subs, lattices, cols), coeffs)[0]
+            fc[mask] = y.reshape(-1, 3, 3)
+        phonopy.harmonic.force_constants.set_translational_invariance(fc)
+        data = {'force_constants': fc, 'cell': cell,
+                'positions': np.dot(fracs, cell),
+                'symbols': np.array(self.refelems), 'masses': masses,
+                'supercell': self.ref.supercell,
+                'factor': self.ref.data['factor']}
+        return pVCA.fcset(data=data)
+
+    def predict(self, mixkey):
+        """ Predict the force constants of a new composition
+
+        dict/MixKey mixkey : mixkey (site or elem format) of the composition
+        for the reference (first) structure
+
+        returns
+        phonons_VCA.fcset phonons : predicted force constants, masses and
+        structure (frequencies, eigenvectors and thermal properties may be
+        computed with its methods) """
+        refatoms = ase.Atoms(symbols=self.refelems,
+                             scaled_positions=self.reffracs,
+                             cell=self.cells[0], pbc=True)
+        mixatoms = mixmap.create_mixture(refatoms, mixkey)
+        mapping = mixmap.mixmap(mixatoms, mixkey)
+        purefracs = mapping.mix2pure(mixatoms).get_scaled_positions()
+        order = matchorder(self.reffracs, purefracs, self.cells[0])
+        sitewts = siteweights(mapping)
+        sitewts = [sitewts[i] for i in order]
+        return self.predict_subs(self.sublattices(sitewts),
+                                 sitemasses(sitewts))
+
+    def errors(self, qpoints=None, fcfiles=None):
+        """ RMS frequency errors (cm-1) of predictions against computed force
+        constants. Without fcfiles each fitted composition is left out of the
+        fit in turn (leave-one-out), otherwise the model is tested against
+        the held-out fcfiles.
+
+        np.array(Nq, 3) qpoints : q-points to compare at (default Gamma)
+        list fcfiles : held-out saved force constants
+
+        returns
+        np.array(Nsets) rms : error for each held-out composition """
+        if qpoints is None:
+            qpoints = [[0.0, 0.0, 0.0]]
+        rms = []
+        if fcfiles is None:
+            for k in range(len(self.fcs)):
+                use = np.array([i for i in range(len(self.fcs)) if i != k])
+                predicted = self.predict_subs(self.subs[k], self.masses[k],
+                                              model=self.fit(use=use))
+                computed = pVCA.load_phonons(self.fcfiles[k])
+                rms += [self.rmsdiff(predicted, computed, qpoints)]
+        else:
+            for fcfile in fcfiles:
+                computed = pVCA.load_phonons(fcfile)
+                cell = np.array(computed.pureatoms.get_cell())
+                order = matchorder(self.reffracs,
+                                   computed.pureatoms.get_scaled_positions(),
+                                   cell)
+                sitewts = fcweights(computed)
+                sitewts = [sitewts[i] for i in order]
+                predicted = self.predict_subs(self.sublattices(sitewts),
+                                              sitemasses(sitewts))
+                rms += [self.rmsdiff(predicted, computed, qpoints)]
+        return np.array(rms)
+
+    @staticmethod
+    def rmsdiff(predicted, computed, qpoints):
+        """ returns
+        float rms : RMS difference of the frequencies (cm-1) of two fcsets """
+        diff = predicted.frequencies(qpoints, eigvecs=False) - \
+            computed.frequencies(qpoints, eigvecs=False)
+        return float(np.sqrt(np.mean(diff**2)))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import shlex
+import sqlite3
+import argparse
+import subprocess
+import strindices as stri
+
+"""
+Module to run CASTEP (or a stand-in) over many .cell files on the local
+machine, e.g. the displacements written by phonons_VCA.gen_perturbations or
+a composition sweep written by compsweep:
+
+runner = jobrunner('jobs.db', command='castep.serial {seed}', maxjobs=4)
+runner.add(glob.glob('Ca1.5Sr0.5GeO4_*.cell'))
+runner.run(verbose=True)
+
+The state of every job is kept in a small sqlite database, so an interrupted
+run resumes where it stopped when run again. Jobs whose .castep output is
+already complete (readcas.check_complete) are never run. The command is run
+in the directory of each .cell file with {seed} replaced by its seed name
+(and {cellfile} by its full path). standin_command() gives the command for
+fakecastep.py, which writes synthetic .castep files for testing.
+"""
+
+states = ['pending', 'running', 'done', 'failed']
+
+
+def standin_command(delay=0.0):
+    """ returns
+    str command : runs fakecastep.py (taking delay seconds per job) """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'fakecastep.py')
+    return ' '.join([shlex.quote(sys.executable), shlex.quote(script),
+                     '{seed}', str(delay)])
+
+
+def castep_complete(casfile):
+    """ returns
+    bool complete : True if casfile exists and its calculation completed """
+    if not os.path.exists(casfile):
+        return False
+    # The final timing line (as readcas.check_complete), so output that is
+    # only partly written is never parsed
+    lines = open(casfile, 'r').readlines()
+    return len(stri.strindices(lines, 'Total time          =')) > 0
+
+
+class jobrunner():
+    """ Class to run CASTEP jobs with bounded concurrency and resume """
+
+    def __init__(self, dbfile='castepjobs.db', command='castep.serial {seed}',
+                 maxjobs=1, poll=0.2):
+        """
+        str dbfile : sqlite database of job states (created if needed)
+        str command : command run for each job ({seed}, {cellfile} replaced)
+        int maxjobs : maximum number of jobs run at once
+        float poll : seconds between checks on running jobs
+        """
+        self.dbfile = dbfile
+        self.command = command
+        self.maxjobs = max(1, int(maxjobs))
+        self.poll = poll
+        self.db = sqlite3.connect(dbfile)
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                        'cellfile TEXT PRIMARY KEY, state TEXT, '
+                        'attempts INTEGER, returncode INTEGER, '
+                        'started REAL, finished REAL)')
+        self.db.commit()
+
+    def add(self, cellfiles):
+        """ Add .cell files as pending jobs (those already known are kept)
+        returns
+        int added : number of new jobs """
+        before = self.count()
+        self.db.executemany('INSERT OR IGNORE INTO jobs VALUES '
+                            '(?, \'pending\', 0, NULL, NULL, NULL)',
+                            [(os.path.abspath(cellfile),)
+                             for cellfile in cellfiles])
+        self.db.commit()
+        return self.count() - before
+
+    def count(self, state=None):
+        """ returns
+        int N : number of jobs (in state) """
+        if state is None:
+            return self.db.execute('SELECT COUNT(*) FROM jobs').fetchone()[0]
+        return self.db.execute('SELECT COUNT(*) FROM jobs WHERE state=?',
+                               (state,)).fetchone()[0]
+
+    def jobs(self, state=None):
+        """ returns
+        list cellfiles : .cell files of all jobs (in state) """
+        if state is None:
+            rows = self.db.execute('SELECT cellfile FROM jobs ORDER BY rowid')
+        else:
+            rows = self.db.execute('SELECT cellfile FROM jobs WHERE state=? '
+                                   'ORDER BY rowid', (state,))
+        return [row[0] for row in rows]
+
+    def status(self):
+        """ returns
+        dict counts : {state: number of jobs} """
+        return {state: self.count(state) for state in states}
+
+    def setstate(self, cellfile, state, **fields):
+        """ Record the state (and any other fields) of a job """
+        names = ['state'] + list(fields.keys())
+        self.db.execute('UPDATE jobs SET ' + ', '.join([name + '=?' for name
+                                                         in names])
+                        + ' WHERE cellfile=?',
+                        [state] + list(fields.values()) + [cellfile])
+        self.db.commit()
+
+    def refresh(self, retry=False):
+        """ Mark jobs with complete output as done and jobs left running by
+        an interrupted run as pending (and failed jobs if retry) """
+        for cellfile in self.jobs():
+            state = self.db.execute('SELECT state FROM jobs WHERE cellfile=?',
+                                    (cellfile,)).fetchone()[0]
+            if state == 'done':
+                continue
+            if castep_complete(cellfile.replace('.cell', '.castep')):
+                self.setstate(cellfile, 'done')
+            elif state == 'running' or (state == 'failed' and retry):
+                self.setstate(cellfile, 'pending')
+
+    def launch(self, cellfile):
+        """ returns
+        subprocess.Popen process : the command started for cellfile """
+        folder, name = os.path.split(cellfile)
+        command = self.command.format(seed=name.replace('.cell', ''),
+                                      cellfile=cellfile)
+        attempts = self.db.execute('SELECT attempts FROM jobs WHERE '
+                                   'cellfile=?', (cellfile,)).fetchone()[0]
+        self.setstate(cellfile, 'running', attempts=attempts+1,
+                      started=time.time())
+        return subprocess.Popen(shlex.split(command), cwd=folder or None,
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+
+    def run(self, retry=False, verbose=False):
+        """ Run all pending jobs (at most maxjobs at once)
+
+        bool retry : also re-run jobs that failed previously
+        bool verbose : report each job as it finishes
+
+        returns
+        dict counts : {state: number of jobs} once all jobs have finished """
+        self.refresh(retry=retry)
+        pending = self.jobs('pending')
+        running = {}
+        Njobs = len(pending)
+        finished = 0
+        try:
+            while pending or running:
+                while pending and len(running) < self.maxjobs:
+                    cellfile = pending.pop(0)
+                    running[cellfile] = self.launch(cellfile)
+                time.sleep(self.poll if running else 0)
+                for cellfile, process in list(running.items()):
+                    if process.poll() is None:
+                        continue
+                    del running[cellfile]
+                    complete = castep_complete(cellfile.replace('.cell',
+                                                                '.castep'))
+                    state = 'done' if complete else 'failed'
+                    self.setstate(cellfile, state,
+                                  returncode=process.returncode,
+                                  finished=time.time())
+                    finished += 1
+                    if verbose:
+                        print(state + ' ' + str(finished) + '/' + str(Njobs)
+                              + ' ' + cellfile, flush=True)
+        except KeyboardInterrupt:
+            # Stop running jobs, they are run again on resume
+            for cellfile, process in running.items():
+                process.terminate()
+                process.wait()
+                self.setstate(cellfile, 'pending')
+            raise
+        return self.status()
+
+    def close(self):
+        self.db.close()
+
+
+##########################################################################
+
+if __name__ == '__main__':
+    """ Run from the command line: jobrunner.py [options] cellfiles """
+    parser = argparse.ArgumentParser(description='Run CASTEP jobs locally.')
+    parser.add_argument('cellfiles', nargs='*', help='.cell files to run')
+    parser.add_argument('-d', '--db', default='castepjobs.db',
+                        help='job database (default castepjobs.db)')
+    parser.add_argument('-c', '--command', default='castep.serial {seed}',
+                        help='command for each job ({seed}, {cellfile})')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of jobs run at once')
+    parser.add_argument('--standin', type=float, default=None,
+                        metavar='DELAY', help='run fakecastep.py instead '
+                        'of CASTEP (taking DELAY seconds per job)')
+    parser.add_argument('--retry', action='store_true',
+                        help='re-run failed jobs')
+    args = parser.parse_args()
+    command = args.command
+    if args.standin is not None:
+        command = standin_command(args.standin)
+    runner = jobrunner(args.db, command=command, maxjobs=args.jobs)
+    runner.add(args.cellfiles)
+    start = time.time()
+    counts = runner.run(retry=args.retry, verbose=True)
+    print(' '.join([state + '=' + str(N) for state, N in counts.items()])
+          + ' in {0:.1f} s'.format(time.time() - start))
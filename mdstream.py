@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import numpy as np
+from ase import Atoms
+import mixmap
+import readmixcastep as rc
+
+"""
+Module to stream CASTEP molecular dynamics trajectories (the seed.md file) in
+chunks of steps, without ever holding the whole trajectory in memory, e.g.
+
+md = readmd('run.md', chunksize=1000)
+for chunk in md:
+    chunk['positions']  # np.array(steps, Nions, 3) in Ang
+    chunk['temperature']  # np.array(steps) in K
+
+mapping = md_mapping('run.md', 'run.cell')  # mixed -> pure sites
+for chunk in readmd('run.md', mapping=mapping):
+    chunk['forces']  # np.array(steps, Npure, 3) one row per site
+
+arrays = readmd('run.md').to_memmap('run_md')  # run_md/positions.npy etc.
+
+Each chunk holds the 'step' index, 'time' (ps), 'total', 'hamiltonian',
+'kinetic' and 'potential' energies (eV), 'temperature' (K), 'pressure' (GPa),
+'cell' and 'stress' (steps, 3, 3) (Ang, GPa), and 'positions' (Ang),
+'velocities' (Ang/ps) and 'forces' (eV/Ang) (steps, Nions, 3). The atoms of a
+VCA mixture are listed separately in the .md file (with the same position,
+velocity and site force), so with a mixmap the arrays are reduced to one row
+per pure site. The .castep of an MD run (task 'molecular') may be read with
+readmixcastep.readcas for its initial structure, mixkey and parameters.
+"""
+
+# Atomic units of CASTEP .md files (CODATA 2018)
+hartree = 27.211386245988  # eV
+bohr = 0.529177210903  # Ang
+au_time = 2.4188843265857e-5  # ps
+kB = 3.166811563455e-6  # Hartree/K
+au_pressure = 29421.02648438959  # GPa (Hartree/Bohr^3)
+
+# Arrays of atoms ('<-- R' etc. in the file) and their units
+atomtags = {'R': 'positions', 'V': 'velocities', 'F': 'forces'}
+units = {'positions': bohr, 'velocities': bohr/au_time,
+         'forces': hartree/bohr, 'cell': bohr, 'stress': au_pressure}
+
+
+def pure_order(mapping):
+    """ returns
+    np.array(Npure) order : index of the mix atom giving the position,
+    velocity and (site) force of each pure site of a mixmap """
+    order = np.zeros(mapping.pureions, dtype=int)
+    for i, p in mapping.mix2pure_map.items():
+        order[p] = i
+    return order
+
+
+class readmd():
+    """ Class for streaming CASTEP .md files in chunks of steps """
+
+    def __init__(self, mdfile, chunksize=1000, mapping=None):
+        """
+        str mdfile : path to .md file
+        int chunksize : number of steps in each chunk
+        mixmap.mixmap mapping : if given the atom arrays are of the pure
+        structure (see md_mapping)
+        """
+        self.mdfile = mdfile
+        self.chunksize = chunksize
+        self.mapping = mapping
+        self.order = None if mapping is None else pure_order(mapping)
+        first = next(self.frames(), None)
+        if first is None:
+            raise ValueError('No MD steps found in ' + mdfile)
+        tokens = ' '.join(first['R']).split()
+        self.elems = tokens[0::5]
+        self.Nions = len(self.elems)
+
+    def frames(self):
+        """ Generator of the raw data of each step (one pass over the file)
+
+        yields
+        dict frame : 'time', 'E', 'T', 'P' values, 'h' and 'S' rows and 'R',
+        'V', 'F' lines (without the tags) """
+        frame = None
+        inheader = False
+        with open(self.mdfile, 'r') as f:
+            for line in f:
+                if '<--' in line and frame is not None:
+                    data, tag = line.split('<--')
+                    tag = tag.strip()
+                    if tag in frame:
+                        frame[tag] += [data]
+                    else:
+                        frame[tag] = [data]
+                    continue
+                words = line.split()
+                if not words or inheader:
+                    if words and words[0] == 'END':
+                        inheader = False
+                    continue
+                if words[0] == 'BEGIN':
+                    inheader = True
+                elif len(words) == 1:  # The time starts each step
+                    if frame is not None and 'R' in frame:
+                        yield frame
+                    frame = {'time': float(words[0])}
+        if frame is not None and 'R' in frame:
+            yield frame
+
+    def build(self, frames, step0):
+        """ returns
+        dict chunk : arrays of a list of frames (in eV, Ang, ps, K, GPa) """
+        Nsteps = len(frames)
+        chunk = {'step': np.arange(step0, step0 + Nsteps)}
+        chunk['time'] = np.array([fr['time'] for fr in frames])*au_time
+        energies = np.array([[float(e) for e in fr['E'][0].split()[:3]]
+                             for fr in frames])*hartree
+        # '<-- E' holds the potential energy, the conserved quantity
+        # (hamiltonian, including any thermostat/barostat) and kinetic energy
+        chunk['potential'] = energies[:, 0]
+        chunk['hamiltonian'] = energies[:, 1]
+        chunk['kinetic'] = energies[:, 2]
+        chunk['total'] = energies[:, 0] + energies[:, 2]
+        chunk['temperature'] = np.array([float(fr['T'][0].split()[0])
+                                         for fr in frames])/kB
+        chunk['pressure'] = np.array([float(fr['P'][0].split()[0])
+                                      if 'P' in fr else np.nan
+                                      for fr in frames])*au_pressure
+        for tag, key in [('h', 'cell'), ('S', 'stress')]:
+            if all([tag in fr for fr in frames]):
+                chunk[key] = np.array(' '.join(
+                    [' '.join(fr[tag]) for fr in frames]).split(),
+                    dtype=float).reshape(Nsteps, 3, 3)*units[key]
+        for tag, key in atomtags.items():
+            if not all([tag in fr for fr in frames]):
+                continue
+            lines = [line for fr in frames for line in fr[tag]]
+            if len(lines) != Nsteps*self.Nions:
+                raise ValueError('Steps ' + str(step0) + ' to '
+                                 + str(step0 + Nsteps - 1) + ' of '
+                                 + self.mdfile + ' do not all have '
+                                 + str(self.Nions) + ' ions.')
+            values = np.array(' '.join(lines).split()).reshape(
+                Nsteps, self.Nions, 5)[:, :, 2:].astype(float)*units[key]
+            if self.order is not None:
+                values = values[:, self.order, :]
+            chunk[key] = values
+        return chunk
+
+    def __iter__(self):
+        """ yields
+        dict chunk : arrays of up to chunksize consecutive steps """
+        frames = []
+        step0 = 0
+        for frame in self.frames():
+            frames += [frame]
+            if len(frames) == self.chunksize:
+                yield self.build(frames, step0)
+                step0 += len(frames)
+                frames = []
+        if frames:
+            yield self.build(frames, step0)
+
+    def count_steps(self):
+        """ returns
+        int Nsteps : number of steps in the file (a quick pass) """
+        Nsteps = 0
+        with open(self.mdfile, 'r') as f:
+            for line in f:
+                if '<-- E' in line:
+                    Nsteps += 1
+        return Nsteps
+
+    def to_memmap(self, folder):
+        """ Write every array of the trajectory to folder/key.npy (memory
+        mapped, one chunk at a time)
+
+        returns
+        dict arrays : {key: np.memmap} opened read only """
+        os.makedirs(folder, exist_ok=True)
+        Nsteps = self.count_steps()
+        arrays = {}
+        n = 0
+        for chunk in self:
+            for key, values in chunk.items():
+                if key not in arrays:
+                    arrays[key] = np.lib.format.open_memmap(
+                        os.path.join(folder, key + '.npy'), mode='w+',
+                        dtype=values.dtype,
+                        shape=(Nsteps,) + values.shape[1:])
+                arrays[key][n:n+len(values)] = values
+            n += len(chunk['step'])
+        for key in list(arrays):
+            arrays[key].flush()
+            del arrays[key]
+            arrays[key] = np.load(os.path.join(folder, key + '.npy'),
+                                  mmap_mode='r')
+        return arrays
+
+
+def md_mapping(mdfile, cellfile=None):
+    """ Mixmap of the atoms of an MD run onto their pure sites
+
+    str mdfile : .md file (the first step gives the atoms)
+    str cellfile : .cell (or .castep) file with the mixtures of the run
+    (default seed.cell)
+
+    returns
+    mixmap.mixmap mapping : mapping of the atoms in the order of the .md """
+    if cellfile is None:
+        cellfile = mdfile.replace('.md', '.cell')
+    if cellfile.endswith('.castep'):
+        cas = rc.readcas(cellfile)
+    else:
+        cas = rc.readcell(cellfile)
+    md = readmd(mdfile, chunksize=1)
+    first = next(iter(md))
+    atoms = Atoms(symbols=md.elems, positions=first['positions'][0],
+                  cell=first['cell'][0], pbc=True)
+    return mixmap.mixmap(atoms, cas.get_mixkey())
+
+
+##########################################################################
+
+if __name__ == '__main__':
+    """ Run from the command line: mdstream.py [options] mdfile """
+    parser = argparse.ArgumentParser(
+        description='Write an MD trajectory to memory mapped .npy arrays.')
+    parser.add_argument('mdfile', help='CASTEP .md file')
+    parser.add_argument('-o', '--folder', default=None,
+                        help='directory for the arrays (default seed_md)')
+    parser.add_argument('-c', '--chunk', type=int, default=1000,
+                        help='steps read at a time')
+    parser.add_argument('-p', '--pure', action='store_true',
+                        help='one row per pure site (mixtures of seed.cell)')
+    parser.add_argument('--cell', default=None,
+                        help='.cell file with the mixtures (with --pure)')
+    args = parser.parse_args()
+    mapping = md_mapping(args.mdfile, args.cell) if args.pure else None
+    folder = args.folder or args.mdfile.replace('.md', '') + '_md'
+    arrays = readmd(args.mdfile, chunksize=args.chunk,
+                    mapping=mapping).to_memmap(folder)
+    print(str(len(arrays['step'])) + ' steps written to ' + folder + ': '
+          + ', '.join(sorted(arrays)))
+    print('mean temperature {0:.2f} K, mean pressure {1:.4f} GPa'.format(
+        float(np.mean(arrays['temperature'])),
+        float(np.nanmean(arrays['pressure']))))
@@ -1,6 +1,14 @@
+import io
+import os
+import copy
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import ase
-import ase.io as io
+from ase.build import make_supercell
 import numpy as np
+import scipy.sparse as sp
+import profiling
 
 """
 Module managing conversion between solid solution structures (using the VCA)
@@ -22,6 +30,10 @@ elemmixkey = {'Ca': {'Ca': 0.5, 'Sr': 0.5},
 WARNING: be careful with labelling if this format is used when different
 sites exist containing the same element -- key labels in the pure structure
 must be unique
+
+Either format may also be held as a compact MixKey object (site positions and
+occupancies stored as arrays) which avoids re-parsing the string site keys,
+e.g. MixKey.from_dict(sitemixkey) or readcas.get_mixkey(compact=True)
 """
 
 # Defaults -- these are relevant when printing cell files
@@ -33,6 +45,10 @@ spins_default = None
 pressure_default = [0.0]*6
 cell_constrs_default = [1, 2, 3, 0, 0, 0]  # Assumes orthorhombic cell
 
+# Trailing zeros (and then bare decimal points) of formatted floats
+stripzeros = re.compile(r'0+(?=[\t\n])')
+stripdots = re.compile(r'\.(?=[\t\n])')
+
 
 def pzero(x):
     """ Make sure zeros are displayed as positive """
@@ -45,49 +61,311 @@ def posstring(posn):
     return ' '.join([str('{0:.6f}'.format(pzero(posn[j])))
                      for j in range(len(posn))])
 
-def create_mixture(pureatoms, mixkey):
+class MixKey():
+    """ Compact mixkey storing sites as arrays rather than string-keyed dicts.
+
+    Sites are held as an (Nsites, 3) array of fractional coordinates (None if
+    the mixkey is of the elem format), an array of pure elements and a sparse
+    (Nsites x Nspecies) matrix of site occupancies. Positions are hashed on a
+    grid of spacing postol so that sites may be looked up without parsing.
+    """
+
+    def __init__(self, pureelems, species, wts, posns=None, postol=1e-5):
+        """
+        list pureelems : pure element (label) of each site
+        list species : element corresponding to each column of wts
+        scipy.sparse.csr_matrix wts : (Nsites, Nspecies) site occupancies
+        np.array(Nsites, 3) posns : fractional site coords (None if elem fmt)
+        float postol : fractional tolerance for matching positions to sites
+        """
+        self.pureelems = np.array(pureelems, dtype=object)
+        self.species = list(species)
+        self.wts = wts
+        self.Nsites = len(self.pureelems)
+        self.postol = postol
+        if posns is None:
+            self.posns = None
+        else:
+            self.posns = np.array(posns, dtype=float).reshape(-1, 3)
+            self.hashsites()
+
+    def __len__(self):
+        return self.Nsites
+
+    @property
+    def site(self):
+        """ True if the mixkey is of the site format (False if elem) """
+        return self.posns is not None
+
+    @classmethod
+    def from_dict(cls, mixkey, postol=1e-5):
+        """ Build a MixKey from a legacy mixkey (of site or elem format) """
+        if isinstance(mixkey, cls):
+            return mixkey
+        keys = list(mixkey.keys())
+        if len(keys[0].split()) == 3:  # site format
+            posns = np.array([[float(p) for p in key.split()]
+                              for key in keys])
+            pureelems = [mixkey[key][0] for key in keys]
+            sitewts = [mixkey[key][1] for key in keys]
+        elif len(keys[0].split()) == 1:  # elem format
+            posns = None
+            pureelems = keys
+            sitewts = [mixkey[key] for key in keys]
+        else:
+            raise KeyError(str(keys[0]) + '  not recognised as mixkey.')
+        return cls.from_sites(pureelems, sitewts, posns=posns, postol=postol)
+
+    @classmethod
+    def from_sites(cls, pureelems, sitewts, posns=None, postol=1e-5):
+        """ Build a MixKey from a list of {elem: wt} dicts (one per site)
+        The order of elements within each site is preserved. """
+        species = []
+        colindex = {}
+        indptr = [0]
+        indices = []
+        data = []
+        for wts in sitewts:
+            for elem, wt in wts.items():
+                if elem not in colindex:
+                    colindex[elem] = len(species)
+                    species += [elem]
+                indices += [colindex[elem]]
+                data += [wt]
+            indptr += [len(indices)]
+        wtmat = sp.csr_matrix((np.array(data, dtype=float),
+                               np.array(indices, dtype=int),
+                               np.array(indptr, dtype=int)),
+                              shape=(len(sitewts), len(species)))
+        return cls(pureelems, species, wtmat, posns=posns, postol=postol)
+
+    def to_dict(self):
+        """ Convert to a legacy mixkey dict (of site or elem format) """
+        if self.site:
+            return {posstring(self.posns[i]): (self.pureelems[i],
+                                               self.sitewts(i))
+                    for i in range(self.Nsites)}
+        return {self.pureelems[i]: self.sitewts(i)
+                for i in range(self.Nsites)}
+
+    def to_elem_dict(self):
+        """ Convert to a legacy mixkey dict of the elem format """
+        if not self.site:
+            return self.to_dict()
+        return mixmap.site2elem_mixkey(self.to_dict())
+
+    def label(self, i):
+        """ Legacy dict key of site i """
+        if self.site:
+            return posstring(self.posns[i])
+        return self.pureelems[i]
+
+    def sitewts(self, i):
+        """ returns dict {elem: wt} of occupancies on site i """
+        start, end = self.wts.indptr[i], self.wts.indptr[i+1]
+        return {self.species[j]: float(wt) for j, wt in
+                zip(self.wts.indices[start:end], self.wts.data[start:end])}
+
+    def sitesums(self):
+        """ returns np.array(Nsites) sum of occupancies on each site """
+        return np.asarray(self.wts.sum(axis=1)).ravel()
+
+    def check_wts(self, wttol=0.0001):
+        """ Check that the atom weights for each site sums to 1.0 """
+        sitewt = self.sitesums()
+        bad = np.where(np.abs(sitewt - 1) > wttol)[0]
+        if len(bad):
+            i = bad[0]
+            raise AttributeError('Sum of concs on site ' + self.label(i)
+                                 + ' equals ' + str(sitewt[i]) +
+                                 ' which does not make sense.')
+
+    def components(self, sites):
+        """ Locate the occupancies of a sequence of (possibly repeated) sites
+        np.array(int) sites : site indices
+
+        returns
+        np.array(int) counts : number of elements on each of the sites
+        np.array(int) comps : indices into self.wts.data/.indices of every
+        element on every site (in order) """
+        sites = np.asarray(sites, dtype=int)
+        starts = self.wts.indptr[sites]
+        counts = self.wts.indptr[sites+1] - starts
+        offsets = starts - np.cumsum(counts) + counts
+        comps = np.repeat(offsets, counts) + np.arange(counts.sum())
+        return counts, comps
+
+    def subset(self, sites, posns=None):
+        """ New MixKey made of the given (possibly repeated) sites
+        np.array(int) sites : site indices
+        np.array(Nsites, 3) posns : fractional coords of the new sites """
+        counts, comps = self.components(sites)
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        wts = sp.csr_matrix((self.wts.data[comps], self.wts.indices[comps],
+                             indptr), shape=(len(counts), len(self.species)))
+        return MixKey(self.pureelems[np.asarray(sites, dtype=int)],
+                      self.species, wts, posns=posns, postol=self.postol)
+
+    def hashkeys(self, posns):
+        """ Integer grid coordinates of (wrapped) fractional positions """
+        nbins = max(int(round(1.0/self.postol)), 1)
+        return np.floor((np.asarray(posns) % 1.0)*nbins).astype(int) % nbins
+
+    def hashsites(self):
+        """ Set up the spatial hash of site positions """
+        self.sitehash = {}
+        for i, key in enumerate(self.hashkeys(self.posns)):
+            self.sitehash.setdefault(tuple(key), []).append(i)
+
+    def find(self, posn):
+        """ Hashed lookup of a site within postol of a fractional position
+        np.array(3) posn : fractional coordinates
+
+        returns
+        int i : index of matching site (None if no site within postol) """
+        nbins = max(int(round(1.0/self.postol)), 1)
+        key = self.hashkeys(posn)
+        best = None
+        for h in [-1, 0, 1]:
+            for k in [-1, 0, 1]:
+                for l in [-1, 0, 1]:
+                    nkey = ((key[0]+h) % nbins, (key[1]+k) % nbins,
+                            (key[2]+l) % nbins)
+                    for i in self.sitehash.get(nkey, []):
+                        diff = posn - self.posns[i]
+                        dist = np.max(np.abs(diff - np.round(diff)))
+                        if dist <= self.postol and (best is None or
+                                                    (dist, i) < best):
+                            best = (dist, i)
+        if best is None:
+            return None
+        return best[1]
+
+    def nearest(self, posn, cell):
+        """ Index of the site closest (considering PBCs) to a position
+        np.array(3) posn : fractional coordinates
+        np.array(3, 3) cell : unit cell vectors """
+        i = self.find(posn)
+        if i is None:
+            diff = posn - self.posns
+            diff -= np.round(diff)
+            images = np.array([[h, k, l] for h in [-1, 0, 1]
+                               for k in [-1, 0, 1] for l in [-1, 0, 1]])
+            vecs = np.dot(diff[:, None, :] + images[None, :, :], cell)
+            dists = np.min(np.linalg.norm(vecs, axis=2), axis=1)
+            i = int(np.argmin(dists))
+        return i
+
+    def elemsite(self, elem):
+        """ Index of the (last) elem format site containing element elem """
+        if elem in self.species:
+            rows = np.repeat(np.arange(self.Nsites), np.diff(self.wts.indptr))
+            sites = rows[self.wts.indices == self.species.index(elem)]
+            if len(sites):
+                return int(sites.max())
+        raise KeyError('Element: '+elem+' does not appear in mixkeys')
+
+
+def fmtfloats(arr, fmt='%.10f'):
+    """ Format the rows of a float array as tab separated strings with
+    trailing zeros stripped, e.g. 0.2500000000 -> 0.25 and 1.0000000000 -> 1
+
+    np.array(N, M) arr : values to format (fmt must include decimal places)
+
+    returns
+    list rowstrings : one string per row of arr """
+    arr = np.atleast_2d(arr)
+    N, M = arr.shape
+    if N == 0:
+        return []
+    text = (('\t'.join([fmt]*M)+'\n')*N) % tuple(arr.ravel())
+    text = stripzeros.sub('', text)
+    text = stripdots.sub('', text)
+    return text.split('\n')[:-1]
+
+
+# Process umask, read once at import (os.umask can only be read by setting
+# it, which would race with files created by other threads)
+umask = os.umask(0o022)
+os.umask(umask)
+
+
+def atomic_write(text, filename):
+    """ Write text to a file via a temporary file and an atomic rename, so an
+    interrupted write never leaves a partial file behind """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp',
+                                   suffix=os.path.basename(filename))
+    try:
+        # mkstemp makes the file 0600: give it the mode of the file it
+        # replaces, or the mode a plain open() would have
+        if os.path.exists(filename):
+            mode = os.stat(filename).st_mode & 0o7777
+        else:
+            mode = 0o666 & ~umask
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmpname, filename)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+def casprint_chunk(args):
+    """ Worker for mixmap.casprint_many: (mapping, [(cellfile, atoms)], pure)
+    """
+    mapping, items, pure = args
+    for cellfile, atoms in items:
+        mapping.casprint(atoms, cellfile, pure=pure)
+    return len(items)
+
+
+def create_mixture(pureatoms, mixkey, supercell=None, rtn_mixkey=False):
     """
     ase.Atoms pureatoms : atomic structure with no mixing (one atom per site)
-    mixkey mixkey : mixkey of either the site or elem format
+    mixkey mixkey : mixkey of either the site or elem format (or a MixKey)
+    np.array(3, 3) supercell : if given, pureatoms (and a site format mixkey
+    for pureatoms) are first expanded to this supercell
+    bool rtn_mixkey : if True also return a site MixKey for the mixed cell
 
     NOTE: at present this function DOES NOT consider spins
 
     Returns:
     --------
     ase.Atoms mixatoms : atomic structure with multiple atoms per site
+    MixKey superkey : site format mixkey of mixatoms (only if rtn_mixkey)
     """
-
+    key = MixKey.from_dict(mixkey)
+    primcell = np.array(pureatoms.get_cell())
+    if supercell is not None:
+        pureatoms = make_supercell(pureatoms, np.array(supercell))
     posns = pureatoms.get_positions()
-    pureelems = pureatoms.get_chemical_symbols()
-    cell = pureatoms.get_cell()
-    mkey0 = list(mixkey.keys())[0]
-    mixposns = []
-    mixelems = []
-    if len(mkey0.split()) == 1:  # mixkey in element format
-        for i, key in enumerate(pureelems):
-            posn = posns[i]
-            subdict = mixkey[key]
-            for sub in subdict:
-                mixposns += [posn]
-                mixelems += [sub]
-    elif len(mkey0.split()) == 3:  # mixkey in site format
-        for key in mixkey:
-            posn = np.array([float(p) for p in key.split()])
-            pureelem, subdict = mixkey[key]
-            for sub in subdict:
-                mixposns += [posn]
-                mixelems += [sub]
-    mixelemset = sorted(list(set(mixelems)))
-    mixposns_sorted = []
-    mixelems_sorted = []
-    for elem in mixelemset:
-        for i, e in enumerate(mixelems):
-            if e == elem:
-                mixposns_sorted += [mixposns[i]]
-                mixelems_sorted += [elem]
-    mixposns_sorted = np.array(mixposns_sorted)
-    mixatoms = ase.Atoms(symbols=mixelems_sorted, positions=mixposns_sorted,
+    cell = np.array(pureatoms.get_cell())
+
+    # Site (row of key) corresponding to each pure atom
+    if key.site:  # match positions to sites of the (primitive) mixkey
+        primfracs = np.linalg.solve(primcell.T, posns.T).T
+        sites = np.array([key.nearest(f, primcell) for f in primfracs],
+                         dtype=int)
+    else:  # mixkey in element format
+        labels = {elem: i for i, elem in enumerate(key.pureelems)}
+        sites = np.array([labels[elem] for elem in
+                          pureatoms.get_chemical_symbols()], dtype=int)
+
+    # Expand each pure atom to all components on its site and sort by element
+    counts, comps = key.components(sites)
+    atomidx = np.repeat(np.arange(len(sites)), counts)
+    mixelems = np.array(key.species, dtype=str)[key.wts.indices[comps]]
+    order = np.argsort(mixelems, kind='stable')
+    mixatoms = ase.Atoms(symbols=list(mixelems[order]),
+                         positions=posns[atomidx[order]],
                          cell=cell, pbc=True)
+    if rtn_mixkey:
+        superkey = key.subset(sites,
+                              posns=pureatoms.get_scaled_positions(wrap=False))
+        return mixatoms, superkey
     return mixatoms
 
 class mixmap():
@@ -98,11 +376,12 @@ class mixmap():
         """ should be initialised for a particular mixed atom structure
 
         ase.Atoms mixatoms : atomic structure with multiple atoms on same site
-        dict mixkey : info atom mix per site (can be site or elem format)
+        dict/MixKey mixkey : info atom mix per site (can be site or elem format)
         float wttol : weights should sum to 1.0 (tolerance for rounding errors)
         float postol : look for atomic site keys within this tolerance of posn
         """
-        self.check_wts(mixkey, wttol)  # check that site weights sum to 1.0
+        self.key = MixKey.from_dict(mixkey)  # Parse site keys only once
+        self.check_wts(self.key, wttol)  # check that site weights sum to 1.0
         self.mixkey = mixkey
         self.postol = postol
         # This info is fixed for this mixmap instance
@@ -127,7 +406,8 @@ class mixmap():
         ase.Atoms mixatoms : structure with multiple atoms on same site"""
 
         mixposns = mixatoms.get_positions()
-        cell = mixatoms.get_cell()
+        mixfracs = mixatoms.get_scaled_positions(wrap=False)
+        cell = np.array(mixatoms.get_cell())
 
         pureelems = []     # Element list for pure structure
         puremasses = []    # Masses for each pure site (average of mix atoms)
@@ -141,12 +421,9 @@ class mixmap():
         for i in range(self.mixions):
             mixelem = self.mixelems[i]
             mixposn = mixposns[i, :]
-            matchkey = self.sitematch(mixelem, mixposn, cell)
-            if len(matchkey.split()) == 3:
-                pureelem, wts = self.mixkey[matchkey]
-            else:
-                pureelem = matchkey
-                wts = self.mixkey[matchkey]
+            isite = self.siteindex(mixelem, mixfracs[i, :], cell)
+            pureelem = self.key.pureelems[isite]
+            wts = self.key.sitewts(isite)
             if len(wts) == 1:  # This is the trivial case
                 puremasses += [self.mixmasses[i]]
                 pureelems += [pureelem]
@@ -184,7 +461,9 @@ class mixmap():
     def check_site_mixkey(site_mixkey):
         """ Raises an error if the input mixkey is not of the site format """
         error = True
-        if isinstance(site_mixkey, dict):
+        if isinstance(site_mixkey, MixKey):
+            error = not site_mixkey.site
+        elif isinstance(site_mixkey, dict):
             layer1 = list(site_mixkey.values())[0]
             cont = False
             if isinstance(layer1, (tuple, list)):
@@ -207,7 +486,9 @@ class mixmap():
     def check_elem_mixkey(elem_mixkey):
         """ Raises an error if the input mixkey is not of the elem format """
         error = True
-        if isinstance(elem_mixkey, dict):
+        if isinstance(elem_mixkey, MixKey):
+            error = elem_mixkey.site
+        elif isinstance(elem_mixkey, dict):
             layer1 = list(elem_mixkey.values())[0]
             if isinstance(layer1, dict):
                 layer2 = list(layer1.values())[0]
@@ -221,6 +502,8 @@ class mixmap():
     def site2elem_mixkey(site_mixkey):
         """ Converts a mixkey of the site format to one of the elem format """
         mixmap.check_site_mixkey(site_mixkey)
+        if isinstance(site_mixkey, MixKey):
+            site_mixkey = site_mixkey.to_dict()
         elem_mixkey = {}
         for sitekey in site_mixkey:
             siteelem, sitedict = site_mixkey[sitekey]
@@ -292,6 +575,8 @@ class mixmap():
     @staticmethod
     def check_wts(mixkey, wttol=0.0001):
         """ Check that the atom weights for each site sums to 1.0 """
+        if isinstance(mixkey, MixKey):
+            return mixkey.check_wts(wttol)
         for sitekey in list(mixkey.keys()):
             if len(sitekey.split()) == 3:  # site_mixkey
                 wts = mixkey[sitekey][1]
@@ -317,27 +602,114 @@ class mixmap():
         returns
         str matchkey : key from self.mixkeys that matches element and site
         """
-        sitekeys = list(self.mixkey.keys())
-        matchkey = None
-        if len(sitekeys[0].split()) == 3:  # site format for mixkey
-            dists = []
-            for sitekey in sitekeys:
-                site = np.array([float(s) for s in sitekey.split()])
-                siteposn = np.dot(site, cell)
-                vector, dist = self.closestimage(posn, siteposn, cell,
-                                                 rtn_dist=True)
-                dists += [dist]
-            matchkey = sitekeys[dists.index(min(dists))]
-        elif len(sitekeys[0].split()) == 1:  # elem format for mixkey
-            for sitekey in sitekeys:
-                if elem in self.mixkey[sitekey]:
-                    matchkey = sitekey
-            if matchkey is None:
-                raise KeyError('Element: '+elem+' does not appear in mixkeys')
-        else:
-            raise KeyError(str(sitekeys[0]) + '  not recognised as mixkey.')
-        return matchkey
+        cell = np.array(cell)
+        fracposn = np.linalg.solve(cell.T, posn)
+        return self.key.label(self.siteindex(elem, fracposn, cell))
+
+    def siteindex(self, elem, fracposn, cell):
+        """
+        As sitematch but returns the index of the matching site in self.key
+
+        str elem : element name
+        np.array(3) fracposn : fractional position of atom
+        np.array(3, 3) cell : unit cell vectors
+        """
+        if self.key.site:  # site format for mixkey
+            return self.key.nearest(fracposn, cell)
+        return self.key.elemsite(elem)  # elem format for mixkey
     
+    def tile(self, pureatoms, superatoms):
+        """ Mapping for a supercell of the structure this mapping was made
+        for, built by tiling the existing maps (the supercell is never
+        searched with setup_maps, so this is linear in the supercell size)
+
+        ase.Atoms pureatoms : pure structure of this mapping (mix2pure)
+        ase.Atoms superatoms : pure supercell of pureatoms (e.g. a phonopy
+        supercell), its atoms may be in any order
+
+        returns
+        mixmap supermap : mapping between superatoms and a mixed supercell.
+        Mix atoms are ordered by mix atom of this mapping then by lattice
+        point, mixtures are relabelled per supercell site, spins and ionic
+        constraints are repeated and k-points are reduced in proportion to
+        the lengths of the supercell vectors """
+        primcell = np.array(pureatoms.get_cell())
+        primfracs = pureatoms.get_scaled_positions()
+        supercell = np.array(superatoms.get_cell())
+        superposns = np.array(superatoms.get_positions())
+        Nsuper = len(superposns)
+        Nlat = Nsuper//self.pureions
+        if Nlat*self.pureions != Nsuper:
+            raise ValueError('Supercell has ' + str(Nsuper) + ' atoms which '
+                             + 'is not a multiple of ' + str(self.pureions))
+
+        # Pure site of this mapping at each supercell atom (closest image)
+        fracs = np.linalg.solve(primcell.T, superposns.T).T
+        s2p = np.zeros(Nsuper, dtype=int)
+        chunk = max(1, 2**20//(3*self.pureions))
+        for c in range(0, Nsuper, chunk):
+            diff = fracs[c:c+chunk, None, :] - primfracs[None, :, :]
+            diff -= np.round(diff)
+            dists = np.linalg.norm(np.dot(diff, primcell), axis=2)
+            s2p[c:c+chunk] = np.argmin(dists, axis=1)
+            bad = np.where(dists.min(axis=1) > self.postol)[0]
+            if len(bad):
+                raise ValueError('Supercell atom ' + str(c + bad[0]) + ' is '
+                                 + 'not at a site of the primitive structure')
+        superelems = list(superatoms.get_chemical_symbols())
+        if (np.bincount(s2p, minlength=self.pureions) != Nlat).any() or any(
+                [superelems[i] != self.pureelems[p]
+                 for i, p in enumerate(s2p)]):
+            raise ValueError('Supercell atoms do not tile the primitive '
+                             + 'structure')
+
+        # images[p, l] : supercell atom at lattice point l of pure site p
+        images = np.argsort(s2p, kind='stable').reshape(self.pureions, Nlat)
+        lattice = np.zeros(Nsuper, dtype=int)
+        lattice[images.ravel()] = np.tile(np.arange(Nlat), self.pureions)
+        atompure = np.zeros(self.mixions, dtype=int)
+        for p in range(self.pureions):
+            for elem, (wt, j) in self.pure2mix_map[p].items():
+                atompure[j] = p
+        mixed = np.array([len(self.pure2mix_map[p]) > 1
+                          for p in range(self.pureions)])[s2p]
+        labels = np.cumsum(mixed)  # CASTEP mixture label of each super site
+
+        supermap = copy.copy(self)
+        supermap.mixelems = [elem for elem in self.mixelems
+                             for l in range(Nlat)]
+        supermap.mixions = self.mixions*Nlat
+        supermap.mixmasses = np.repeat(self.mixmasses, Nlat)
+        supermap.pureions = Nsuper
+        supermap.pureelems = superelems
+        supermap.puremasses = self.puremasses[s2p]
+        supermap.pure2mix_map = {
+            s: {elem: (wt, j*Nlat + lattice[s]) for elem, (wt, j) in
+                self.pure2mix_map[p].items()} for s, p in enumerate(s2p)}
+        supermap.mix2pure_map = {
+            j*Nlat + l: int(images[p, l]) for j, p in
+            self.mix2pure_map.items() for l in range(Nlat)}
+        supermixpure = images[atompure].ravel()
+        supermap.mixsitemixes = {}
+        for J, s in enumerate(supermixpure):
+            m, wt = self.mixsitemixes[J//Nlat]
+            supermap.mixsitemixes[J] = (int(labels[s]) if m else 0, wt)
+        if self.key.site:
+            sites = np.array([self.siteindex(self.pureelems[p], primfracs[p],
+                                             primcell)
+                              for p in range(self.pureions)], dtype=int)
+            supermap.key = self.key.subset(
+                sites[s2p], posns=superatoms.get_scaled_positions())
+            supermap.mixkey = supermap.key
+        supermap.spins = list(np.repeat(self.spins, Nlat))
+        if self.ion_constrs is not None:
+            supermap.ion_constrs = np.repeat(self.ion_constrs, Nlat, axis=0)
+        ratios = (np.linalg.norm(primcell, axis=1)
+                  / np.linalg.norm(supercell, axis=1))
+        supermap.kpoints = [max(1, int(np.ceil(k*r - 1e-6)))
+                            for k, r in zip(self.kpoints, ratios)]
+        return supermap
+
     def pure2mix(self, pureatoms):
         """ Convert a pure ase.Atoms structure to a mixed structure """
         pureposns = pureatoms.get_positions()
@@ -429,24 +801,55 @@ class mixmap():
         ase.Atoms atoms : structure to produce file from
         str cellfile : filename (incl. path) to write to
         bool pure : if True, produce .cell of pure struc, otherwise mix """
-        
+        atomic_write(self.castext(atoms, pure=pure), cellfile)
+
+    def casprint_many(self, cells, pure=False, nprocs=1):
+        """ Produce many CASTEP .cell files (e.g. displacements or a series of
+        structures) with the same mapping and calculation parameters
+
+        dict cells : {cellfile: ase.Atoms} structures to write
+        bool pure : if True, produce .cell of pure strucs, otherwise mix
+        int nprocs : number of worker processes to format and write with
+
+        returns
+        list cellfiles : files written """
+        items = list(cells.items())
+        if nprocs is None or nprocs <= 1 or len(items) <= 1:
+            for cellfile, atoms in items:
+                self.casprint(atoms, cellfile, pure=pure)
+            return [cellfile for cellfile, atoms in items]
+        # Each worker receives the mapping once with a chunk of structures
+        nchunks = min(nprocs, len(items))
+        chunks = [(self, items[c::nchunks], pure) for c in range(nchunks)]
+        with ProcessPoolExecutor(max_workers=nchunks) as pool:
+            for written in pool.map(casprint_chunk, chunks):
+                pass
+        return [cellfile for cellfile, atoms in items]
+
+    def castext(self, atoms, pure=False):
+        """ Text of a CASTEP .cell file for an atoms object (see casprint)
+
+        ase.Atoms atoms : structure to produce file from
+        bool pure : if True, produce .cell of pure struc, otherwise mix
+
+        returns
+        str text : contents of the .cell file """
+        buf = io.StringIO()
+
         # Print cell
-        caslines = ['%BLOCK LATTICE_CART\n']
-        cell = atoms.get_cell()
-        for i in range(3):
-            caslines += ['\t'+'\t'.join([str('{0:.10f}'.format(cell[i,
-                j]).rstrip('0').rstrip('.'))
-                                         for j in range(3)])+'\n']
-        caslines += ['%ENDBLOCK LATTICE_CART\n']+['\n']
+        buf.write('%BLOCK LATTICE_CART\n')
+        buf.write(''.join(['\t'+line+'\n' for line in
+                           fmtfloats(np.array(atoms.get_cell()))]))
+        buf.write('%ENDBLOCK LATTICE_CART\n\n')
         
         # Print cell constraints (if not [1, 2, ... 6])
         if any([self.cell_constrs[i] != i+1 for i in range(6)]):
-            caslines += ['%BLOCK cell_constraints\n']
-            caslines += ['\t'+'\t'.join([str(int(self.cell_constrs[j]))
-                                         for j in range(3)])+'\n']
-            caslines += ['\t'+'\t'.join([str(int(self.cell_constrs[j]))
-                                         for j in range(3, 6)])+'\n']
-            caslines += ['%ENDBLOCK cell_constraints\n']+['\n']
+            buf.write('%BLOCK cell_constraints\n')
+            buf.write('\t'+'\t'.join([str(int(self.cell_constrs[j]))
+                                      for j in range(3)])+'\n')
+            buf.write('\t'+'\t'.join([str(int(self.cell_constrs[j]))
+                                      for j in range(3, 6)])+'\n')
+            buf.write('%ENDBLOCK cell_constraints\n\n')
                 
         # Print elements, atomic positions, spins and mix weights
         mixelems = atoms.get_chemical_symbols()
@@ -455,90 +858,95 @@ class mixmap():
         if pure:
             spins = self.mix2pure_spins(spins)
             Natoms = self.pureions
+            mixstrings = ['']*Natoms
+        else:
+            sitemixes = [self.mixsitemixes[i] for i in range(Natoms)]
+            mixstrings = self.mixstrings([m for m, wt in sitemixes],
+                                         [wt for m, wt in sitemixes])
         if self.frac:
-            caslines += ['%BLOCK POSITIONS_FRAC\n']
+            block = 'POSITIONS_FRAC'
             mixposns = atoms.get_scaled_positions()
         else:
-            caslines += ['%BLOCK POSITIONS_ABS\n']
+            block = 'POSITIONS_ABS'
             mixposns = atoms.get_positions()
-        for i in range(Natoms):
-            (m, wt) = self.mixsitemixes[i]
-            if pure:
-                wt = 1.0
-            if wt == 1.0:
-                mixstring = ''
-            elif wt <= 0.0 or wt > 1.0:
-                raise ValueError('Trying to print ion index ' + str(i) +
-                                 ' with weight ' + str(wt) +
-                                 ' and do not know what to do.')
-            else:
-                mixstring = '\tMIXTURE=('+str(m)+' '+str(wt)+')'
-            spin = spins[i]
-            if spin == 0:
-                spinstring = ''
-            else:
-                spinstring = '\tSPIN='+str(spin)
-            posstring = '\t'.join(
-                [str('{0:.10f}'.format(mixposns[i,
-                    j]).rstrip("0").rstrip("."))\
-                            for j in range(3)])
-            caslines += ['\t' + mixelems[i] + '\t' + posstring
-                         + spinstring + mixstring + '\n']
-        if self.frac:
-            caslines += ['%ENDBLOCK POSITIONS_FRAC\n']
-        else:
-            caslines += ['%ENDBLOCK POSITIONS_ABS\n']
+        spinstrings = ['' if spin == 0 else '\tSPIN='+str(spin)
+                       for spin in list(spins)[:Natoms]]
+        buf.write('%BLOCK '+block+'\n')
+        buf.write(''.join(['\t' + elem + '\t' + posn + spin + mix + '\n'
+                           for elem, posn, spin, mix in
+                           zip(mixelems, fmtfloats(mixposns[:Natoms]),
+                               spinstrings, mixstrings)]))
+        buf.write('%ENDBLOCK '+block+'\n')
 
         # Print k-points and offset
-        caslines += ['\n']
-        caslines += ['kpoints_mp_grid = '+' '.join([str(self.kpoints[j])
-                                                    for j in range(3)])+'\n']
-        caslines += ['kpoints_mp_offset = '+' '.join(
-            [str(self.kpoints_offset[j]) for j in range(3)])+'\n']
+        buf.write('\n')
+        buf.write('kpoints_mp_grid = '+' '.join([str(self.kpoints[j])
+                                                 for j in range(3)])+'\n')
+        buf.write('kpoints_mp_offset = '+' '.join(
+            [str(self.kpoints_offset[j]) for j in range(3)])+'\n')
         
         # Pseudo potentials
         if self.pseudos:
-            caslines += ['\n']+['%BLOCK SPECIES_POT\n']
+            buf.write('\n%BLOCK SPECIES_POT\n')
             for elem in list(self.pseudos.keys()):
-                caslines += ['\t'+elem+' '+self.pseudos[elem]+'\n']
-            caslines += ['%ENDBLOCK SPECIES_POT\n']+['\n']
+                buf.write('\t'+elem+' '+self.pseudos[elem]+'\n')
+            buf.write('%ENDBLOCK SPECIES_POT\n\n')
         
         # Symmetry statements
         if self.sym_gen:
-            caslines += ['symmetry_generate\n']+['\n']
+            buf.write('symmetry_generate\n\n')
         if self.snap_sym:
-            caslines += ['snap_to_symmetry\n']+['\n']
+            buf.write('snap_to_symmetry\n\n')
         
         # External pressure
         if any([self.pressure[i] != 0.0 for i in range(6)]):
-            caslines += ['%BLOCK external_pressure\n']+['\tGPA\n']
-            caslines += ['\t'+'\t'.join(
+            buf.write('%BLOCK external_pressure\n\tGPA\n')
+            buf.write('\t'+'\t'.join(
                 [str('{0:.8f}'.format(self.pressure[j]))
-                 for j in [0, 5, 4]])+'\n']
-            caslines += ['\t\t\t'+'\t'.join([str('{0:.8f}'.format(
-                self.pressure[j])) for j in [1, 3]])+'\n']
-            caslines += ['\t\t\t\t\t'+'\t'.join([str('{0:.8f}'.format(
-                self.pressure[j])) for j in [2]])+'\n']
-            caslines += ['%ENDBLOCK external_pressure\n']+['\n']
+                 for j in [0, 5, 4]])+'\n')
+            buf.write('\t\t\t'+'\t'.join([str('{0:.8f}'.format(
+                self.pressure[j])) for j in [1, 3]])+'\n')
+            buf.write('\t\t\t\t\t'+'\t'.join([str('{0:.8f}'.format(
+                self.pressure[j])) for j in [2]])+'\n')
+            buf.write('%ENDBLOCK external_pressure\n\n')
         
         # Ionic constraints
         # WARNING: at the moment this doesn't switch pureatoms <--> mixatoms
         if self.ion_constrs is not None:
-            caslines += ['%BLOCK IONIC_CONSTRAINTS\n']
+            buf.write('%BLOCK IONIC_CONSTRAINTS\n')
             k = 1
             for i, elem in enumerate(mixelems):
                 for j in range(3):
                     zeros = [0.0, 0.0, 0.0]
                     if self.ion_constrs[i, j]:
                         zeros[j] = 1.0
-                        caslines += [str(k) + '\t' + elem + '\t'
-                                     + str(i+1) + '\t' +
-                                     '\t'.join([str(z) for z in zeros])+'\n']
+                        buf.write(str(k) + '\t' + elem + '\t'
+                                  + str(i+1) + '\t' +
+                                  '\t'.join([str(z) for z in zeros])+'\n')
                         k += 1
-            caslines += ['%ENDBLOCK IONIC_CONSTRAINTS\n']+['\n']
+            buf.write('%ENDBLOCK IONIC_CONSTRAINTS\n\n')
         
-        # This writes the .cell file
-        open(cellfile, 'w').writelines(caslines)
+        return buf.getvalue()
+
+    @staticmethod
+    def mixstrings(mixindices, wts):
+        """ MIXTURE statements for the positions block of a .cell file
+
+        list mixindices : CASTEP mixture label for each atom
+        list wts : weight of each atom (no statement written if 1.0)
+
+        returns
+        list mixstrings : MIXTURE statement (or '') for each atom """
+        wts = np.asarray(wts, dtype=float)
+        bad = np.where((wts <= 0.0) | (wts > 1.0))[0]
+        if len(bad):
+            i = bad[0]
+            raise ValueError('Trying to print ion index ' + str(i) +
+                             ' with weight ' + str(wts[i]) +
+                             ' and do not know what to do.')
+        return ['' if wt == 1.0 else
+                '\tMIXTURE=('+str(m)+' '+str(wt)+')'
+                for m, wt in zip(mixindices, wts.tolist())]
     
     def setcellparams(self, frac=True,
                       kpoints=kpts_default, kpoints_offset=kpts_offset_default,
@@ -560,3 +968,6 @@ class mixmap():
         self.cell_constrs = cell_constrs
         self.ion_constrs = ion_constrs
             
+
+
+profiling.autoenable(__name__)  # if VCA_PROFILE is set
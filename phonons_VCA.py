@@ -1,21 +1,57 @@
 import phonopy
+import ase
 import mixmap
 import readmixcastep as rc
 import numpy as np
 import glob
+import os
+import json
+import hashlib
 import pinchposns as pinpos
+from concurrent.futures import ProcessPoolExecutor
 
 """ Wrapper to manage phonon calculations using phonopy and CASTEP for
 solid solutions made with the virtual crystal approximation (VCA) """
 
 
-def gen_perturbations(casfile, supercell='Gamma'):
+def structure_fingerprint(atoms):
+    """ returns
+    str fingerprint : sha256 of the elements, cell and fractional positions
+    (rounded to 1e-6) of a structure """
+    sha = hashlib.sha256()
+    sha.update(' '.join(atoms.get_chemical_symbols()).encode())
+    for arr in [np.array(atoms.get_cell()), atoms.get_scaled_positions()]:
+        sha.update(np.ascontiguousarray(np.round(arr, 6) + 0.0).tobytes())
+    return sha.hexdigest()
+
+
+def manifest_file(chem):
+    """ returns
+    str manifest : displacement manifest written next to chem_N.cell files """
+    return chem + '_displacements.json'
+
+
+def read_manifest(chem):
+    """ returns
+    dict manifest : displacement manifest written by gen_perturbations """
+    with open(manifest_file(chem), 'r') as f:
+        return json.load(f)
+
+
+def gen_perturbations(casfile, supercell='Gamma', nprocs=1, symprec=1e-4,
+                      distance=0.05):
     """ Genterate input .cell files for CASTEP singlepoint energy simulations
     as part of a phonopy phonon calculation of a solid solution.
+    A manifest of the displacements (chem_displacements.json) is also written
+    so that calc_phonons can read them back without any matching.
     
     str casfile : filename (incl. path) to .castep file to compute phonons of
     np.array(3, 3) supercell : size of real space supercell dictates k-points
-    If supercell is 'Gamma', only unit cell displacements are created """
+    If supercell is 'Gamma', only unit cell displacements are created,
+    otherwise mixed supercells are written (see mixmap.tile)
+    int nprocs : number of processes used to write the .cell files
+    float symprec : symmetry tolerance used by phonopy
+    float distance : displacement distance (Ang) """
     # Load the mixed data
     chem = casfile.replace('.castep', '')
     cas = rc.readcas(casfile)
@@ -30,43 +66,276 @@ def gen_perturbations(casfile, supercell='Gamma'):
     mapping.setcellparams(spins=spins, pressure=press)
 
     # Generate perturbed cells (displacements) of pure cell
-    if supercell == 'Gamma':  # Gamma-point means only single unit cell
+    if isinstance(supercell, str) and supercell == 'Gamma':
         supercell = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]])
-    GammaPhonon = phonopy.Phonopy(pureatoms, supercell, symprec=1e-4,
+    GammaPhonon = phonopy.Phonopy(pureatoms, supercell, symprec=symprec,
                                   factor=phonopy.units.VaspToCm)
-    GammaPhonon.generate_displacements(distance=0.05)
+    GammaPhonon.generate_displacements(distance=distance)
     displcells = GammaPhonon.get_supercells_with_displacements()
+    if len(GammaPhonon.supercell) != len(pureatoms):  # Real supercell
+        mapping = mapping.tile(pureatoms, GammaPhonon.supercell)
     
     # Convert displaced pure cells to mixtures and write files
+    mixdispls = {}
     for d, displcell in enumerate(displcells):
-        mixdispl = mapping.pure2mix(displcells[d])
-        cellfile = chem+'_'+str(d)+'.cell'
-        mapping.casprint(mixdispl, cellfile)
+        mixdispls[chem+'_'+str(d)+'.cell'] = mapping.pure2mix(displcell)
+    mapping.casprint_many(mixdispls, nprocs=nprocs)
 
+    # Record exactly which displacement each file contains
+    displacements = []
+    for d, first_atoms in enumerate(
+            GammaPhonon.displacement_dataset['first_atoms']):
+        displacements += [{'index': d,
+                           'cellfile': os.path.basename(chem+'_'+str(d)
+                                                        + '.cell'),
+                           'atom': int(first_atoms['number']),
+                           'displacement':
+                           [float(x) for x in first_atoms['displacement']]}]
+    manifest = {'parent': structure_fingerprint(pureatoms),
+                'supercell': np.array(supercell).astype(int).tolist(),
+                'symprec': symprec, 'distance': distance,
+                'natom': len(GammaPhonon.supercell),
+                'displacements': displacements}
+    mixmap.atomic_write(json.dumps(manifest, indent=1), manifest_file(chem))
 
-def calc_phonons(casfile, supercell='Gamma', method=2, postol=0.001,
-                 bands=None, verbose=False):
-    """ Compute phonons from completed singlepoint CASTEP calculations of
-    perturbations about a relaxed cell.
-    Note that this function assumes that the perturbed files are in the
-    same directory and use the same naming convention as the parent.
 
-    str casfile : filename (incl. path) to .castep file to compute phonons of
-    np.array(3, 3) supercell : size of real space supercell dictates k-points
-    If supercell is 'Gamma', only unit cell displacements are created.
-    int method : can be 1 (regenerate displacements and assume the same) or
-    2 (process all castep files that follow displacement naming convention)
-    float postol : Tolerance (Ang) when ion considered displaced (2 only)
-    np.array() bands : k-points to compute frequencies at
-    bool verbose : function can take a while to run -> prints checkpoints.
+def progress(n, N, msg):
+    """ Report progress through a long loop (n of N items complete) """
+    print(msg + ' ' + str(n) + '/' + str(N), flush=True)
+
+
+def map_displs(worker, jobs, state, nprocs=1, verbose=False,
+               msg='read displacement'):
+    """ Apply worker to every job (in a process pool if nprocs > 1) and return
+    the results in the order of jobs.
+
+    function worker : worker(job) -> result, may use displstate
+    list jobs : arguments for each call of worker
+    dict state : shared (read-only) data set as displstate in every process
+    int nprocs : number of processes
+    bool verbose : report progress as results arrive """
+    results = []
+    if nprocs is None or nprocs <= 1:
+        displinit(state)
+        for job in jobs:
+            results += [worker(job)]
+            if verbose:
+                progress(len(results), len(jobs), msg)
+    else:
+        chunksize = max(1, len(jobs)//(4*nprocs))
+        with ProcessPoolExecutor(max_workers=nprocs, initializer=displinit,
+                                 initargs=(state,)) as pool:
+            for result in pool.map(worker, jobs, chunksize=chunksize):
+                results += [result]
+                if verbose:
+                    progress(len(results), len(jobs), msg)
+    return results
+
+
+displstate = {}
+
+
+def displinit(state):
+    """ Worker initialiser: shared data is sent to each process only once """
+    displstate.clear()
+    displstate.update(state)
+
+
+def read_forces(displcasfile):
+    """ Worker: pure forces of a displaced cell (method 1)
+    returns
+    np.array(pureions, 3) displpureforces : forces mapped to pure sites """
+    displmix = rc.readcas(displcasfile)
+    displmixforces = displmix.get_forces()
+    return displstate['mapping'].mix2pure_forces(displmixforces)
+
+
+def read_displacement(displcasfile):
+    """ Worker: displaced ion, its displacement and the pure forces of a
+    displaced cell (method 2)
+    returns
+    dict first_atoms_dict : entry of the phonopy displacement_dataset """
+    mapping = displstate['mapping']
+    pureatoms = displstate['pureatoms']
+    postol = displstate['postol']
+    pureposns = pureatoms.get_positions()
+
+    # Load displacement file and compute displ relative to parent
+    displmix = rc.readcas(displcasfile)
+    displmixatoms = displmix.extract_struc()
+    displpureatoms = mapping.mix2pure(displmixatoms)
+    displpureatoms = pinpos.reorder_atoms(pureatoms, displpureatoms)
+    puretotaldispl = displpureatoms.get_positions() - pureposns
+    
+    # Check that exactly one ion is displaced per perturbed cell
+    displmagnitudes = np.linalg.norm(puretotaldispl, axis=1)
+    displions = list(np.where(displmagnitudes > postol)[0])
+    if len(displions) > 1:
+        raise IndexError('The following ions were all displaced by '
+                         + 'more than ' + str(postol) + ' in '
+                         + displcasfile + ': '
+                         + ' '.join([str(i) for i in displions]))
+    elif not displions:
+        raise IndexError('No ions were found to be displaced by '
+                         + 'more than ' + str(postol) + ' in '
+                         + displcasfile)
+    displion = int(displions[0])
     
+    # Extract (pure) forces and construct the entry for first_atoms_list
+    # this list is later fed to construct displacement_dataset
+    displmixforces = displmix.get_forces()
+    displpureforces = mapping.mix2pure_forces(displmixforces)
+    first_atoms_dict = {}
+    first_atoms_dict['number'] = displion
+    first_atoms_dict['displacement'] = puretotaldispl[displion, :]
+    first_atoms_dict['forces'] = displpureforces
+    return first_atoms_dict
+
+
+def fingerprint(filename):
+    """ returns
+    list [mtime_ns, size] : cheap signature of a file's current contents """
+    stat = os.stat(filename)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def read_record(job):
+    """ Worker: fingerprint, completeness and data of a displaced cell
+    tuple (str displcasfile, int method) : file and calc_phonons method
     returns
-    tuple (q_points, distances, frequencies, eigvecs) : output of
-    phonopy_instance.get_band_structure() command.
-    These are all lists of lists of np.arrays, where the relavent entry of
-    frequencies is a list of freqs (in cm-1) of the form np.array(3*phonions)
-    and the relevant entry of eigvecs is a matrix of phonon eigenvectors of 
-    the form np.array(3*phonions, 3*phonions). """
+    dict record : entry of a forceset store """
+    displcasfile, method = job
+    record = {'fingerprint': fingerprint(displcasfile)}
+    if not rc.readcas(displcasfile).check_complete():
+        record['complete'] = False
+        return record
+    record['complete'] = True
+    if method == 1:
+        record['forces'] = read_forces(displcasfile).tolist()
+    else:
+        first_atoms_dict = read_displacement(displcasfile)
+        record['number'] = first_atoms_dict['number']
+        record['displacement'] = first_atoms_dict['displacement'].tolist()
+        record['forces'] = first_atoms_dict['forces'].tolist()
+    return record
+
+
+class forceset():
+    """ Persistent store of the pure forces (and displacements) read from the
+    displaced .castep files of one parent structure. Each record holds the
+    mtime/size fingerprint of the file it was read from, so repeated calls
+    only parse new or changed files. """
+
+    def __init__(self, casfile, postol=0.001, storefile=None):
+        """
+        str casfile : parent .castep file (displacements are chem_N.castep)
+        float postol : tolerance used to detect the displaced ion
+        str storefile : path of the store (default chem_forceset.json)
+
+        If the parent file or postol have changed, stored records are dropped
+        """
+        self.chem = casfile.replace('.castep', '')
+        if storefile is None:
+            storefile = self.chem + '_forceset.json'
+        self.storefile = storefile
+        self.header = {'parent': fingerprint(casfile), 'postol': postol}
+        self.records = {}
+        if os.path.exists(self.storefile):
+            with open(self.storefile, 'r') as f:
+                stored = json.load(f)
+            if stored.get('header') == self.header:
+                self.records = stored['records']
+
+    def displcasfile(self, d):
+        """ returns
+        str displcasfile : .castep file of displacement d """
+        return self.chem+'_'+str(d)+'.castep'
+
+    def stale(self, Ndispls, method=2):
+        """ returns
+        list indices : displacements whose files exist but are not stored
+        (or have changed since they were stored) """
+        indices = []
+        for d in range(Ndispls):
+            displcasfile = self.displcasfile(d)
+            if not os.path.exists(displcasfile):
+                continue
+            record = self.records.get(str(d))
+            if (record is None or
+                    record['fingerprint'] != fingerprint(displcasfile) or
+                    (record['complete'] and method == 2 and
+                     'number' not in record)):
+                indices += [d]
+        return indices
+
+    def missing(self, Ndispls):
+        """ returns
+        list indices : displacements with no complete calculation stored """
+        return [d for d in range(Ndispls) if not
+                self.records.get(str(d), {}).get('complete', False)]
+
+    def update(self, Ndispls, state, method=2, nprocs=1, verbose=False):
+        """ Parse only new or changed displacement files and save the store
+
+        int Ndispls : number of displacements expected
+        dict state : mapping (and pureatoms, postol for method 2) for workers
+        int method : calc_phonons method (1 forces only, 2 also displacement)
+
+        returns
+        list indices : displacements that were (re-)read """
+        indices = self.stale(Ndispls, method=method)
+        jobs = [(self.displcasfile(d), method) for d in indices]
+        records = map_displs(read_record, jobs, state, nprocs=nprocs,
+                             verbose=verbose)
+        for d, record in zip(indices, records):
+            self.records[str(d)] = record
+        if indices or not os.path.exists(self.storefile):
+            self.save()
+        return indices
+
+    def save(self):
+        """ Write the store (atomically) to self.storefile """
+        mixmap.atomic_write(json.dumps({'header': self.header,
+                                        'records': self.records}),
+                            self.storefile)
+
+    def check_missing(self, Ndispls):
+        """ Raise an error if any displacement is not yet complete """
+        missing = self.missing(Ndispls)
+        if missing:
+            raise IndexError('Displacements still missing (or incomplete) '
+                             + 'for ' + self.chem + ': '
+                             + ' '.join([str(d) for d in missing]))
+
+    def forces(self, Ndispls):
+        """ returns
+        np.array(Ndispls, pureions, 3) sets_of_forces : stored pure forces """
+        self.check_missing(Ndispls)
+        return np.array([self.records[str(d)]['forces']
+                         for d in range(Ndispls)])
+
+    def first_atoms(self, Ndispls):
+        """ returns
+        list first_atoms_list : phonopy displacement_dataset entries """
+        self.check_missing(Ndispls)
+        first_atoms_list = []
+        for d in range(Ndispls):
+            record = self.records[str(d)]
+            first_atoms_list += [{'number': record['number'],
+                                  'displacement':
+                                  np.array(record['displacement']),
+                                  'forces': np.array(record['forces'])}]
+        return first_atoms_list
+
+
+def build_phonons(casfile, supercell='Gamma', method=None, postol=0.001,
+                  verbose=False, nprocs=1, cache=False, fcfile=None,
+                  symprec=None, distance=None):
+    """ Read the displaced CASTEP calculations about a relaxed cell and build
+    the force constants (arguments as for calc_phonons)
+
+    returns
+    phonopy.Phonopy PhononObj : phonopy instance with force constants set """
     # Set up the PHONOPY object for the relaxed cell
     chem = casfile.replace('.castep', '')
     cas = rc.readcas(casfile)
@@ -76,29 +345,66 @@ def calc_phonons(casfile, supercell='Gamma', method=2, postol=0.001,
     mapping = mixmap.mixmap(mixatoms, mixkey)
     pureatoms = mapping.mix2pure(mixatoms)
     pureions = pureatoms.get_number_of_atoms()
-    if supercell == 'Gamma':  # Gamma-point means only single unit cell
+    primmapping = mapping
+    if fcfile is None and cache:
+        fcfile = chem + '_phonons.npz'
+    if isinstance(supercell, str) and supercell == 'Gamma':
+        # Gamma-point means only single unit cell
         supercell = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1]])
-        bands = [np.array([0.0])]
-    PhononObj = phonopy.Phonopy(pureatoms, supercell,
+    manifest = None
+    if os.path.exists(manifest_file(chem)):
+        manifest = read_manifest(chem)
+    if method is None:
+        method = 3 if manifest is not None else 2
+    if method == 3 and manifest is None:
+        raise ValueError('Method 3 needs the manifest ' + manifest_file(chem)
+                         + ' written by gen_perturbations')
+    if manifest is not None and method in (1, 3):
+        # Methods 1 and 3 rely on the displacements of the manifest
+        if manifest['parent'] != structure_fingerprint(pureatoms):
+            raise ValueError('Parent structure of ' + casfile + ' does not '
+                             + 'match that in ' + manifest_file(chem))
+        if not np.array_equal(manifest['supercell'], supercell):
+            raise ValueError('Supercell does not match that used to generate '
+                             + 'the displacements in ' + manifest_file(chem))
+    # Same symmetry tolerance and displacement as gen_perturbations used
+    if symprec is None:
+        symprec = manifest['symprec'] if manifest is not None else 1e-4
+    if distance is None:
+        distance = manifest['distance'] if manifest is not None else 0.05
+    PhononObj = phonopy.Phonopy(pureatoms, supercell, symprec=symprec,
                                 factor=phonopy.units.VaspToCm)
+    if len(PhononObj.supercell) != pureions:
+        # Real supercell: displaced files are mixed supercells, forces are
+        # mapped back onto the (phonopy ordered) pure supercell
+        superatoms = PhononObj.supercell
+        mapping = mapping.tile(pureatoms, superatoms)
+        pureatoms = ase.Atoms(symbols=superatoms.get_chemical_symbols(),
+                              positions=superatoms.get_positions(),
+                              cell=superatoms.get_cell(),
+                              masses=mapping.puremasses, pbc=True)
+        pureions = len(pureatoms)
     
     if method == 1:
         """ Generate more displs and ASSUME that they are the same as before.
         Less stable than method 2 and should only be used as a check. """
         # Generate perturbed pure cells
-        PhononObj.generate_displacements(distance=0.05)
+        PhononObj.generate_displacements(distance=distance)
         displcells = PhononObj.get_supercells_with_displacements()
         Ndispls = len(displcells)
-        sets_of_forces = np.zeros((Ndispls, pureions, 3))
-        for d in range(Ndispls):
-            displcasfile = chem+'_'+str(d)+'.castep'
-            if verbose:
-                print("reading "+displcasfile)
-            displmix = rc.readcas(displcasfile)
-            displmixforces = displmix.get_forces()
-            displpureforces = mapping.mix2pure_forces(displmixforces)
-            sets_of_forces[d] = displpureforces
-            PhononObj.set_forces(sets_of_forces)
+        if cache:
+            store = forceset(casfile, postol=postol)
+            store.update(Ndispls, {'mapping': mapping}, method=1,
+                         nprocs=nprocs, verbose=verbose)
+            sets_of_forces = store.forces(Ndispls)
+        else:
+            displcasfiles = [chem+'_'+str(d)+'.castep'
+                             for d in range(Ndispls)]
+            sets_of_forces = np.array(map_displs(read_forces, displcasfiles,
+                                                 {'mapping': mapping},
+                                                 nprocs=nprocs,
+                                                 verbose=verbose))
+        PhononObj.set_forces(sets_of_forces)
     
     elif method == 2:
         """ Load all the displaced structures and create a displacement_dataset
@@ -106,52 +412,30 @@ def calc_phonons(casfile, supercell='Gamma', method=2, postol=0.001,
         # Detect displacement files
         allcasfiles = glob.glob(chem+'_*.castep')
         displcasfiles = []
-        for casfile in allcasfiles:
-            n = casfile.replace(chem+'_', '').replace('.castep', '')
+        displindices = []
+        for displcasfile in allcasfiles:
+            n = displcasfile.replace(chem+'_', '').replace('.castep', '')
             try:
-                int(n)
-                displcasfiles.append(casfile)
+                displindices.append(int(n))
+                displcasfiles.append(displcasfile)
             except ValueError:
                 pass  # file doesn't follow displacement naming convention
-        Ndispls = len(displcasfiles)
-        first_atoms_list = []
-        pureposns = pureatoms.get_positions()
-        
-        for d in range(Ndispls):
-            # Load displacement files and compute displ relative to parent
-            displcasfile = chem+'_'+str(d)+'.castep'
-            if verbose:
-                print("reading "+displcasfile)
-            displmix = rc.readcas(displcasfile)
-            displmixatoms = displmix.extract_struc()
-            displpureatoms = mapping.mix2pure(displmixatoms)
-            displpureatoms = pinpos.reorder_atoms(pureatoms, displpureatoms)
-            puretotaldispl = displpureatoms.get_positions() - pureposns
-            
-            # Check that exactly one ion is displaced per perturbed cell
-            displions = []
-            for i in range(pureions):
-                displmagnitude = np.linalg.norm(puretotaldispl[i, :])
-                if displmagnitude > postol:
-                    displions.append(i)
-            if len(displions) > 1:
-                raise IndexError('The following ions were all displaced by '
-                                 + 'more than ' + str(postol) + ': '
-                                 + ' '.join([str(i) for i in displions]))
-            elif not displions:
-                raise IndexError('No ions were found to be displaced by '
-                                 + 'more than ' + str(postol))
-            displion = displions[0]
-            
-            # Extract (pure) forces and construct first_atoms_list
-            # this list is later fed to construct displacement_dataset
-            displmixforces = displmix.get_forces()
-            displpureforces = mapping.mix2pure_forces(displmixforces)
-            first_atoms_dict = {}
-            first_atoms_dict['number'] = displion
-            first_atoms_dict['displacement'] = puretotaldispl[displion, :]
-            first_atoms_dict['forces'] = displpureforces
-            first_atoms_list += [first_atoms_dict]
+        state = {'mapping': mapping, 'pureatoms': pureatoms, 'postol': postol}
+        if cache:
+            # Gaps in the numbering are reported as missing displacements
+            Ndispls = max(displindices) + 1 if displindices else 0
+            store = forceset(casfile, postol=postol)
+            store.update(Ndispls, state, method=2, nprocs=nprocs,
+                         verbose=verbose)
+            first_atoms_list = store.first_atoms(Ndispls)
+        else:
+            Ndispls = len(displcasfiles)
+            # Files are processed in displacement order (not glob order)
+            displcasfiles = [chem+'_'+str(d)+'.castep'
+                             for d in range(Ndispls)]
+            first_atoms_list = map_displs(read_displacement, displcasfiles,
+                                          state, nprocs=nprocs,
+                                          verbose=verbose)
             
         # Now construct displacement_dataset (for all perturbations)
         displacement_dataset = {}
@@ -159,6 +443,34 @@ def calc_phonons(casfile, supercell='Gamma', method=2, postol=0.001,
         displacement_dataset['first_atoms'] = first_atoms_list
         PhononObj.set_displacement_dataset(displacement_dataset)
     # End of Method 2
+
+    elif method == 3:
+        """ The displacements are listed in the manifest, so only the forces
+        need to be read (no matching of displaced structures to the parent).
+        """
+        displacements = manifest['displacements']
+        Ndispls = len(displacements)
+        if cache:
+            store = forceset(casfile, postol=postol)
+            store.update(Ndispls, {'mapping': mapping}, method=1,
+                         nprocs=nprocs, verbose=verbose)
+            sets_of_forces = store.forces(Ndispls)
+        else:
+            displcasfiles = [chem+'_'+str(displ['index'])+'.castep'
+                             for displ in displacements]
+            sets_of_forces = map_displs(read_forces, displcasfiles,
+                                        {'mapping': mapping}, nprocs=nprocs,
+                                        verbose=verbose)
+        first_atoms_list = []
+        for displ, forces in zip(displacements, sets_of_forces):
+            first_atoms_list += [{'number': displ['atom'],
+                                  'displacement':
+                                  np.array(displ['displacement']),
+                                  'forces': np.array(forces)}]
+        displacement_dataset = {}
+        displacement_dataset['natom'] = manifest['natom']
+        displacement_dataset['first_atoms'] = first_atoms_list
+        PhononObj.set_displacement_dataset(displacement_dataset)
     
     # Forces & displacements are now set so may compute the force constants
     if verbose:
@@ -171,10 +483,402 @@ def calc_phonons(casfile, supercell='Gamma', method=2, postol=0.001,
     PhononObj.set_force_constants(FCs)
     # Force constants at this point ALREADY obey the ASR near perfectly
     # (i.e. columns/rows sum to zero)
+    if fcfile is not None:
+        save_phonons(PhononObj, fcfile, mapping=primmapping)
+    return PhononObj
+
+
+def calc_phonons(casfile, supercell='Gamma', method=None, postol=0.001,
+                 bands=None, verbose=False, nprocs=1, cache=False,
+                 fcfile=None, symprec=None, distance=None):
+    """ Compute phonons from completed singlepoint CASTEP calculations of
+    perturbations about a relaxed cell.
+    Note that this function assumes that the perturbed files are in the
+    same directory and use the same naming convention as the parent.
+
+    str casfile : filename (incl. path) to .castep file to compute phonons of
+    np.array(3, 3) supercell : size of real space supercell dictates k-points
+    If supercell is 'Gamma', only unit cell displacements are created.
+    Otherwise the displaced files are mixed supercells (see mixmap.tile).
+    int method : can be 1 (regenerate displacements and assume the same),
+    2 (process all castep files that follow displacement naming convention)
+    or 3 (take displacements from the manifest written by gen_perturbations).
+    If None, 3 is used if a manifest exists, otherwise 2.
+    float postol : Tolerance (Ang) when ion considered displaced (2 only)
+    np.array() bands : k-points to compute frequencies at
+    bool verbose : function can take a while to run -> prints checkpoints.
+    int nprocs : number of processes used to read the displacement files
+    bool cache : if True keep a forceset store (chem_forceset.json) so that
+    repeated calls only read new or changed displacement files, and save the
+    force constants to chem_phonons.npz (see load_phonons)
+    str fcfile : save the force constants to this file instead
+    float symprec : phonopy symmetry tolerance and float distance :
+    displacement (Ang, method 1), both as given to gen_perturbations. If None
+    they are taken from the manifest, or gen_perturbations' defaults
     
+    returns
+    tuple (q_points, distances, frequencies, eigvecs) : output of
+    phonopy_instance.get_band_structure() command.
+    These are all lists of lists of np.arrays, where the relavent entry of
+    frequencies is a list of freqs (in cm-1) of the form np.array(3*phonions)
+    and the relevant entry of eigvecs is a matrix of phonon eigenvectors of 
+    the form np.array(3*phonions, 3*phonions). """
+    if isinstance(supercell, str) and supercell == 'Gamma':
+        bands = [np.array([0.0])]
+    PhononObj = build_phonons(casfile, supercell=supercell, method=method,
+                              postol=postol, verbose=verbose, nprocs=nprocs,
+                              cache=cache, fcfile=fcfile, symprec=symprec,
+                              distance=distance)
+
     # Compute frequencies from dynamical matrix
     if verbose:
         print("\nDiagonalising dynamical matrix")
     PhononObj.set_band_structure(bands, is_eigenvectors=True)
     return PhononObj.get_band_structure()
 
+
+
+def gamma_phonons(force_constants, masses, factor=phonopy.units.VaspToCm,
+                  eigvecs=True):
+    """ Gamma-point phonons straight from unit cell force constants (no
+    phonopy band structure), for one or a stack of force constant sets
+
+    np.array([Nsets,] N, N, 3, 3) force_constants : Gamma-point (unit cell)
+    force constants, e.g. PhononObj.force_constants or fcinterp predictions
+    np.array([Nsets,] N) masses : mass of each pure site (mixmap.puremasses)
+    float factor : conversion of sqrt(eigenvalues) to frequencies (cm-1)
+    bool eigvecs : if False eigenvectors are not computed
+
+    returns
+    np.array([Nsets,] 3N) freqs : frequencies (imaginary as negative)
+    np.array([Nsets,] 3N, 3N) eigvecs : eigenvectors (columns), only
+    returned if eigvecs """
+    fcs = np.asarray(force_constants, dtype=float)
+    if fcs.ndim < 4 or fcs.shape[-2:] != (3, 3):
+        raise ValueError('Force constants must have shape ([Nsets,] N, N, 3, '
+                         + '3), not ' + str(fcs.shape))
+    N = fcs.shape[-3]
+    if fcs.shape[-4] != N:
+        raise ValueError('Force constants are not those of a single cell ('
+                         + str(fcs.shape[-4]) + ' by ' + str(N) + ' atoms)')
+    if np.ndim(masses) == 0 or np.shape(masses)[-1] != N:
+        raise ValueError('Need a mass for each of the ' + str(N) + ' atoms of '
+                         + 'the force constants, not masses of shape '
+                         + str(np.shape(masses)))
+    # (..., i, j, a, b) -> (..., 3i+a, 3j+b) and mass weight
+    dynmats = np.swapaxes(fcs, -3, -2).reshape(fcs.shape[:-4] + (3*N, 3*N))
+    m3 = np.repeat(np.asarray(masses, dtype=float), 3, axis=-1)
+    invroot = 1.0/np.sqrt(m3)
+    dynmats = dynmats*invroot[..., :, None]*invroot[..., None, :]
+    dynmats = (dynmats + np.swapaxes(dynmats, -1, -2))/2
+    if eigvecs:
+        eigvals, vecs = np.linalg.eigh(dynmats)
+        return mode_frequencies(eigvals, factor), vecs
+    return mode_frequencies(np.linalg.eigvalsh(dynmats), factor)
+
+
+def calc_gamma(casfile, method=None, postol=0.001, verbose=False, nprocs=1,
+               cache=False, fcfile=None, eigvecs=True, symprec=None,
+               distance=None):
+    """ Gamma-point phonons from completed singlepoint CASTEP calculations
+    (as calc_phonons with supercell='Gamma') by direct diagonalisation of the
+    mass weighted force constants (see gamma_phonons)
+
+    returns
+    np.array(3*pureions) freqs : frequencies (cm-1)
+    np.array(3*pureions, 3*pureions) eigvecs : eigenvectors (columns), only
+    returned if eigvecs """
+    PhononObj = build_phonons(casfile, supercell='Gamma', method=method,
+                              postol=postol, verbose=verbose, nprocs=nprocs,
+                              cache=cache, fcfile=fcfile, symprec=symprec,
+                              distance=distance)
+    return gamma_phonons(PhononObj.force_constants,
+                         PhononObj.primitive.get_masses(),
+                         factor=PhononObj.unit_conversion_factor,
+                         eigvecs=eigvecs)
+
+
+def irreducible_qpoints(PhononObj, mesh, shift=None, symmetry=True):
+    """ Irreducible q-points of a (Gamma centred) Monkhorst-Pack mesh
+
+    phonopy.Phonopy PhononObj : phonopy instance
+    list mesh : number of q-points along each reciprocal lattice vector
+    list shift : shift of the mesh (fractions of a mesh step)
+    bool symmetry : if False the full mesh is returned
+
+    returns
+    np.array(Nq, 3) qpoints : fractional q-points
+    np.array(Nq) weights : normalised weights (sum to one) """
+    from phonopy.structure.grid_points import GridPoints
+    primitive = PhononObj.primitive
+    rotations = PhononObj.primitive_symmetry.get_pointgroup_operations()
+    grid = GridPoints(np.array(mesh, dtype=int),
+                      np.linalg.inv(primitive.get_cell()),
+                      q_mesh_shift=shift, rotations=rotations,
+                      is_mesh_symmetry=symmetry)
+    weights = np.array(grid.weights, dtype=float)
+    return np.array(grid.qpoints), weights/weights.sum()
+
+
+def mode_frequencies(eigvals, factor=phonopy.units.VaspToCm):
+    """ returns
+    np.array freqs : frequencies (imaginary as negative) from eigenvalues of
+    dynamical matrices """
+    return np.sign(eigvals)*np.sqrt(np.abs(eigvals))*factor
+
+
+def thermal_properties(freqs, weights, temperatures, fmin=1.0):
+    """ Harmonic thermal properties of a set of modes
+
+    np.array(Nq, Nmodes) freqs : frequencies (cm-1)
+    np.array(Nq) weights : weight of each q-point (normalised over the mesh)
+    np.array(NT) temperatures : temperatures (K)
+    float fmin : modes below this frequency (cm-1) are ignored
+
+    returns
+    tuple (free_energy, entropy, heat_capacity) : np.array(NT) each, in
+    kJ/mol, J/K/mol and J/K/mol (per mole of unit cells) """
+    units = phonopy.units
+    wts = np.broadcast_to(np.asarray(weights)[:, None], freqs.shape)
+    keep = freqs > fmin
+    E = freqs[keep]*units.CmToEv  # eV
+    wts = wts[keep]
+    T = np.asarray(temperatures, dtype=float)
+    F = np.zeros(len(T)) + np.dot(wts, E/2)  # zero point energy
+    S = np.zeros(len(T))
+    Cv = np.zeros(len(T))
+    hot = T > 0
+    if hot.any():
+        kT = units.Kb*T[hot]
+        x = E[:, None]/kT[None, :]
+        expm = np.exp(-x)
+        F[hot] += np.dot(wts, kT[None, :]*np.log1p(-expm))
+        S[hot] = units.Kb*np.dot(wts, x*expm/(1.0 - expm) - np.log1p(-expm))
+        Cv[hot] = units.Kb*np.dot(wts, x**2*expm/(1.0 - expm)**2)
+    mol = units.EV*units.Avogadro
+    return F*mol/1000.0, S*mol, Cv*mol
+
+
+def mesh_phonons(PhononObj, mesh, prefix, temperatures=None, shift=None,
+                 symmetry=True, chunksize=64, eigvecs=True, binwidth=1.0,
+                 sigma=None, fmin=1.0, verbose=False):
+    """ Phonon DOS and thermal properties on a dense q-mesh. Dynamical
+    matrices are built and diagonalised a chunk of q-points at a time and
+    the frequencies and eigenvectors streamed to memory-mapped .npy files,
+    and the thermal properties and DOS are summed a chunk at a time, so only
+    one chunk of frequencies and eigenvectors is ever held in memory.
+
+    phonopy.Phonopy PhononObj : phonopy instance with force constants set
+    list mesh : q-mesh (number of q-points along each reciprocal vector)
+    str prefix : files prefix_qpoints.npy, prefix_weights.npy,
+    prefix_freqs.npy (Nq, Nmodes) and prefix_eigvecs.npy (Nq, Nmodes, Nmodes)
+    are written (eigenvectors are columns, as numpy.linalg.eigh)
+    np.array temperatures : (K) default 0, 10, ... 1000
+    list shift : mesh shift; bool symmetry : irreducible q-points only
+    int chunksize : number of q-points diagonalised at once
+    bool eigvecs : if False eigenvectors are not written
+    float binwidth : DOS bin width (cm-1)
+    float sigma : if given, Gaussian smearing width (cm-1) of the DOS
+    float fmin : modes below this frequency (cm-1) are left out of the
+    thermal properties
+
+    returns
+    tuple (dos_freqs, dos, temperatures, free_energy, entropy, heat_capacity)
+    : DOS (states per cm-1 per unit cell) at frequencies dos_freqs and
+    thermal properties (see thermal_properties) at temperatures """
+    if temperatures is None:
+        temperatures = np.arange(0.0, 1001.0, 10.0)
+    qpoints, weights = irreducible_qpoints(PhononObj, mesh, shift=shift,
+                                           symmetry=symmetry)
+    np.save(prefix+'_qpoints.npy', qpoints)
+    np.save(prefix+'_weights.npy', weights)
+    Nq = len(qpoints)
+    Nmodes = 3*len(PhononObj.primitive.get_masses())
+    freqs = np.lib.format.open_memmap(prefix+'_freqs.npy', mode='w+',
+                                      dtype=float, shape=(Nq, Nmodes))
+    if eigvecs:
+        vecs = np.lib.format.open_memmap(prefix+'_eigvecs.npy', mode='w+',
+                                         dtype=complex,
+                                         shape=(Nq, Nmodes, Nmodes))
+    dynmat = PhononObj.dynamical_matrix
+    factor = PhononObj.unit_conversion_factor
+    # Thermal properties are sums over modes, so are accumulated per chunk
+    NT = len(temperatures)
+    F, S, Cv = np.zeros(NT), np.zeros(NT), np.zeros(NT)
+    lowest, highest = np.inf, -np.inf
+    for c in range(0, Nq, chunksize):
+        chunk = qpoints[c:c+chunksize]
+        dms = np.zeros((len(chunk), Nmodes, Nmodes), dtype=complex)
+        for i, q in enumerate(chunk):
+            dynmat.run(q)
+            dms[i] = dynmat.dynamical_matrix
+        if eigvecs:
+            eigvals, vecs[c:c+len(chunk)] = np.linalg.eigh(dms)
+        else:
+            eigvals = np.linalg.eigvalsh(dms)
+        chunkfreqs = mode_frequencies(eigvals, factor)
+        freqs[c:c+len(chunk)] = chunkfreqs
+        lowest = min(lowest, chunkfreqs.min())
+        highest = max(highest, chunkfreqs.max())
+        f, s, cv = thermal_properties(chunkfreqs, weights[c:c+len(chunk)],
+                                      temperatures, fmin=fmin)
+        F += f
+        S += s
+        Cv += cv
+        if verbose:
+            progress(min(c+chunksize, Nq), Nq, 'diagonalised q-point')
+    freqs.flush()
+    if eigvecs:
+        vecs.flush()
+        del vecs
+
+    # DOS, a chunk of the (memory-mapped) frequencies at a time
+    edges = np.arange(np.floor(lowest/binwidth)*binwidth - binwidth,
+                      highest + 2*binwidth, binwidth)
+    dos_freqs = (edges[1:] + edges[:-1])/2
+    dos = np.zeros(len(dos_freqs))
+    for c in range(0, Nq, chunksize):
+        f = np.ravel(freqs[c:c+chunksize])
+        w = np.repeat(weights[c:c+chunksize], Nmodes)
+        if sigma is None:
+            dos += np.histogram(f, bins=edges, weights=w)[0]/binwidth
+        else:
+            gauss = np.exp(-0.5*((dos_freqs[None, :] - f[:, None])/sigma)**2)
+            dos += np.dot(w, gauss)/(sigma*np.sqrt(2*np.pi))
+    return dos_freqs, dos, np.asarray(temperatures), F, S, Cv
+
+
+def calc_mesh(casfile, mesh, supercell='Gamma', method=None, postol=0.001,
+              verbose=False, nprocs=1, cache=False, fcfile=None, prefix=None,
+              symprec=None, distance=None, **kwargs):
+    """ Phonon DOS and thermal properties on a dense q-mesh from completed
+    singlepoint CASTEP calculations (see calc_phonons and mesh_phonons)
+
+    list mesh : q-mesh (number of q-points along each reciprocal vector)
+    str prefix : prefix of the .npy files written (default chem+'_mesh')
+    kwargs : passed on to mesh_phonons (temperatures, chunksize etc.)
+
+    returns
+    tuple (dos_freqs, dos, temperatures, free_energy, entropy, heat_capacity)
+    """
+    if prefix is None:
+        prefix = casfile.replace('.castep', '') + '_mesh'
+    PhononObj = build_phonons(casfile, supercell=supercell, method=method,
+                              postol=postol, verbose=verbose, nprocs=nprocs,
+                              cache=cache, fcfile=fcfile, symprec=symprec,
+                              distance=distance)
+    return mesh_phonons(PhononObj, mesh, prefix, verbose=verbose, **kwargs)
+
+
+def save_phonons(PhononObj, fcfile, mapping=None):
+    """ Save force constants with the pure structure (and the mixmap it was
+    made with) to a compressed .npz file, to be read by load_phonons
+
+    phonopy.Phonopy PhononObj : phonopy instance with force constants set
+    str fcfile : .npz file to write
+    mixmap.mixmap mapping : mapping of the (primitive) mixed structure """
+    unitcell = PhononObj.unitcell
+    data = {'force_constants': PhononObj.force_constants,
+            'cell': np.array(unitcell.get_cell()),
+            'positions': np.array(unitcell.get_positions()),
+            'symbols': np.array(unitcell.get_chemical_symbols()),
+            'masses': np.array(unitcell.get_masses()),
+            'supercell': np.array(PhononObj.supercell_matrix),
+            'factor': PhononObj.unit_conversion_factor}
+    if mapping is not None:
+        mixpure = np.zeros(mapping.mixions, dtype=int)
+        mixwts = np.zeros(mapping.mixions)
+        for p in range(mapping.pureions):
+            for elem, (wt, j) in mapping.pure2mix_map[p].items():
+                mixpure[j] = p
+                mixwts[j] = wt
+        data['mixelems'] = np.array(mapping.mixelems)
+        data['mixmasses'] = np.array(mapping.mixmasses)
+        data['mixpure'] = mixpure
+        data['mixwts'] = mixwts
+    tmp = fcfile + '.tmp.npz'
+    np.savez_compressed(tmp, **data)
+    os.replace(tmp, fcfile)
+
+
+def load_phonons(fcfile):
+    """ returns
+    fcset phonons : force constants saved by save_phonons (or calc_phonons
+    with cache=True), ready to give frequencies at any q-point """
+    return fcset(fcfile)
+
+
+class fcset():
+    """ Saved force constants of a (pure) structure, for fast re-query of
+    phonon frequencies and eigenvectors (no .castep files are read) """
+
+    def __init__(self, fcfile=None, data=None):
+        """
+        str fcfile : .npz file written by save_phonons
+        dict data : the arrays of such a file (instead of fcfile)
+        """
+        if fcfile is not None:
+            with np.load(fcfile) as data:
+                data = {key: data[key] for key in data.files}
+        self.data = data
+        self.force_constants = self.data['force_constants']
+        self.supercell = self.data['supercell']
+        self.masses = self.data['masses']
+        self.pureatoms = ase.Atoms(symbols=[str(elem) for elem in
+                                            self.data['symbols']],
+                                   positions=self.data['positions'],
+                                   cell=self.data['cell'],
+                                   masses=self.masses, pbc=True)
+        if 'mixelems' in self.data:
+            self.mixelems = [str(elem) for elem in self.data['mixelems']]
+            self.mixpure = self.data['mixpure']
+            self.mixwts = self.data['mixwts']
+        self.PhononObj = None
+
+    def phonopy(self):
+        """ returns
+        phonopy.Phonopy PhononObj : phonopy instance with the force constants
+        (made once, without a symmetry search) """
+        if self.PhononObj is None:
+            self.PhononObj = phonopy.Phonopy(self.pureatoms, self.supercell,
+                                             factor=float(self.data['factor']),
+                                             is_symmetry=False)
+            self.PhononObj.force_constants = self.force_constants
+        return self.PhononObj
+
+    def frequencies(self, qpoints, eigvecs=True):
+        """ Frequencies (and eigenvectors) at arbitrary q-points
+
+        np.array(Nq, 3) qpoints : fractional q-points
+
+        returns
+        np.array(Nq, Nmodes) freqs : frequencies (cm-1, imaginary negative)
+        np.array(Nq, Nmodes, Nmodes) eigvecs : eigenvectors (columns), only
+        returned if eigvecs """
+        qpoints = np.reshape(qpoints, (-1, 3))
+        dynmat = self.phonopy().dynamical_matrix
+        Nmodes = 3*len(self.masses)
+        dms = np.zeros((len(qpoints), Nmodes, Nmodes), dtype=complex)
+        for i, q in enumerate(qpoints):
+            dynmat.run(q)
+            dms[i] = dynmat.dynamical_matrix
+        factor = float(self.data['factor'])
+        if eigvecs:
+            eigvals, vecs = np.linalg.eigh(dms)
+            return mode_frequencies(eigvals, factor), vecs
+        return mode_frequencies(np.linalg.eigvalsh(dms), factor)
+
+    def gamma(self, eigvecs=True):
+        """ Gamma-point frequencies (and eigenvectors) by direct
+        diagonalisation (unit cell force constants only, see gamma_phonons)
+        """
+        return gamma_phonons(self.force_constants, self.masses,
+                             factor=float(self.data['factor']),
+                             eigvecs=eigvecs)
+
+    def mesh(self, mesh, prefix, **kwargs):
+        """ DOS and thermal properties on a q-mesh (see mesh_phonons) """
+        PhononObj = phonopy.Phonopy(self.pureatoms, self.supercell,
+                                    factor=float(self.data['factor']))
+        PhononObj.force_constants = self.force_constants
+        return mesh_phonons(PhononObj, mesh, prefix, **kwargs)
@@ -4,6 +4,10 @@ import sys
 import mixmap
 import readmixcastep as rc
 import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+from scipy.spatial import cKDTree
 
 """
 Reads two cell files and ensures that the positions in the second are close
@@ -11,74 +15,202 @@ to those in the first.
 """
 
 
-def reorder_atoms(fixatoms, pinchatoms):
-    """ Reorder pinchatoms (i.e. accounting for PBCs) to match fixatoms
-    Note: this only works for pure atomic structures (no mixed atoms) """
+# Lattice translations of the 27 neighbouring cells
+images = np.array([[h, k, l] for h in [-1, 0, 1] for k in [-1, 0, 1]
+                   for l in [-1, 0, 1]])
+
+
+def closest_images(fixposns, posns, cell):
+    """ Closest periodic images of posns[i] to fixposns[i] (vectorised
+    mixmap.mixmap.closestimage)
+
+    np.array(N, 3) fixposns, posns : absolute coordinates
+    np.array(3, 3) cell : unit cell vectors
+
+    returns
+    np.array(N, 3) imageposns : closest image of each of posns
+    np.array(N) dists : distance of each to fixposns """
+    cell = np.array(cell)
+    diff = np.dot(np.asarray(posns) - np.asarray(fixposns),
+                  np.linalg.inv(cell))
+    diff -= np.round(diff)
+    cands = np.dot(diff[:, None, :] + images[None, :, :], cell)
+    dists = np.linalg.norm(cands, axis=2)
+    best = np.argmin(dists, axis=1)
+    rows = np.arange(len(best))
+    return fixposns + cands[rows, best], dists[rows, best]
+
+
+def distance_matrix(fixposns, posns, cell, chunksize=None):
+    """ returns
+    np.array(Nfix, N) dists : minimum image distance between every pair of
+    fixposns and posns (computed in chunks of fixposns) """
+    fixposns = np.asarray(fixposns)
+    posns = np.asarray(posns)
+    cell = np.array(cell)
+    inv = np.linalg.inv(cell)
+    if chunksize is None:
+        chunksize = max(1, 2000000//(27*max(1, len(posns))))
+    dists = np.zeros((len(fixposns), len(posns)))
+    shifts = np.dot(images, cell)
+    for start in range(0, len(fixposns), chunksize):
+        diff = np.dot(posns[None, :, :] -
+                      fixposns[start:start+chunksize, None, :], inv)
+        diff = np.dot(diff - np.round(diff), cell)
+        cands = diff[:, :, None, :] + shifts[None, None, :, :]
+        dists[start:start+chunksize] = np.sqrt(
+            np.min(np.sum(cands**2, axis=3), axis=2))
+    return dists
+
+
+def candidate_pairs(fixposns, posns, cell, k):
+    """ Sparse minimum image distances to the k nearest posns of each of
+    fixposns, from a KD-tree of the 27 neighbouring images of posns
+
+    returns
+    tuple (rows, cols, dists) : candidate pairs and their distances """
+    cell = np.array(cell)
+    N = len(posns)
+    fracs = np.dot(np.asarray(posns), np.linalg.inv(cell)) % 1.0
+    imageposns = np.dot((fracs[None, :, :] + images[:, None, :])
+                        .reshape(-1, 3), cell)
+    tree = cKDTree(imageposns)
+    dists, idx = tree.query(fixposns, k=min(k, len(imageposns)))
+    rows = np.repeat(np.arange(len(fixposns)), dists.shape[1])
+    cols = idx.ravel() % N
+    dists = dists.ravel()
+    # Keep the closest image of each (row, col) pair only
+    order = np.lexsort((dists, cols, rows))
+    rows, cols, dists = rows[order], cols[order], dists[order]
+    first = np.unique(rows*N + cols, return_index=True)[1]
+    return rows[first], cols[first], dists[first]
+
+
+def assign_atoms(fixatoms, pinchatoms, match_elems=False, dense_max=3000):
+    """ Optimal one-to-one assignment of pinchatoms to fixatoms, minimising
+    the sum of the (minimum image) distances between matched atoms
+
+    ase.Atoms fixatoms, pinchatoms : structures with the same number of atoms
+    bool match_elems : only match atoms of the same element
+    int dense_max : above this many atoms, candidate pairs come from a
+    neighbour search (KD-tree) and a sparse assignment is solved (a
+    ValueError is raised if the neighbours admit no full assignment)
+
+    returns
+    np.array(N) perm : pinchatoms[perm[i]] is matched to fixatoms[i]
+    np.array(N, 3) posns : closest image of each matched atom to fixatoms """
     N = len(fixatoms)
     if len(pinchatoms) != N:
         raise ValueError('Low symmetry structure has different number of ' +
                          'atoms to high-symmetry strucutre.')
-    pinchposns = pinchatoms.get_positions()
     fixposns = fixatoms.get_positions()
-    fixelems = fixatoms.get_chemical_symbols()
-    cell = pinchatoms.get_cell()
-    # For the moment I won't match elems
-    pinchposnew = np.zeros((N, 3))
-    for i, fixpos in enumerate(fixposns):
-        ds = np.zeros((N))
-        for j, jpos in enumerate(pinchposns):
-            bprime, dist = mixmap.mixmap.closestimage(fixpos, jpos, cell,
-                                                      rtn_dist=True)
-            ds[j] = dist
-        j = np.where(ds == min(ds))[0][0]
-        pinchposnew[i, :] = mixmap.mixmap.closestimage(fixpos, pinchposns[j],
-                                                       cell, rtn_dist=False)
-    pinchatoms.set_chemical_symbols(fixelems)
-    pinchatoms.set_positions(pinchposnew)
+    pinchposns = pinchatoms.get_positions()
+    cell = np.array(pinchatoms.get_cell())
+    if match_elems:
+        fixelems = np.array(fixatoms.get_chemical_symbols())
+        pinchelems = np.array(pinchatoms.get_chemical_symbols())
+    perm = None
+    if N > dense_max:
+        k = 8
+        while k < N and perm is None:
+            rows, cols, dists = candidate_pairs(fixposns, pinchposns, cell,
+                                                k)
+            if match_elems:
+                same = fixelems[rows] == pinchelems[cols]
+                rows, cols, dists = rows[same], cols[same], dists[same]
+            # Every full matching has N edges, so a constant offset keeps
+            # zero distances as explicit entries without changing the optimum
+            graph = csr_matrix((dists + 1.0, (rows, cols)), shape=(N, N))
+            try:
+                perm = min_weight_full_bipartite_matching(graph)[1]
+            except ValueError:
+                k *= 4  # too few candidates for a full matching
+        if perm is None:
+            # The dense N x N distance matrix is too big to fall back on
+            raise ValueError('No full assignment of the ' + str(N) + ' atoms'
+                             + ' between near neighbours; the structures '
+                             + 'may differ too much or not have the same '
+                             + 'number of atoms of each element (raise '
+                             + 'dense_max to solve the dense problem).')
+    if perm is None:
+        dists = distance_matrix(fixposns, pinchposns, cell)
+        if match_elems:
+            dists[fixelems[:, None] != pinchelems[None, :]] = np.inf
+        try:
+            perm = linear_sum_assignment(dists)[1]
+        except ValueError:
+            raise ValueError('The structures do not have the same number '
+                             + 'of atoms of each element.')
+    posns, dists = closest_images(fixposns, pinchposns[perm], cell)
+    return np.array(perm), posns
+
+
+def reorder_atoms(fixatoms, pinchatoms, rtn_perm=False, match_elems=False):
+    """ Reorder pinchatoms (i.e. accounting for PBCs) to match fixatoms, each
+    atom of pinchatoms being matched to exactly one of fixatoms (optimal
+    assignment, see assign_atoms)
+    Note: this only works for pure atomic structures (no mixed atoms)
+
+    bool rtn_perm : also return the permutation (pinchatoms[perm[i]], in
+    the original order, now matches fixatoms[i])
+    bool match_elems : only match atoms of the same element """
+    perm, posns = assign_atoms(fixatoms, pinchatoms, match_elems=match_elems)
+    pinchatoms.set_chemical_symbols(fixatoms.get_chemical_symbols())
+    pinchatoms.set_positions(posns)
+    if rtn_perm:
+        return pinchatoms, perm
     return pinchatoms
 
 
-##########################################################################
+def pinch(cellfile0, cellfile1):
+    """ Pinch the second cell to match the first: reorder its (pure) atoms
+    to be closest to those of the first and overwrite it
 
-if __name__ == '__main__':
-    """ Run from the command line, pinch the second cell to match the first """
-    cellfile0 = sys.argv[1]
-    cellfile1 = sys.argv[2]
+    str cellfile0 : fixed .cell or .castep file
+    str cellfile1 : .cell file to pinch (overwritten)
 
+    returns
+    str cellfile1 : file written """
     # Load the fixed cell (incl generating pure structure)
     if '.cell' in cellfile0:
         mix0 = rc.readcell(cellfile0)
     elif '.castep' in cellfile0:
         mix0 = rc.readcas(cellfile0)
+    else:
+        raise ValueError(cellfile0 + ' is not a .castep or .cell file.')
     mixatoms0 = mix0.extract_struc()
     mixkey0 = mix0.get_mixkey()
     mapping0 = mixmap.mixmap(mixatoms0, mixkey0)
     pureatoms0 = mapping0.mix2pure(mixatoms0)
-    posns0 = pureatoms0.get_positions()
-    Nions = len(pureatoms0)
-    
+
     # Load the cell to be pinched (incl generating pure structure)
     mix1 = rc.readcell(cellfile1)
     mixatoms1 = mix1.extract_struc()
     mixkey1 = mix1.get_mixkey()
     mapping1 = mixmap.mixmap(mixatoms1, mixkey1)
     pureatoms1 = mapping1.mix2pure(mixatoms1)
-    posns1 = pureatoms1.get_positions()
-    cell1 = pureatoms1.get_cell()
-    
+
     # Load calculation params for the second cell (for writing new cell file)
     spins = mix1.get_init_spin()
     kpoints, offset = mix1.get_kpoints()
     constrs = mix1.get_cell_constrs()
     psps = mix1.get_psps()
     pressure = mix1.get_ext_press()
-    
+
     # Reorder the positions of the pure structure
     pureatoms1 = reorder_atoms(pureatoms0, pureatoms1)
-    
+
     # Transform back to the mixed structure and write the cell file
     mixatoms1 = mapping1.pure2mix(pureatoms1)
     mapping1.setcellparams(pseudos=psps, kpoints=kpoints,
                            kpoints_offset=offset, spins=spins,
                            pressure=pressure, cell_constrs=constrs)
     mapping1.casprint(mixatoms1, cellfile1)
+    return cellfile1
+
+
+##########################################################################
+
+if __name__ == '__main__':
+    """ Run from the command line, pinch the second cell to match the first """
+    pinch(sys.argv[1], sys.argv[2])
@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import time
+import atexit
+import inspect
+import functools
+import importlib
+from contextlib import contextmanager
+
+"""
+Opt-in profiling of the hot paths of readmixcastep, mixmap and strindices:
+call counts, cumulative wall time and lines scanned of every public method of
+readcas, readcell and mixmap and of strindex/strindices, e.g.
+
+with profiling.profile() as stats:
+    cas = readmixcastep.readcas('big.castep')
+    cas.get_mixkey()
+print(profiling.table(stats))
+
+or for a whole script (the summary is written when Python exits):
+
+VCA_PROFILE=1 python script.py          (table on stderr)
+VCA_PROFILE=prof.json python script.py  (JSON, any other name gets the table)
+
+The methods are only wrapped while profiling is on (the originals are put
+back by disable), so there is no overhead otherwise. Times and lines are
+inclusive: a method is credited with the time of everything it calls and
+with every line scanned by the strindex/strindices calls made within it (the
+constructors are also credited with the lines of the file they read). Work
+done in other processes (e.g. nprocs > 1) is not recorded.
+"""
+
+envvar = 'VCA_PROFILE'
+
+# Classes (all public methods and __init__) and functions to instrument
+targets = {'readmixcastep': ['readcas', 'readcell'],
+           'mixmap': ['mixmap'],
+           'strindices': ['strindex', 'strindices']}
+
+stats = {}      # {name: {'calls': int, 'seconds': float, 'lines': int}}
+_stack = []     # stats entries of the calls in progress
+_originals = {}  # {(owner, attribute): original} of instrumented attributes
+_atexit = []    # destinations of the summary written at exit
+
+
+def scan_length(signature, args, kwargs, result):
+    """ returns
+    int lines : number of lines a strindex/strindices call (with the given
+    inspect.Signature) scans: its [nmin:nmax] range, or up to the match for
+    strindex with first=True (which stops there) """
+    params = signature.bind(*args, **kwargs)
+    params.apply_defaults()
+    params = params.arguments
+    nmax = len(params['flist'])
+    if params['nmax'] is not None:
+        nmax = min(nmax, params['nmax'])
+    if params.get('first') and result is not None:
+        nmax = min(nmax, result + 1)
+    return max(0, nmax - params['nmin'])
+
+
+def file_length(args, kwargs, result):
+    """ returns
+    int lines : number of lines read by a readcas/readcell constructor """
+    return getattr(args[0], 'Nlines', 0)
+
+
+def entry(name):
+    """ returns
+    dict entry : statistics of name (created if needed) """
+    if name not in stats:
+        stats[name] = {'calls': 0, 'seconds': 0.0, 'lines': 0}
+    return stats[name]
+
+
+def wrap(func, name, lines=None):
+    """ returns
+    function wrapper : func, recording its calls, time and lines scanned
+    (lines(args, kwargs, result) if given) in stats[name] """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        record = entry(name)
+        record['calls'] += 1
+        _stack.append(record)
+        start = time.perf_counter()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+            return result
+        finally:
+            record['seconds'] += time.perf_counter() - start
+            _stack.pop()
+            if lines is not None:
+                Nlines = lines(args, kwargs, result)
+                # Credit the lines to this call and to every caller
+                for caller in {id(r): r for r in _stack + [record]}.values():
+                    caller['lines'] += Nlines
+    return wrapper
+
+
+def instrument(module):
+    """ Wrap the targets of a module (see targets), once """
+    for target in targets.get(module.__name__, []):
+        obj = getattr(module, target)
+        if isinstance(obj, type):
+            for attr, raw in list(vars(obj).items()):
+                if attr.startswith('_') and attr != '__init__':
+                    continue
+                if (obj, attr) in _originals:
+                    continue
+                name = target + '.' + attr
+                lines = file_length if attr == '__init__' else None
+                if isinstance(raw, staticmethod):
+                    wrapped = staticmethod(wrap(raw.__func__, name, lines))
+                elif isinstance(raw, classmethod):
+                    wrapped = classmethod(wrap(raw.__func__, name, lines))
+                elif callable(raw):
+                    wrapped = wrap(raw, name, lines)
+                else:
+                    continue
+                _originals[(obj, attr)] = raw
+                setattr(obj, attr, wrapped)
+        elif (module, target) not in _originals:
+            _originals[(module, target)] = obj
+            setattr(module, target, wrap(
+                obj, module.__name__ + '.' + target,
+                functools.partial(scan_length, inspect.signature(obj))))
+
+
+def enable():
+    """ Start profiling (instrument every target module)
+
+    returns
+    dict stats : statistics, updated as instrumented code runs """
+    for modulename in targets:
+        instrument(importlib.import_module(modulename))
+    return stats
+
+
+def disable():
+    """ Stop profiling (restore the original functions and methods) """
+    for (owner, attr), raw in list(_originals.items()):
+        setattr(owner, attr, raw)
+    _originals.clear()
+
+
+def enabled():
+    """ returns
+    bool enabled : True if any target is instrumented """
+    return bool(_originals)
+
+
+def reset():
+    """ Forget the statistics recorded so far """
+    stats.clear()
+
+
+def summary(data=None):
+    """ returns
+    list rows : {'name', 'calls', 'seconds', 'lines'} of every instrumented
+    function called (in data, default stats), slowest first """
+    if data is None:
+        data = stats
+    rows = [dict(name=name, **record) for name, record in data.items()]
+    return sorted(rows, key=lambda row: -row['seconds'])
+
+
+def table(data=None):
+    """ returns
+    str table : summary (of data, default stats) as a text table """
+    rows = summary(data)
+    width = max([len(row['name']) for row in rows] + [8])
+    lines = ['{0:<{w}s} {1:>9s} {2:>11s} {3:>11s} {4:>12s}'.format(
+        'function', 'calls', 'seconds', 'ms/call', 'lines', w=width)]
+    for row in rows:
+        lines += ['{0:<{w}s} {1:9d} {2:11.4f} {3:11.4f} {4:12d}'.format(
+            row['name'], row['calls'], row['seconds'],
+            1e3*row['seconds']/max(1, row['calls']), row['lines'], w=width)]
+    return '\n'.join(lines)
+
+
+def write(destination='1', data=None):
+    """ Write the summary (of data, default stats): to stderr as a table if
+    destination is '1' (or '-'), as JSON if it ends with .json, otherwise as
+    a table to that file """
+    if destination in ['1', '-', 'true', 'yes', 'table']:
+        print(table(data), file=sys.stderr, flush=True)
+    elif destination.endswith('.json'):
+        with open(destination, 'w') as f:
+            json.dump(summary(data), f, indent=1)
+    else:
+        with open(destination, 'w') as f:
+            f.write(table(data) + '\n')
+
+
+@contextmanager
+def profile(destination=None):
+    """ Context manager that profiles its body (its statistics are also
+    added to stats, e.g. for the summary at exit with VCA_PROFILE)
+
+    str destination : where to write the summary of the body on exit (see
+    write), if anywhere
+
+    yields
+    dict block : statistics of the body (see summary and table) """
+    global stats
+    outer = stats
+    stats = block = {}
+    already = enabled()
+    enable()
+    try:
+        yield block
+    finally:
+        if not already:
+            disable()
+        stats = outer
+        for name, record in block.items():
+            total = entry(name)
+            for key in total:
+                total[key] += record[key]
+        if destination is not None:
+            write(destination, block)
+
+
+def autoenable(modulename):
+    """ Called as each target module is imported: instrument it if the
+    VCA_PROFILE environment variable is set, and write the summary at exit """
+    destination = os.environ.get(envvar, '')
+    if destination in ['', '0', 'false', 'no']:
+        return
+    instrument(sys.modules[modulename])
+    if not _atexit:
+        _atexit.append(destination)
+        atexit.register(write, destination)
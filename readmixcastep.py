@@ -1,9 +1,11 @@
 import numpy as np
 import strindices as stri
+import profiling
+import mixmap
 from casase import casread
 from ase import Atoms
 
-recognised_tasks = ['single', 'geometry', "Electronic"]
+recognised_tasks = ['single', 'geometry', "Electronic", 'molecular']
 
 """
 Module to manage reading of CASTEP input and output files.
@@ -136,8 +138,10 @@ class readcell():
                 spins[i] = float(lnsplt[j].split('=')[1])
         return spins
 
-    def get_mixkey(self, iteration=None):
+    def get_mixkey(self, iteration=None, compact=False):
         """ Extract a dictionary mapping mixed atoms onto single site
+        bool compact : if True return a mixmap.MixKey rather than a dict
+
         returns
         dict mixkey : mapping -- see mixmap module for more info """
         mixkey = {}
@@ -168,6 +172,8 @@ class readcell():
                 wts[elem] = wt
                 elemkey = sorted(list(set(wts.keys())))[0]
                 mixkey[poskey] = (elemkey, wts)
+        if compact:
+            return mixmap.MixKey.from_dict(mixkey)
         return mixkey
 
     def get_posns(self, iteration=-1):
@@ -327,6 +333,13 @@ class readcas():
         elif self.task == 'geometry':
             lenthalpies = stri.strindices(self.caslines, 'with enthalpy=')
             Niterations = len(lenthalpies)
+        elif self.task == 'molecular':
+            # One force calculation per MD step (step 0 included), use
+            # mdstream to read the trajectory itself from the .md file
+            lforces = stri.strindices(self.caslines,
+                                      ['* Forces *', '* Symmetrised Forces *'],
+                                      either=True)
+            Niterations = len(lforces)
         return Niterations
 
     def get_elements(self):
@@ -377,18 +390,21 @@ class readcas():
                 ' are you sure the calcation completed?')
         return spins
 
-    def get_mixkey(self, iteration=-1, pureelems=None):
+    def get_mixkey(self, iteration=-1, pureelems=None, compact=False):
         """ Extract a dictionary mapping mixed atoms onto single site
         
         int iteration : atom positions (site labels) change during simulation
 
         purelems: dictionary
            {dopant: pure element} 
+
+        bool compact : if True return a mixmap.MixKey rather than a dict
         
         returns
         dict mixkey : mapping -- see mixmap module for more info """
         posns = self.get_posns(iteration=iteration)
-        if (self.task == 'single' or self.task == "Electronic"):
+        if (self.task == 'single' or self.task == "Electronic" or
+                self.task == 'molecular'):
             (nmin, nmax) = (0, self.Nlines)
         elif self.task == 'geometry':
             (nmin, nmax) = self.geomrange(iteration=iteration)
@@ -447,6 +463,8 @@ class readcas():
                         sitemix = mixkey[key][1]
                         mixkey[key] = [pureelems[el], sitemix]
 
+        if compact:
+            return mixmap.MixKey.from_dict(mixkey)
         return mixkey
 
     def geomrange(self, iteration=-1, nmin=0, nmax=None):
@@ -490,7 +508,8 @@ class readcas():
         returns
         np.array(Nions, 3) posns : fractional position of each ion """
         posns = np.zeros((self.Nions, 3))
-        if (self.task == 'single' or self.task == "Electronic"):
+        if (self.task == 'single' or self.task == "Electronic" or
+                self.task == 'molecular'):
             nmin, nmax = (0, self.Nlines)
         elif self.task == 'geometry':
             nmin, nmax = self.geomrange(iteration=iteration)
@@ -536,7 +555,8 @@ class readcas():
         returns
         np.array(3, 3) cell : unit cell vectors (Angstroms) """
         cell = np.zeros((3, 3))
-        if (self.task == 'single' or self.task == "Electronic"):
+        if (self.task == 'single' or self.task == "Electronic" or
+                self.task == 'molecular'):
             nmin, nmax = (0, self.Nlines)
         elif self.task == 'geometry':
             cellconstrs = self.get_cell_constrs()
@@ -560,9 +580,9 @@ class readcas():
         if self.Niterations == 0:
             raise IndexError(
                 'No SCF calculations completed so cannot extract enthalpy.')
-        if self.task == 'single':
+        if self.task == 'single' or self.task == 'molecular':
             raise NotImplementedError(
-                'get_enthalpy not implemented if task == single.')
+                'get_enthalpy not implemented if task == ' + self.task + '.')
         elif self.task == 'geometry':
             (nmin, nmax) = self.geomrange(iteration=iteration)
             lenthalpy = stri.strindex(self.caslines, 'with enthalpy=',
@@ -579,7 +599,7 @@ class readcas():
         if self.Niterations == 0:
             raise IndexError(
                 'No SCF calculations completed so cannot extract enthalpy.')
-        if self.task == 'single':
+        if self.task == 'single' or self.task == 'molecular':
             (nmin, nmax) = (0, self.Nlines)
         elif self.task == 'geometry':
             (nmin, nmax) = self.geomrange(iteration=iteration)
@@ -608,7 +628,7 @@ class readcas():
         if self.Niterations == 0:
             raise IndexError(
                 'No SCF calculations completed so cannot extract forces.')
-        if self.task == 'single':
+        if self.task == 'single' or self.task == 'molecular':
             (nmin, nmax) = (0, self.Nlines)
         elif self.task == 'geometry':
             (nmin, nmax) = self.geomrange(iteration=iteration)
@@ -634,7 +654,7 @@ class readcas():
         if self.Niterations == 0:
             raise IndexError(
                 'No SCF calculations completed so cannot extract stresses.')
-        if self.task == 'single':
+        if self.task == 'single' or self.task == 'molecular':
             (nmin, nmax) = (0, self.Nlines)
         elif self.task == 'geometry':
             (nmin, nmax) = self.geomrange(iteration=iteration)
@@ -701,3 +721,5 @@ class readcas():
 
         return bondLengths
 
+
+profiling.autoenable(__name__)  # if VCA_PROFILE is set
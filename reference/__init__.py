@@ -0,0 +1,7 @@
+"""
+Frozen copies of readmixcastep, mixmap and strindices as they were before
+any performance work (only the import of strindices is changed), used by
+differential.py as the reference that faster implementations must reproduce
+exactly. Do not optimise or otherwise change these modules: fix a bug here
+only together with the same fix in the main modules.
+"""
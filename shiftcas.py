@@ -1,18 +1,134 @@
 #!/usr/bin/env python3
 
-import sys
+import argparse
 import mixmap
 import readmixcastep as rc
 import numpy as np
 
-cellfile = sys.argv[1]
-shift = np.array([float(s) for s in sys.argv[2:5]])  # frac coords
-
-cas = rc.readcell(cellfile)
-mixatoms = cas.extract_struc()
-mixkey = cas.get_mixkey()
-mapping = mixmap.mixmap(mixatoms, mixkey)
-posns = mixatoms.get_scaled_positions()
-posns += shift
-mixatoms.set_scaled_positions(posns)
-mapping.casprint(mixatoms, cellfile)
+""" Command line tool to shift all atoms in a .cell file by a vector (in
+fractional coordinates): shiftcas.py cellfile x y z
+
+or by many vectors at once, each written to its own file (e.g. to scan
+origin shifts), with the structure read and mapped only once:
+
+shiftcas.py cellfile --shifts shifts.txt -o 'seed_{n}.cell'
+shiftcas.py cellfile --grid 2 2 2 --dry-run """
+
+
+def grid_shifts(grid):
+    """ returns
+    np.array(n1*n2*n3, 3) shifts : fractional shifts i/n1, j/n2, k/n3 """
+    axes = [np.arange(n)/float(n) for n in grid]
+    return np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+
+
+def shift_cells(cellfile, shifts, outfmt=None, nprocs=1, dryrun=False,
+                wrap=False):
+    """ Shift every atom of a (mixed) .cell file by each of many vectors
+
+    str cellfile : .cell file to shift
+    np.array(M, 3) shifts : shift vectors (fractional coordinates)
+    str outfmt : filename of each shifted cell, formatted with n (index of
+    the shift) and x, y, z (the shift), default seed_shift{n}.cell
+    int nprocs : number of processes to write with (mixmap.casprint_many)
+    bool dryrun : only return the shifted positions, write nothing
+    bool wrap : wrap the shifted positions back into the cell
+
+    returns
+    np.array(M, Nions, 3) posns : shifted fractional positions
+    list outfiles : files written (empty if dryrun) """
+    shifts = np.atleast_2d(np.asarray(shifts, dtype=float))
+    cas = rc.readcell(cellfile)
+    mixatoms = cas.extract_struc()
+    posns = mixatoms.get_scaled_positions()
+    shifted = posns[None, :, :] + shifts[:, None, :]
+    if wrap:
+        shifted %= 1.0
+    if dryrun:
+        return shifted, []
+
+    mixkey = cas.get_mixkey()
+    mapping = mixmap.mixmap(mixatoms, mixkey)
+    kpoints, offset = cas.get_kpoints()
+    mapping.setcellparams(pseudos=cas.get_psps(), kpoints=kpoints,
+                          kpoints_offset=offset, spins=cas.get_init_spin(),
+                          pressure=cas.get_ext_press(),
+                          cell_constrs=cas.get_cell_constrs())
+    if outfmt is None:
+        outfmt = cellfile.replace('.cell', '') + '_shift{n}.cell'
+    cells = {}
+    for n, (shift, fracs) in enumerate(zip(shifts, shifted)):
+        atoms = mixatoms.copy()
+        atoms.set_scaled_positions(fracs)
+        cells[outfmt.format(n=n, x=shift[0], y=shift[1], z=shift[2])] = atoms
+    if len(cells) != len(shifts):
+        raise ValueError('outfmt ' + outfmt + ' gives the same filename '
+                         + 'for different shifts.')
+    outfiles = mapping.casprint_many(cells, nprocs=nprocs)
+    return shifted, outfiles
+
+
+def shift_cell(cellfile, shift, outfile=None):
+    """ Shift every atom of a (mixed) .cell file
+
+    str cellfile : .cell file to shift
+    np.array(3) shift : shift vector (fractional coordinates)
+    str outfile : file to write (default overwrite cellfile)
+
+    returns
+    str outfile : file written """
+    if outfile is None:
+        outfile = cellfile
+    shifted, outfiles = shift_cells(cellfile, [shift],
+                                    outfmt=outfile.replace('{', '{{')
+                                    .replace('}', '}}'))
+    return outfiles[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Shift every atom of a .cell file.')
+    parser.add_argument('cellfile')
+    parser.add_argument('shift', type=float, nargs='*',
+                        help='x y z (fractional), the cellfile is overwritten')
+    parser.add_argument('-s', '--shifts', default=None,
+                        help='text (or .npy) file of shifts, one per row')
+    parser.add_argument('-g', '--grid', type=int, nargs=3, default=None,
+                        help='every shift on an n1 x n2 x n3 grid')
+    parser.add_argument('-o', '--outfmt', default=None,
+                        help='output filenames, formatted with {n}, {x}, '
+                        '{y}, {z} (default seed_shift{n}.cell)')
+    parser.add_argument('-n', '--nprocs', type=int, default=1,
+                        help='number of processes to write with')
+    parser.add_argument('--wrap', action='store_true',
+                        help='wrap positions back into the cell')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the shifted positions, write nothing')
+    args = parser.parse_args()
+    if args.shifts is not None:
+        if args.shifts.endswith('.npy'):
+            shifts = np.load(args.shifts)
+        else:
+            shifts = np.loadtxt(args.shifts, ndmin=2)
+        outfmt = args.outfmt
+    elif args.grid is not None:
+        shifts = grid_shifts(args.grid)
+        outfmt = args.outfmt
+    elif len(args.shift) == 3:
+        shifts = np.array([args.shift])
+        outfmt = args.outfmt or args.cellfile.replace('{', '{{').replace(
+            '}', '}}')
+    else:
+        parser.error('give a shift x y z, --shifts or --grid')
+    shifted, outfiles = shift_cells(args.cellfile, shifts, outfmt=outfmt,
+                                    nprocs=args.nprocs, dryrun=args.dry_run,
+                                    wrap=args.wrap)
+    if args.dry_run:
+        elems = rc.readcell(args.cellfile).get_elements()
+        for shift, fracs in zip(shifts, shifted):
+            print('shift ' + ' '.join(['{0:.6f}'.format(s) for s in shift]))
+            for elem, frac in zip(elems, fracs):
+                print('  {0:3s}'.format(elem)
+                      + ' '.join(['{0:12.8f}'.format(f) for f in frac]))
+    else:
+        print('\n'.join(outfiles))
@@ -3,6 +3,8 @@ Module containing functions to detect the list indices in which strings occur.
 Generally the list is normally to be a list of file lines from f.readlines().
 """
 
+import profiling
+
 
 def strindex(flist, strings, nmin=0, nmax=None, first=False, either=False):
     """ Extract index of first/last line in list at which string occurs.
@@ -48,3 +50,6 @@ def strindices(flist, strings, nmin=0, nmax=None, either=False):
     indices = [i+nmin for i, item in enumerate(flist[nmin:nmax]) if
                check(string in item for string in strings)]
     return indices
+
+
+profiling.autoenable(__name__)  # if VCA_PROFILE is set
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+import argparse
+import numpy as np
+from ase import Atoms
+import mixmap
+import readmixcastep as rc
+from fakecastep import castext, fmtrow
+from mdstream import bohr
+
+"""
+Generator of synthetic (but format faithful) CASTEP .cell and .castep files
+of any size, for benchmarks and tests, e.g.
+
+write_castep('big.castep', 1000, Nmixed=100, task='geometry', Niterations=20)
+write_castep('cont.castep', 200, Nmixed=20, Niterations=12, Nsegments=3)
+write_cell('big.cell', 1000, Nmixed=100)
+castep_from_cell('big_0.cell')  # single point output for an existing .cell
+write_md('run.md', 200, Nmixed=20, Nsteps=500)  # MD trajectory (and .castep)
+
+Sites sit on a jittered cubic grid (perovskite-like Ca, Ti, O, O, O labels)
+and Nmixed of them are VCA mixtures of two elements, so a file with Nions ions
+has Nions - Nmixed sites. The energies, forces and stresses are random (the
+stand-in physics of fakecastep is far too slow for thousands of ions) but
+atoms on one site share their position and force as in CASTEP output. A
+geometry run has Niterations BFGS iterations, optionally split over Nsegments
+continuation runs appended to the same file (as CASTEP does). An MD run
+(task 'molecular') has Niterations steps in the .castep and its trajectory in
+the seed.md file (in atomic units, every atom of a mixture listed).
+"""
+
+site_elems = ['Ca', 'Ti', 'O', 'O', 'O']
+partners = {'Ca': 'Sr', 'Ti': 'Zr', 'O': 'F'}
+spacing = 2.0  # Ang between sites
+pseudos = {elem: elem + '_00PBE.usp'
+           for elem in site_elems + list(partners.values())}
+
+
+def gen_structure(Nions, Nmixed=0, seed=0):
+    """ Synthetic mixed structure
+
+    int Nions : number of ions (each mixed site holds two)
+    int Nmixed : number of mixed sites
+    int seed : random seed
+
+    returns
+    np.array(3, 3) cell : unit cell vectors (Ang)
+    np.array(Nions, 3) fracs : fractional positions
+    list elems : element of each ion
+    list mixlabels : CASTEP mixture label of each ion (0 if not mixed)
+    list wts : mixture weight of each ion """
+    Nsites = Nions - Nmixed
+    if Nmixed < 0 or Nmixed > Nsites:
+        raise ValueError('Cannot have ' + str(Nmixed) + ' mixed sites with '
+                         + str(Nions) + ' ions.')
+    rng = np.random.RandomState(seed)
+    n = int(np.ceil(Nsites**(1.0/3) - 1e-9))
+    grid = np.array([[i, j, k] for i in range(n) for j in range(n)
+                     for k in range(n)])[:Nsites]
+    sitefracs = (grid + 0.5 + rng.uniform(-0.05, 0.05, (Nsites, 3)))/n
+    cell = np.diag([1.0, 1.02, 1.05])*n*spacing
+    mixsites = set(rng.choice(Nsites, Nmixed, replace=False).tolist())
+
+    fracs, elems, mixlabels, wts = [], [], [], []
+    m = 0
+    for s in range(Nsites):
+        elem = site_elems[s % len(site_elems)]
+        if s in mixsites:
+            m += 1
+            wt = round(rng.uniform(0.2, 0.8), 4)
+            fracs += [sitefracs[s], sitefracs[s]]
+            elems += [elem, partners[elem]]
+            mixlabels += [m, m]
+            wts += [wt, round(1.0 - wt, 4)]
+        else:
+            fracs += [sitefracs[s]]
+            elems += [elem]
+            mixlabels += [0]
+            wts += [1.0]
+    return cell, np.array(fracs), elems, mixlabels, wts
+
+
+def site_mixkey(fracs, elems, mixlabels, wts):
+    """ returns
+    dict mixkey : site mixkey of a synthetic structure (see mixmap) """
+    mixkey = {}
+    for frac, elem, m, wt in zip(fracs, elems, mixlabels, wts):
+        key = mixmap.posstring(frac)
+        if key in mixkey:
+            siteelem, sitewts = mixkey[key]
+            sitewts[elem] = wt
+        else:
+            mixkey[key] = (elem, {elem: wt})
+    return mixkey
+
+
+def write_cell(cellfile, Nions, Nmixed=0, seed=0, kpoints=(4, 4, 4)):
+    """ Write a synthetic .cell file (through mixmap.casprint)
+
+    returns
+    str cellfile : file written """
+    cell, fracs, elems, mixlabels, wts = gen_structure(Nions, Nmixed, seed)
+    atoms = Atoms(symbols=elems, scaled_positions=fracs, cell=cell, pbc=True)
+    mapping = mixmap.mixmap(atoms, site_mixkey(fracs, elems, mixlabels, wts))
+    mapping.setcellparams(kpoints=list(kpoints),
+                          kpoints_offset=[0.0 if k % 2 == 0 else 1.0/(2*k)
+                                          for k in kpoints],
+                          cell_constrs=[1, 2, 3, 0, 0, 0],
+                          pseudos={elem: pseudos[elem]
+                                   for elem in sorted(set(elems))})
+    mapping.casprint(atoms, cellfile)
+    return cellfile
+
+
+def results(rng, site):
+    """ returns
+    tuple (energy, forces, stress) : random results for ions on sites
+    np.array(Nions) site (the atoms of a mixture share a force) """
+    forces = rng.normal(0.0, 0.1, (site.max() + 1, 3))[site]
+    stress = rng.normal(0.0, 0.5, (3, 3))
+    return (-5.0*(site.max() + 1) + rng.normal(0.0, 0.01), forces,
+            0.5*(stress + stress.T))
+
+
+def castep_text(cell, fracs, elems, mixlabels, wts, task='single',
+                Niterations=1, Nsegments=1, complete=True, seed=0,
+                kpoints=(4, 4, 4)):
+    """ Text of a synthetic .castep file for a structure
+
+    str task : 'single', 'geometry' or 'molecular'
+    int Niterations : number of BFGS iterations or MD steps
+    int Nsegments : number of runs (continuations) the iterations are split
+    over
+    bool complete : if False the last run has no final 'Total time' line
+
+    returns
+    str text : contents of the .castep file """
+    rng = np.random.RandomState(seed)
+    cell = np.array(cell, dtype=float)
+    fracs = np.array(fracs, dtype=float)
+    # Site of each ion (the atoms of a mixture share a site)
+    labels = [('mix', m) if m > 0 else ('ion', i)
+              for i, m in enumerate(mixlabels)]
+    sites = {}
+    site = np.array([sites.setdefault(label, len(sites)) for label in labels])
+    Nsites = len(sites)
+    if task == 'single':
+        Niterations, Nsegments = 1, 1
+    Nsegments = max(1, min(Nsegments, Niterations))
+    segments = np.array_split(np.arange(Niterations), Nsegments)
+    text = ''
+    for g, iterations in enumerate(segments):
+        out = castext(elems, mixlabels, wts, task=task, kpoints=kpoints,
+                      cell_constrs=(1, 2, 3, 0, 0, 0),
+                      pseudos={elem: pseudos.get(elem, elem + '.usp')
+                               for elem in sorted(set(elems))})
+        out.structure(cell, fracs)
+        out.parameters()
+        for k, n in enumerate(iterations):
+            if k > 0 and task == 'geometry':
+                # Small relaxation step (shared by the atoms on each site)
+                fracs = fracs + rng.normal(0.0, 1e-3, (Nsites, 3))[site]
+                cell = cell*(1.0 + rng.normal(0.0, 1e-3))
+                out.structure(cell, fracs)
+            energy, forces, stress = results(rng, site)
+            out.results(energy, forces, stress)
+            if task == 'geometry':
+                out.iteration(int(n), energy + rng.uniform(0.0, 0.1))
+            elif task == 'molecular':
+                out.mdstep(int(n), 1e-3*n, energy, 0.02*Nsites,
+                           300.0 + rng.normal(0.0, 5.0))
+        last = g == len(segments) - 1
+        if task == 'geometry' and (complete or not last):
+            out.lines += [' BFGS: Final Enthalpy     = '
+                          '{0:.8E} eV'.format(energy), '']
+        if complete or not last:
+            out.populations()
+            out.lines += ['Total time          = {0:9.2f} s'.format(
+                1.0 + len(iterations))]
+        text += out.text()
+    return text
+
+
+def write_castep(casfile, Nions, Nmixed=0, task='geometry', Niterations=5,
+                 Nsegments=1, complete=True, seed=0):
+    """ Write a synthetic .castep file (see gen_structure and castep_text)
+
+    returns
+    str casfile : file written """
+    structure = gen_structure(Nions, Nmixed, seed)
+    text = castep_text(*structure, task=task, Niterations=Niterations,
+                       Nsegments=Nsegments, complete=complete, seed=seed)
+    mixmap.atomic_write(text, casfile)
+    return casfile
+
+
+def castep_from_cell(cellfile, casfile=None, seed=0):
+    """ Write a synthetic single point .castep file for an existing (mixed)
+    .cell file, e.g. a phonon displacement written by gen_perturbations
+
+    returns
+    str casfile : file written """
+    if casfile is None:
+        casfile = cellfile.replace('.cell', '.castep')
+    cas = rc.readcell(cellfile)
+    atoms = cas.extract_struc()
+    mapping = mixmap.mixmap(atoms, cas.get_mixkey())
+    mixlabels = [mapping.mixsitemixes[i][0] for i in range(len(atoms))]
+    wts = [mapping.mixsitemixes[i][1] for i in range(len(atoms))]
+    text = castep_text(np.array(atoms.get_cell()),
+                       atoms.get_scaled_positions(),
+                       atoms.get_chemical_symbols(), mixlabels, wts,
+                       task='single', seed=seed,
+                       kpoints=cas.get_kpoints()[0])
+    mixmap.atomic_write(text, casfile)
+    return casfile
+
+
+def md_text(cell, fracs, elems, mixlabels, wts, Nsteps=10, seed=0):
+    """ Text of a synthetic CASTEP .md file (a random walk of the sites)
+
+    returns
+    str text : contents of the .md file """
+    rng = np.random.RandomState(seed)
+    cell = np.array(cell, dtype=float)/bohr
+    posns = np.dot(np.array(fracs, dtype=float), cell)
+    labels = [('mix', m) if m > 0 else ('ion', i)
+              for i, m in enumerate(mixlabels)]
+    sites = {}
+    site = np.array([sites.setdefault(label, len(sites)) for label in labels])
+    Nsites = len(sites)
+    counts = {}
+    numbers = []
+    for elem in elems:
+        counts[elem] = counts.get(elem, 0) + 1
+        numbers += [counts[elem]]
+    ions = [' {0:<2s} {1:14d}'.format(elem, n)
+            for elem, n in zip(elems, numbers)]
+    lines = [' BEGIN header', '  ', ' END header', '  ']
+    for n in range(Nsteps):
+        velocities = rng.normal(0.0, 1e-4, (Nsites, 3))[site]
+        forces = rng.normal(0.0, 1e-3, (Nsites, 3))[site]
+        if n > 0:
+            posns = posns + 40.0*velocities
+        kinetic = 1e-3*Nsites*(1.0 + rng.normal(0.0, 0.05))
+        potential = -0.2*Nsites + rng.normal(0.0, 1e-3)
+        stress = rng.normal(0.0, 1e-5, (3, 3))
+        lines += [' '*22 + '{0:.8E}'.format(40.0*n)]
+        # CASTEP layout: potential, conserved (hamiltonian) and kinetic
+        lines += [' '*22 + fmtrow([potential, potential + kinetic + 1e-4,
+                                   kinetic], '{0:19.8E}') + '  <-- E',
+                  ' '*22 + '{0:19.8E}'.format(9.5e-4*(1.0 + rng.normal(
+                      0.0, 0.05))) + ' '*38 + '  <-- T',
+                  ' '*22 + '{0:19.8E}'.format(np.trace(stress)/3)
+                  + ' '*38 + '  <-- P']
+        lines += [' '*22 + fmtrow(row, '{0:19.8E}') + '  <-- h'
+                  for row in cell]
+        lines += [' '*22 + fmtrow(np.zeros(3), '{0:19.8E}') + '  <-- hv'
+                  for row in cell]
+        lines += [' '*22 + fmtrow(row, '{0:19.8E}') + '  <-- S'
+                  for row in 0.5*(stress + stress.T)]
+        for tag, values in [('R', posns), ('V', velocities), ('F', forces)]:
+            lines += [ion + fmtrow(v, '{0:19.8E}') + '  <-- ' + tag
+                      for ion, v in zip(ions, values)]
+        lines += [' ']
+    return '\n'.join(lines) + '\n'
+
+
+def write_md(mdfile, Nions, Nmixed=0, Nsteps=10, seed=0, castep=True):
+    """ Write a synthetic .md file (see gen_structure and md_text), and the
+    .castep and .cell files of the same run if castep
+
+    returns
+    str mdfile : file written """
+    structure = gen_structure(Nions, Nmixed, seed)
+    mixmap.atomic_write(md_text(*structure, Nsteps=Nsteps, seed=seed),
+                        mdfile)
+    if castep:
+        mixmap.atomic_write(castep_text(*structure, task='molecular',
+                                        Niterations=Nsteps, seed=seed),
+                            mdfile.replace('.md', '.castep'))
+        write_cell(mdfile.replace('.md', '.cell'), Nions, Nmixed, seed=seed)
+    return mdfile
+
+
+##########################################################################
+
+if __name__ == '__main__':
+    """ Run from the command line: synthcastep.py [options] filename """
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic .castep or .cell file.')
+    parser.add_argument('filename',
+                        help='.castep, .cell or .md file to write')
+    parser.add_argument('-n', '--ions', type=int, default=100)
+    parser.add_argument('-k', '--mixed', type=int, default=0,
+                        help='number of mixed sites')
+    parser.add_argument('-t', '--task', default='geometry',
+                        choices=['single', 'geometry', 'molecular'])
+    parser.add_argument('-m', '--iterations', type=int, default=5)
+    parser.add_argument('-c', '--segments', type=int, default=1,
+                        help='number of continuation runs')
+    parser.add_argument('--incomplete', action='store_true',
+                        help='leave the last run unfinished')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.filename.endswith('.cell'):
+        write_cell(args.filename, args.ions, args.mixed, seed=args.seed)
+    elif args.filename.endswith('.md'):
+        write_md(args.filename, args.ions, args.mixed,
+                 Nsteps=args.iterations, seed=args.seed)
+    else:
+        write_castep(args.filename, args.ions, args.mixed, task=args.task,
+                     Niterations=args.iterations, Nsegments=args.segments,
+                     complete=not args.incomplete, seed=args.seed)
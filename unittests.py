@@ -3,7 +3,30 @@
 import readmixcastep as rc
 import mixmap
 import phonons_VCA as pVCA
+import compsweep
+import vegard
+import fcinterp
+import jobrunner
+import elastic
+import eos
+import converge
+import pinchposns
+import vcatools
+import update_cell
+import shiftcas
+import synthcastep
+import benchmark
+import profiling
+import differential
+import mdstream
+import numpy as np
+import phonopy
+from ase import Atoms
+from ase.build import make_supercell
+from ase.calculators.lj import LennardJones
+from ase.io.castep import read_castep_md
 import os
+import shutil
 
 """ A silly script to test that all the functionality works.
 Running this script should test that most functions and classes run without
@@ -62,6 +85,10 @@ mixkey = cas.get_mixkey()
 atoms = cas.extract_struc()
 mapping = mixmap.mixmap(atoms, mixkey)
 
+compactkey = cas.get_mixkey(compact=True)  # MixKey rather than dict
+print(compactkey.to_elem_dict())
+mixmap.mixmap(atoms, compactkey)
+
 print(mapping.pure2mix_map)
 print(mapping.mix2pure_map)
 print(mapping.mixsitemixes)
@@ -106,6 +133,57 @@ mapping = mixmap.mixmap(mixatoms, mixkey)
 
 mapping.casprint(mixatoms, 'test3.cell', pure=False)  # write mix cell
 
+# Mixed 2x2x1 supercell directly from the pure primitive cell
+superatoms, superkey = mixmap.create_mixture(atoms, mixkey,
+                                             supercell=[[2, 0, 0], [0, 2, 0],
+                                                        [0, 0, 1]],
+                                             rtn_mixkey=True)
+print(len(superatoms), len(superkey))
+
+# Same supercell by tiling the primitive mapping (no setup_maps)
+purecell = mapping.mix2pure(mixatoms)
+supermap = mapping.tile(purecell, make_supercell(purecell,
+                                                 np.diag([2, 2, 1])))
+print(supermap.pureions, supermap.mixions, supermap.kpoints)
+
+# Sweep the Ca/Sr composition of the pure cell (writing a .cell per point)
+
+def sweepkey(x):
+    return {'Ca': {'Ca': 1.0-x, 'Sr': x}, 'Ti': {'Ti': 1.0}, 'O': {'O': 1.0}}
+
+sweep = compsweep.compsweep(atoms, sweepkey, {'x': np.linspace(0.0, 1.0, 5)})
+for point, cellfile in sweep.write('test_sweep_{x:.2f}.cell'):
+    print(cellfile)
+
+# Constrain the Sr atoms along z: the constraints must follow the atoms kept
+# at each point (none at the Ca end member)
+constrs = np.zeros((sweep.mapping.mixions, 3), dtype=bool)
+constrs[np.array(sweep.mixatoms.get_chemical_symbols()) == 'Sr', 2] = True
+csweep = compsweep.compsweep(atoms, sweepkey, {'x': [0.0, 0.5, 1.0]},
+                             ion_constrs=constrs)
+for n, point in enumerate(csweep.points):
+    pointatoms, pointmap = csweep.pointcell(n)
+    constrained = [pointatoms.get_chemical_symbols()[i]
+                   for i in np.where(pointmap.ion_constrs[:, 2])[0]]
+    print("x =", point['x'], "constrained:", len(constrained),
+          set(constrained) <= {'Sr'})
+
+# Fit structures from the sweep and predict a starting cell for x = 0.6
+
+vg = vegard.vegard(['test_sweep_0.00.cell', 'test_sweep_0.50.cell',
+                    'test_sweep_1.00.cell'], deg=1)
+vg.write({'test_vegard.cell': sweepkey(0.6)})
+
+# Per-site fit (coordinates follow the sites within 2.5 Ang), and a quadratic
+# fit to two structures is refused
+vglocal = vegard.vegard(['test_sweep_0.00.cell', 'test_sweep_0.50.cell',
+                         'test_sweep_1.00.cell'], local=2.5)
+print("Local Vegard fits:", len(vglocal.models), "max rms", vglocal.rms.max())
+try:
+    vegard.vegard(['test_sweep_0.00.cell', 'test_sweep_1.00.cell'], deg=2)
+except ValueError as error:
+    print("Refused:", error)
+
 ########################################################
 ########################################################
 
@@ -141,7 +219,7 @@ print(eigvecs[2, :15].reshape(5, 3))
 # Compute phonons (using method 2) -- slower but more stable method
 
 output = pVCA.calc_phonons('examples/Ca1.5Sr0.5GeO4/Ca1.5Sr0.5GeO4.castep',
-                           method=2, verbose=True)
+                           method=2, verbose=True, nprocs=2, cache=True)
 q_points, distances, frequencies, eigenvectors = output
 freqs = frequencies[0][0]
 eigvecs = eigenvectors[0][0]
@@ -155,4 +233,257 @@ print(eigvecs[2, :15].reshape(5, 3))
 
 ########################################################
 
+# Repeat using the stored force set (no .castep files are re-read)
+
+output = pVCA.calc_phonons('examples/Ca1.5Sr0.5GeO4/Ca1.5Sr0.5GeO4.castep',
+                           method=2, cache=True)
+store = pVCA.forceset('examples/Ca1.5Sr0.5GeO4/Ca1.5Sr0.5GeO4.castep')
+print("\nMissing displacements:", store.missing(21))
+
+# Re-query the saved force constants at other q-points (no files re-read)
+saved = pVCA.load_phonons('examples/Ca1.5Sr0.5GeO4/Ca1.5Sr0.5GeO4_phonons.npz')
+freqs, eigvecs = saved.frequencies([[0.0, 0.0, 0.0], [0.5, 0.0, 0.0]])
+print("\nFirst 5 frequencies at X:", freqs[1, :5])
+
+# Direct Gamma-point solve, batched over a stack of force constant sets
+freqs, eigvecs = saved.gamma()
+stack = pVCA.gamma_phonons(np.array([saved.force_constants]*3),
+                           np.array([saved.masses]*3), eigvecs=False)
+print("\nGamma frequencies (direct):", freqs[3:6], stack.shape)
+for fcs, masses in [(saved.force_constants[..., :2], saved.masses),
+                    (saved.force_constants, saved.masses[:-1])]:
+    try:
+        pVCA.gamma_phonons(fcs, masses)
+        print("Mismatched shapes accepted")
+    except ValueError as error:
+        print("Mismatched shapes refused:", error)
+
+# Interpolate the force constants to a nearby composition (needs more saved
+# compositions to be meaningful, with one the force constants are constant)
+fi = fcinterp.fcinterp(['examples/Ca1.5Sr0.5GeO4/Ca1.5Sr0.5GeO4_phonons.npz'])
+predicted = fi.predict({'Ca': {'Ca': 0.7, 'Sr': 0.3}, 'Ge': {'Ge': 1.0},
+                        'O': {'O': 1.0}})
+print("\nInterpolated Gamma frequencies:",
+      predicted.frequencies([0.0, 0.0, 0.0], eigvecs=False)[0, :5])
+
+# Interpolate 2x1x1 supercell force constants (Lennard-Jones forces) over
+# three Ca/Sr compositions, then check an end member is reproduced and the
+# leave-one-out errors
+fcfiles = []
+for x in [0.0, 0.5, 1.0]:
+    pure = Atoms('CaO', scaled_positions=[[0, 0, 0], [0.5, 0.5, 0.5]],
+                 cell=np.eye(3)*(3.0 + 0.3*x), pbc=True)
+    mixkey = {'Ca': {'Ca': 1.0 - x, 'Sr': x}, 'O': {'O': 1.0}}
+    mixatoms = mixmap.create_mixture(pure, mixkey)
+    mapping = mixmap.mixmap(mixatoms, mixkey)
+    PhononObj = phonopy.Phonopy(mapping.mix2pure(mixatoms),
+                                np.diag([2, 1, 1]))
+    PhononObj.generate_displacements(distance=0.01)
+    forces = []
+    for displ in PhononObj.supercells_with_displacements:
+        displatoms = Atoms(symbols=displ.symbols, positions=displ.positions,
+                           cell=displ.cell, pbc=True)
+        displatoms.calc = LennardJones(sigma=2.3, epsilon=0.1, rc=6.0)
+        forces += [displatoms.get_forces()]
+    PhononObj.forces = forces
+    PhononObj.produce_force_constants()
+    fcfiles += ['test_fcinterp_{0:.2f}.npz'.format(x)]
+    pVCA.save_phonons(PhononObj, fcfiles[-1], mapping=mapping)
+fi = fcinterp.fcinterp(fcfiles, deg=2)
+predicted = fi.predict({'Ca': {'Ca': 1.0}, 'O': {'O': 1.0}})
+qpoints = [[0.0, 0.0, 0.0], [0.5, 0.0, 0.0]]
+diff = predicted.frequencies(qpoints, eigvecs=False) - \
+    pVCA.load_phonons(fcfiles[0]).frequencies(qpoints, eigvecs=False)
+print("\nSupercell end member reproduced:", np.abs(diff).max() < 1e-3)
+looerrs = fi.errors(qpoints)
+print("Leave-one-out errors (cm-1):", looerrs, np.all(np.isfinite(looerrs)))
+
+########################################################
+
+# Compute phonons from the displacement manifest (no matching of structures)
+
+output = pVCA.calc_phonons('examples/Ca1.5Sr0.5GeO4/Ca1.5Sr0.5GeO4.castep',
+                           method=3)
+print("\nFirst 10 frequencies (manifest):")
+print(output[2][0][0][:10])
+# Method 1 regenerates the displacements with the manifest's distance and
+# symprec, so must reproduce them
+output1 = pVCA.calc_phonons('examples/Ca1.5Sr0.5GeO4/Ca1.5Sr0.5GeO4.castep',
+                            method=1)
+print("Method 1 matches manifest:",
+      np.allclose(output1[2][0][0], output[2][0][0], atol=1e-3))
+
+########################################################
+
+# Phonon DOS and thermal properties on a q-mesh (streamed to test_mesh_*.npy)
+
+PhononObj = pVCA.build_phonons(
+    'examples/Ca1.5Sr0.5GeO4/Ca1.5Sr0.5GeO4.castep', method=3)
+dos_freqs, dos, temps, F, S, Cv = pVCA.mesh_phonons(PhononObj, [2, 2, 2],
+                                                    'test_mesh')
+print("\nFree energy (kJ/mol) at", temps[:3], "K:", F[:3])
+
+########################################################
+
+# Run the sweep .cell files with the stand-in CASTEP (twice: the second run
+# finds every job complete and runs nothing)
+
+for filename in ['test_sweep_0.00.castep', 'test_sweep_1.00.castep',
+                 'test_jobs.db']:
+    if os.path.exists(filename):
+        os.remove(filename)
+runner = jobrunner.jobrunner('test_jobs.db',
+                             command=jobrunner.standin_command(), maxjobs=2)
+runner.add(['test_sweep_0.00.cell', 'test_sweep_1.00.cell'])
+print("\nJob states:", runner.run())
+print("Job states (resumed):", runner.run())
+print("Stand-in energy:",
+      rc.readcas('test_sweep_0.00.castep').get_energy())
+
+########################################################
+
+# Strained cells for elastic constants, and a fit to synthetic stresses
+
+shutil.copy('examples/Ca2.15Sr0.85Ti2O7_Amam.castep', 'test_elastic.castep')
+cellfiles = elastic.gen_strains('test_elastic.castep',
+                                strains=elastic.strain_set([-0.01, 0.01]))
+strains, strainfiles = elastic.read_manifest('test_elastic.castep')
+Cknown = np.diag([200.0, 210.0, 190.0, 60.0, 70.0, 80.0])
+stresses = np.dot(strains, Cknown) + np.array([1.0, 1.0, 1.0, 0, 0, 0])
+C, rms = elastic.fit_cij(np.array([strains, strains]),
+                         np.array([stresses, 1.1*stresses]))
+print("\nFitted C11 of two compositions:", C[:, 0, 0],
+      "K_VRH:", elastic.vrh(C)[0])
+
+########################################################
+
+# Pressure sweep .cell files and a Birch-Murnaghan fit of synthetic energies
+
+cellfiles = eos.gen_eos('test_elastic.castep', pressures=[0.0, 5.0, 10.0])
+volumes = np.linspace(480.0, 580.0, 6)
+energies = eos.birch_murnaghan(volumes, -170.0, 530.0, 150.0/160.2177, 4.5)
+fit = eos.fit_birch_murnaghan(np.array([volumes, volumes]),
+                              np.array([energies, energies + 1.0]))
+print("\nFitted V0 and B0 of two compositions:", fit['V0'], fit['B0'])
+
+########################################################
+
+# k-point convergence: without a command only the first run is written
+
+for filename in ['test1_k2x2x1.castep', 'test1_k3x3x1.castep']:
+    if os.path.exists(filename):
+        os.remove(filename)
+conv = converge.convergence('test1.cell', 'kpoints', etol=1e-3)
+print("\nk-point grids:", conv.values[:4])
+print("Waiting to run:", conv.run()['waiting'])
+
+########################################################
+
+# Match a shuffled copy of a pure structure back onto it (optimal assignment)
+
+shuffled = purecell[np.random.permutation(len(purecell))]
+shuffled, perm = pinchposns.reorder_atoms(purecell, shuffled, rtn_perm=True)
+print("\nLargest distance after reordering:",
+      np.abs(shuffled.get_positions() - purecell.get_positions()).max())
+
+########################################################
+
+# Unified command line tools, run over a glob (as vcatools.py info ...)
+
+options = vcatools.parser().parse_args(['info', 'examples/*.cell'])
+summary = vcatools.run(options.command, options.paths, options)
+print("Summary:", summary['ok'], "ok,", summary['failed'], "failed")
+
+########################################################
+
+# Incremental rebuild of pure .cell files (the second call rebuilds nothing)
+
+if os.path.exists('test_update_cell.json'):
+    os.remove('test_update_cell.json')
+for n in range(2):
+    rebuilt, current = update_cell.update(['test_elastic.castep'],
+                                          {'Sr': 'Ca'},
+                                          manifest='test_update_cell.json')
+    print("Rebuilt:", rebuilt, "up to date:", current)
+
+# vcatools update-cell shares the manifest: up to date with the same pure
+# elements, rebuilt when they change
+for pureelem in ['Sr=Ca', 'Ca=Sr']:
+    options = vcatools.parser().parse_args(
+        ['update-cell', '-p', pureelem, '-m', 'test_update_cell.json',
+         'test_elastic.castep'])
+    options.pureelems = update_cell.parse_pureelems(options.pureelems)
+    summary = vcatools.run(options.command, options.paths, options)
+    print("vcatools update-cell:", summary['ok'], "rebuilt,",
+          summary['skipped'], "skipped")
+
+########################################################
+
+# Several origin shifts of one cell, mapped once and written together
+
+shifted, outfiles = shiftcas.shift_cells('test1.cell',
+                                         shiftcas.grid_shifts([2, 1, 1]),
+                                         outfmt='test_shift_{n}.cell')
+print("Shifted positions:", shifted.shape, "written to", outfiles)
+
+########################################################
+
+# Synthetic continuation run and a small benchmark sweep
+
+synthcastep.write_castep('test_synth.castep', 40, Nmixed=8, Niterations=6,
+                         Nsegments=2)
+synthcas = rc.readcas('test_synth.castep')
+print("Synthetic run:", synthcas.Nions, "ions,", synthcas.Niterations,
+      "iterations,", len(synthcas.get_mixkey()), "sites")
+results = benchmark.run([8, 16], repeat=1, phonon_max=8, verbose=False)
+print(benchmark.table(results))
+
+########################################################
+
+# Profile parsing and mapping (the methods are restored afterwards)
+
+with profiling.profile() as stats:
+    profcas = rc.readcas('test_synth.castep')
+    mixmap.mixmap(profcas.extract_struc(), profcas.get_mixkey())
+print(profiling.table(stats))
+print("Still instrumented:", profiling.enabled())
+
+########################################################
+
+# Compare the current parsers and mappers with the frozen reference ones
+
+synthcastep.write_castep('test_diff.castep', 20, Nmixed=4, Niterations=3)
+report = differential.run(['test_diff.castep',
+                           'examples/Ca3Ti2O7_P42mnm.cell'])
+for filename, entry in report.items():
+    print(differential.summary_line(filename, entry))
+print(differential.timing_table(report))
+
+########################################################
+
+# Stream a synthetic MD trajectory in chunks, on the pure sites, to .npy files
+
+synthcastep.write_md('test_md.md', 20, Nmixed=4, Nsteps=12)
+mdcas = rc.readcas('test_md.castep')
+print("MD run:", mdcas.task, mdcas.Niterations, "steps, final energy",
+      mdcas.get_energy())
+mdmapping = mdstream.md_mapping('test_md.md')
+for chunk in mdstream.readmd('test_md.md', chunksize=5, mapping=mdmapping):
+    print("Steps", chunk['step'][0], "to", chunk['step'][-1], "positions",
+          chunk['positions'].shape, "mean T", np.mean(chunk['temperature']))
+mdarrays = mdstream.readmd('test_md.md', chunksize=5).to_memmap('test_md')
+print("Memory mapped:", mdarrays['forces'].shape, sorted(mdarrays))
+images = read_castep_md('test_md.md', index=':')
+print("Matches ase .md reader:",
+      np.allclose(mdarrays['positions'], [a.get_positions() for a in images],
+                  atol=1e-6),
+      np.allclose(mdarrays['forces'], [a.get_forces() for a in images],
+                  atol=1e-6),
+      np.allclose(mdarrays['potential'],
+                  [a.get_potential_energy(force_consistent=True)
+                   for a in images], atol=1e-6))
+shutil.rmtree('test_md')
+
+########################################################
+
 print("\n\nAll functions and methods appeared to run succesfully.\n\n")
@@ -1,31 +1,249 @@
 #!/usr/bin/env python3
 
+import os
+import sys
+import json
+import fcntl
+import hashlib
+import argparse
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import readmixcastep as rc
 import mixmap
-from glob import glob
 
-def main(pureelems):
+"""
+Writes the pure .cell of the final structure of each .castep file, rebuilding
+only the .cell files that are missing or stale (as make would):
+
+update_cell.py [-p Ba=La -p Al=Mg] [-c config.json] [-j N] [-f] [files/globs]
+
+The fingerprints (mtime, size and content hash) of every .castep and of the
+.cell built from it, and the pure element map used, are recorded in a
+manifest (update_cell.json). A .cell is rebuilt when its .castep has changed
+(e.g. by a continuation run), the .cell itself has been changed or removed,
+or the pure elements differ; contents are only hashed when the mtime or size
+differ from the manifest. Files not yet in the manifest are rebuilt if their
+.cell is missing or older than the .castep. The pure elements may also be
+given in a JSON config file: {"pureelems": {"Ba": "La", "Al": "Mg"}}
+vcatools.py update-cell reads and writes the same manifest (updates are
+merged under a lock file, manifest.lock, so parallel workers lose nothing).
+"""
+
+manifest_default = 'update_cell.json'
+
+
+def file_hash(filename):
+    """ returns
+    str sha256 : hash of the contents of filename """
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def fingerprint(filename, previous=None):
+    """ returns
+    dict fingerprint : mtime_ns, size and sha256 of filename (the hash of
+    previous is reused if its mtime and size are unchanged) """
+    stat = os.stat(filename)
+    fp = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+    if (previous is not None and previous.get('mtime_ns') == fp['mtime_ns']
+            and previous.get('size') == fp['size']):
+        fp['sha256'] = previous['sha256']
+    else:
+        fp['sha256'] = file_hash(filename)
+    return fp
+
+
+def stale(casfile, pureelems, record=None):
+    """ returns
+    str reason : why the .cell of casfile must be rebuilt, or None if it is
+    up to date (record is its entry in the manifest, if any) """
+    cellname = casfile.replace(".castep", ".cell")
+    if not os.path.exists(cellname):
+        return 'missing'
+    if record is None:
+        if os.stat(cellname).st_mtime_ns < os.stat(casfile).st_mtime_ns:
+            return 'older than .castep'
+        return None
+    if record.get('pureelems') != pureelems:
+        return 'pure elements changed'
+    if changed(casfile, record['source']):
+        return '.castep changed'
+    if changed(cellname, record['target']):
+        return '.cell changed since it was built'
+    return None
+
+
+def changed(filename, previous):
+    """ returns
+    bool changed : True if the contents of filename differ from those with
+    fingerprint previous (only hashed if the mtime or size differ) """
+    stat = os.stat(filename)
+    if stat.st_mtime_ns == previous['mtime_ns'] and \
+            stat.st_size == previous['size']:
+        return False
+    return file_hash(filename) != previous['sha256']
+
+
+def update_cell(casfile, pureelems):
+    """ Write the pure .cell of the final structure in a .castep file
+
+    str casfile : .castep file
+    dict pureelems : {elem: pureelem} element each mixed site is labelled
+    with in the pure structure (see readcas.get_mixkey)
+
+    returns
+    str cellname : file written """
+    cellname = casfile.replace(".castep", ".cell")
+    cas = rc.readcas(casfile)
+    kpoints, offset = cas.get_kpoints()
+    constrs = cas.get_cell_constrs()
+    psps = cas.get_psps()
+
+    mixatoms = cas.extract_struc()
+    mixkey = cas.get_mixkey(pureelems=pureelems)
+
+    #Map
+    mapping = mixmap.mixmap(mixatoms, mixkey)
+    pureatoms = mapping.mix2pure(mixatoms)
+
+    params = {'pseudos': psps, 'kpoints': kpoints, 'kpoints_offset': offset}
+    if constrs is not None:
+        params['cell_constrs'] = constrs
+    mapping.setcellparams(**params)
+    mapping.casprint(pureatoms, cellname, pure=True)
+    return cellname
+
+
+def build(job):
+    """ Worker: (casfile, pureelems, previous record) -> (casfile, record)
+    after rebuilding the .cell of casfile """
+    casfile, pureelems, previous = job
+    source = fingerprint(casfile, previous=None if previous is None
+                         else previous['source'])
+    cellname = update_cell(casfile, pureelems)
+    return casfile, {'source': source, 'target': fingerprint(cellname),
+                     'pureelems': pureelems}
+
+
+def load_records(manifest):
+    """ returns
+    dict records : {casfile: record} of a manifest (empty if missing) """
+    if os.path.exists(manifest):
+        return json.load(open(manifest, 'r'))
+    return {}
+
+
+def save_records(manifest, updates):
+    """ Merge updated records into a manifest, under a lock so that several
+    processes updating one manifest (e.g. vcatools --jobs) lose nothing """
+    with open(manifest + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        records = load_records(manifest)
+        records.update(updates)
+        mixmap.atomic_write(json.dumps(records, indent=1), manifest)
+
+
+def update(casfiles, pureelems, manifest=manifest_default, nprocs=1,
+           force=False, verbose=False):
+    """ Rebuild the stale .cell files of casfiles (in parallel)
+
+    list casfiles : .castep files
+    dict pureelems : {elem: pureelem} (see update_cell)
+    str manifest : manifest of fingerprints (created if needed)
+    int nprocs : number of processes to rebuild with
+    bool force : rebuild every .cell
+
+    returns
+    list rebuilt : casfiles whose .cell was rebuilt
+    list current : casfiles whose .cell was up to date """
+    pureelems = dict(pureelems or {})
+    records = load_records(manifest)
+    folder = os.path.dirname(os.path.abspath(manifest))
+
+    def key(casfile):
+        return os.path.relpath(os.path.abspath(casfile), folder)
+
+    jobs, current = [], []
+    for casfile in casfiles:
+        record = records.get(key(casfile))
+        reason = 'forced' if force else stale(casfile, pureelems, record)
+        if reason is None:
+            current += [casfile]
+        else:
+            if verbose:
+                print(casfile + ': ' + reason, flush=True)
+            jobs += [(casfile, pureelems, record)]
+
+    rebuilt, updates = [], {}
+    try:
+        if nprocs is None or nprocs <= 1:
+            for job in jobs:
+                casfile, record = build(job)
+                updates[key(casfile)] = record
+                rebuilt += [casfile]
+        else:
+            with ProcessPoolExecutor(max_workers=nprocs) as pool:
+                futures = [pool.submit(build, job) for job in jobs]
+                for future in as_completed(futures):
+                    casfile, record = future.result()
+                    updates[key(casfile)] = record
+                    rebuilt += [casfile]
+    finally:
+        # Record whatever was rebuilt, even if a build failed
+        if updates:
+            save_records(manifest, updates)
+    return rebuilt, current
+
 
-    casfiles = glob("*.castep")
+def parse_pureelems(pairs):
+    """ returns
+    dict pureelems : {elem: pureelem} from ['elem=pureelem', ...] """
+    pureelems = {}
+    for pair in pairs:
+        if '=' not in pair:
+            raise argparse.ArgumentTypeError('pure elements are given as '
+                                             + 'elem=pureelem, not ' + pair)
+        elem, pureelem = pair.split('=', 1)
+        pureelems[elem] = pureelem
+    return pureelems
 
-    for file in casfiles:
-        print(file)
-        cellname=file.replace(".castep", ".cell")
-        if not glob(cellname):
-            cas = rc.readcas(file)
-            kpoints, offset = cas.get_kpoints()
-            constrs=cas.get_cell_constrs()
-            psps = cas.get_psps()
 
-            mixatoms = cas.extract_struc()
-            mixkey = cas.get_mixkey(pureelems=pureelems)
+def main(argv=None):
+    """ Command line: update_cell.py [options] [castep files or globs] """
+    parser = argparse.ArgumentParser(
+        description='Rebuild the pure .cell files of stale .castep files.')
+    parser.add_argument('paths', nargs='*', default=['*.castep'],
+                        help='.castep files or globs (default *.castep)')
+    parser.add_argument('-p', '--pureelem', dest='pureelems',
+                        action='append', default=[],
+                        help='pure element of mixed sites, e.g. -p Ba=La')
+    parser.add_argument('-c', '--config', default=None,
+                        help='JSON file with {"pureelems": {...}}')
+    parser.add_argument('-m', '--manifest', default=manifest_default,
+                        help='manifest of fingerprints')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes to rebuild with')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='rebuild every .cell file')
+    args = parser.parse_args(argv)
+    pureelems = {}
+    if args.config is not None:
+        pureelems.update(json.load(open(args.config, 'r'))['pureelems'])
+    pureelems.update(parse_pureelems(args.pureelems))
 
-            #Map 
-            mapping = mixmap.mixmap(mixatoms, mixkey)
-            pureatoms = mapping.mix2pure(mixatoms)
+    casfiles = []
+    for path in args.paths:
+        casfiles += [casfile for casfile in sorted(glob(path))
+                     if casfile not in casfiles]
+    rebuilt, current = update(casfiles, pureelems, manifest=args.manifest,
+                              nprocs=args.jobs, force=args.force,
+                              verbose=True)
+    print(str(len(rebuilt)) + ' rebuilt, ' + str(len(current))
+          + ' up to date')
 
-            mapping.casprint(pureatoms, cellname, pure=True)
 
 if __name__ == "__main__":
-    pureelems = {'Ba': 'La', 'Al': 'Mg'}
-    main(pureelems)
+    main(sys.argv[1:])
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import readmixcastep as rc
+import phonons_VCA as pVCA
+import SS_to_endmember
+import shiftcas
+import pinchposns
+import update_cell
+
+"""
+Single command line entry point for the per-file tools, each of which takes
+any number of paths or globs and processes them in a pool of --jobs workers:
+
+vcatools.py to-pure 'runs/*.castep' --jobs 8
+vcatools.py shift --vector 0.5 0 0 a.cell b.cell
+vcatools.py pinch highsym.cell 'lowsym_*.cell'
+vcatools.py update-cell -p Ba=La -p Al=Mg '*.castep'
+vcatools.py phonons --method 3 'comps/*/*.castep' --jobs 4
+vcatools.py phonons --method 3 --supercell 2 2 1 'comps/*/*.castep'
+vcatools.py info '*.castep' --json
+
+A progress line is printed as each file finishes (or a JSON object per line
+with --json) and a summary at the end; the exit status is 1 if any file
+failed. The subcommands call SS_to_endmember.to_pure, shiftcas.shift_cell,
+pinchposns.pinch, update_cell.update_cell and phonons_VCA.calc_phonons.
+"""
+
+
+def expand(paths):
+    """ returns
+    list files : paths with globs expanded (sorted, each file once); paths
+    that match nothing are kept so that they are reported as failures """
+    files = []
+    for path in paths:
+        matches = sorted(glob(path)) or [path]
+        files += [match for match in matches if match not in files]
+    return files
+
+
+def to_pure_task(path, options):
+    return SS_to_endmember.to_pure(path)
+
+
+def shift_task(path, options):
+    return shiftcas.shift_cell(path, options.vector)
+
+
+def pinch_task(path, options):
+    return pinchposns.pinch(options.reference, path)
+
+
+def update_cell_task(path, options):
+    # Same manifest and staleness checks as update_cell.py
+    rebuilt, current = update_cell.update([path], options.pureelems,
+                                          manifest=options.manifest,
+                                          force=options.force)
+    if not rebuilt:
+        return None  # skipped: .cell up to date (see update_cell.stale)
+    return path.replace('.castep', '.cell')
+
+
+def phonons_task(path, options):
+    supercell, bands = 'Gamma', None
+    if options.supercell is not None:
+        # Gamma frequencies from the supercell force constants
+        supercell, bands = np.diag(options.supercell), [np.zeros((1, 3))]
+    output = pVCA.calc_phonons(path, supercell=supercell, bands=bands,
+                               method=options.method, cache=options.cache)
+    freqs = np.array(output[2][0][0])
+    return {'modes': len(freqs), 'lowest': [round(float(f), 3)
+                                            for f in freqs[:4]]}
+
+
+def info_task(path, options):
+    if path.endswith('.castep'):
+        cas = rc.readcas(path)
+        info = {'task': cas.task, 'complete': bool(cas.check_complete()),
+                'iterations': int(cas.Niterations)}
+        if cas.Niterations > 0:
+            info['energy'] = float(cas.get_energy())
+    else:
+        cas = rc.readcell(path)
+        info = {}
+    info['ions'] = int(cas.Nions)
+    info['kpoints'] = [int(k) for k in cas.get_kpoints()[0]]
+    key = cas.get_mixkey(compact=True)
+    counts = np.asarray(key.wts.sum(axis=0)).ravel()
+    info['composition'] = {elem: round(float(n), 6) for elem, n
+                           in zip(key.species, counts)}
+    return info
+
+
+subcommands = {'to-pure': to_pure_task, 'shift': shift_task,
+               'pinch': pinch_task, 'update-cell': update_cell_task,
+               'phonons': phonons_task, 'info': info_task}
+
+
+def runtask(args):
+    """ Worker: (subcommand, path, options) -> (path, status, result, time),
+    errors are returned rather than raised so one bad file stops nothing """
+    name, path, options = args
+    start = time.time()
+    try:
+        if not os.path.exists(path):
+            raise FileNotFoundError('no such file')
+        result = subcommands[name](path, options)
+        status = 'skipped' if result is None else 'ok'
+    except Exception as error:
+        status, result = 'failed', type(error).__name__ + ': ' + str(error)
+    return path, status, result, time.time() - start
+
+
+def run(name, paths, options, jobs=1, jsonlines=False, stream=sys.stdout):
+    """ Run subcommand name over paths with jobs workers, reporting progress
+
+    returns
+    dict summary : number of files 'ok', 'skipped' and 'failed', the
+    'failures' {path: error} and the wall 'seconds' taken """
+    files = expand(paths)
+    tasks = [(name, path, options) for path in files]
+    summary = {'ok': 0, 'skipped': 0, 'failed': 0, 'failures': {}}
+    start = time.time()
+    width = len(str(len(files)))
+
+    def report(n, path, status, result, seconds):
+        summary[status] += 1
+        if status == 'failed':
+            summary['failures'][path] = result
+        if jsonlines:
+            line = json.dumps({'n': n, 'total': len(files), 'path': path,
+                               'status': status, 'result': result,
+                               'seconds': round(seconds, 3)})
+        else:
+            if isinstance(result, dict):
+                result = json.dumps(result)
+            line = '[{0:>{w}}/{1}] {2:7s} {3}'.format(n, len(files), status,
+                                                      path, w=width)
+            if result is not None:
+                line += ' -> ' + str(result)
+            line += ' ({0:.2f} s)'.format(seconds)
+        print(line, file=stream, flush=True)
+
+    if jobs is None or jobs <= 1:
+        for n, task in enumerate(tasks):
+            report(n+1, *runtask(task))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(runtask, task) for task in tasks]
+            for n, future in enumerate(as_completed(futures)):
+                report(n+1, *future.result())
+    summary['seconds'] = time.time() - start
+    return summary
+
+
+def parser():
+    """ returns
+    argparse.ArgumentParser parser : parser of every subcommand """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes')
+    common.add_argument('--json', action='store_true',
+                        help='report progress as JSON lines')
+    main = argparse.ArgumentParser(description='CASTEP VCA tools.')
+    sub = main.add_subparsers(dest='command', required=True)
+    helps = {'to-pure': 'write the pure (_nonSS) cell of solid solutions',
+             'shift': 'shift every atom by a fractional vector',
+             'pinch': 'reorder the atoms of cells to match a reference cell',
+             'update-cell': 'write the pure .cell of .castep files',
+             'phonons': 'Gamma phonons of finished displacements',
+             'info': 'summary of .castep and .cell files'}
+    subparsers = {}
+    for name in subcommands:
+        subparsers[name] = sub.add_parser(name, parents=[common],
+                                          help=helps[name])
+    subparsers['pinch'].add_argument('reference',
+                                     help='fixed .cell or .castep file')
+    for name, subparser in subparsers.items():
+        subparser.add_argument('paths', nargs='+', help='files or globs')
+    subparsers['shift'].add_argument('-v', '--vector', type=float, nargs=3,
+                                     required=True)
+    subparsers['update-cell'].add_argument(
+        '-p', '--pureelem', dest='pureelems', action='append', default=[],
+        help='pure element of mixed sites, e.g. -p Ba=La -p Al=Mg')
+    subparsers['update-cell'].add_argument(
+        '-m', '--manifest', default=update_cell.manifest_default,
+        help='manifest of fingerprints (shared with update_cell.py)')
+    subparsers['update-cell'].add_argument(
+        '-f', '--force', action='store_true',
+        help='rewrite .cell files that already exist')
+    subparsers['phonons'].add_argument('-m', '--method', type=int,
+                                       default=None, choices=[1, 2, 3])
+    subparsers['phonons'].add_argument(
+        '-s', '--supercell', type=int, nargs=3, default=None,
+        help='diagonal supercell the displacements were made in (default '
+        'Gamma, the unit cell)')
+    subparsers['phonons'].add_argument(
+        '--cache', action='store_true',
+        help='keep forcesets and save force constants')
+    return main
+
+
+##########################################################################
+
+if __name__ == '__main__':
+    options = parser().parse_args()
+    if options.command == 'update-cell':
+        options.pureelems = update_cell.parse_pureelems(options.pureelems)
+    summary = run(options.command, options.paths, options, jobs=options.jobs,
+                  jsonlines=options.json)
+    if options.json:
+        print(json.dumps(summary))
+    else:
+        print('\n{0} ok, {1} skipped, {2} failed in {3:.1f} s'.format(
+            summary['ok'], summary['skipped'], summary['failed'],
+            summary['seconds']))
+        for path, error in summary['failures'].items():
+            print('  ' + path + ': ' + error)
+    sys.exit(1 if summary['failed'] else 0)
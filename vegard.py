@@ -0,0 +1,266 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import ase
+import mixmap
+import readmixcastep as rc
+
+"""
+Module to predict starting structures for new solid solution compositions
+from structures already relaxed at other compositions of the same parent
+(Vegard's law and its quadratic extension).
+
+Cell vectors and the fractional coordinates of every (pure) site are fitted
+as linear or quadratic functions of the mixture weights on each site, then
+predicted .cell files are written for new compositions, e.g.
+
+vg = vegard(['CaSr_0.00.castep', 'CaSr_0.50.castep', 'CaSr_1.00.castep'])
+vg.write({'CaSr_0.25.cell': {'Ca': {'Ca': 0.75, 'Sr': 0.25},
+                             'Ti': {'Ti': 1.0}, 'O': {'O': 1.0}}})
+
+By default every coordinate depends on the weights of every site (a global
+fit, which captures e.g. anions moving with the cation composition); with
+local=r each site follows only the sites within r Ang of it. One species per
+site is left out of the fit (the weights of a site sum to one) and a fit with
+more coefficients than structures can determine raises a ValueError.
+"""
+
+
+def readrelaxed(args):
+    """ Read a relaxed structure and its site weights (worker function)
+
+    tuple (str casfile, int iteration) : .castep (or .cell) file and iteration
+
+    returns
+    tuple (cell, purefracs, pureelems, sitewts) : cell vectors, fractional
+    positions and elements of the pure structure and a list of {elem: wt}
+    dicts giving the mixture on each pure site """
+    casfile, iteration = args
+    if casfile.endswith('.cell'):
+        cas = rc.readcell(casfile)
+    else:
+        cas = rc.readcas(casfile)
+    cell = cas.get_cell(iteration=iteration)
+    posns = cas.get_posns(iteration=iteration)
+    mixatoms = ase.Atoms(scaled_positions=posns, cell=cell,
+                         symbols=cas.get_elements(), pbc=True)
+    mapping = mixmap.mixmap(mixatoms, cas.get_mixkey(iteration=iteration))
+    pureatoms = mapping.mix2pure(mixatoms)
+    return (np.array(cell), pureatoms.get_scaled_positions(wrap=False),
+            mapping.pureelems, siteweights(mapping))
+
+
+def siteweights(mapping):
+    """ returns
+    list sitewts : {elem: wt} mixture of each pure site of a mixmap """
+    return [{elem: wt for elem, (wt, j) in mapping.pure2mix_map[p].items()}
+            for p in range(mapping.pureions)]
+
+
+def matchorder(refposns, posns, cell):
+    """ Order of posns that best matches refposns (closest periodic images)
+
+    np.array(N, 3) refposns, posns : fractional positions
+    np.array(3, 3) cell : unit cell vectors
+
+    returns
+    np.array(N) order : posns[order] matches refposns """
+    diff = posns[None, :, :] - refposns[:, None, :]
+    diff -= np.round(diff)
+    dists = np.linalg.norm(np.dot(diff, cell), axis=2)
+    order = np.argmin(dists, axis=1)
+    if len(set(order)) != len(order):
+        raise ValueError('Could not match the sites of the structures to one'
+                         + ' another (are they the same parent structure?)')
+    return order
+
+
+class vegard():
+    """ Class to fit and predict structures as a function of composition """
+
+    def __init__(self, casfiles, deg=1, iteration=-1, nprocs=1, local=None):
+        """
+        list casfiles : relaxed .castep (or .cell) files of the same parent
+        structure at different compositions (endpoints and intermediates)
+        int deg : 1 (linear/Vegard) or 2 (quadratic) in the site weights
+        int iteration : iteration of each file to take the structure from
+        int nprocs : number of processes used to read the files
+        float local : if given, the fractional coordinates of each site
+        depend only on the weights of the sites within this distance (Ang)
+        of it (itself included), otherwise on the weights of every site (so
+        e.g. unmixed anion sites still follow the cation composition). The
+        cell always depends on every site.
+        """
+        if deg not in [1, 2]:
+            raise ValueError('deg must be 1 (linear) or 2 (quadratic).')
+        self.deg = deg
+        self.local = local
+        self.casfiles = list(casfiles)
+        jobs = [(casfile, iteration) for casfile in self.casfiles]
+        if nprocs is None or nprocs <= 1:
+            structures = [readrelaxed(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=nprocs) as pool:
+                structures = list(pool.map(readrelaxed, jobs))
+
+        # The first structure sets the site ordering for all others
+        cell0, fracs0, elems0, sitewts0 = structures[0]
+        self.Nsites = len(fracs0)
+        self.refelems = list(elems0)
+        self.reffracs = fracs0
+        self.species = sorted(set([elem for cell, fracs, elems, sitewts
+                                   in structures for wts in sitewts
+                                   for elem in wts]))
+        cells, fracs, wts = [], [], []
+        for cell, pfracs, elems, sitewts in structures:
+            if len(pfracs) != self.Nsites:
+                raise ValueError('Structures have different numbers of sites')
+            order = matchorder(fracs0, pfracs, cell)
+            diff = pfracs[order] - fracs0
+            fracs += [fracs0 + diff - np.round(diff)]  # unwrap onto ref
+            cells += [cell]
+            wts += [self.weightmatrix([sitewts[i] for i in order])]
+        self.cells = np.array(cells)
+        self.fracs = np.array(fracs)
+        self.wts = np.array(wts)  # (Nstructures, Nsites, Nspecies)
+        self.fit()
+
+    def weightmatrix(self, sitewts):
+        """ returns
+        np.array(Nsites, Nspecies) wts : weights from list of {elem: wt} """
+        wts = np.zeros((len(sitewts), len(self.species)))
+        for i, sitewt in enumerate(sitewts):
+            for elem, wt in sitewt.items():
+                if elem not in self.species:
+                    raise KeyError('Element ' + elem + ' does not appear in '
+                                   + 'any of the fitted structures.')
+                wts[i, self.species.index(elem)] = wt
+        return wts
+
+    def variables(self, sites):
+        """ returns
+        np.array(int) varcols : columns of the flattened (Nsites*Nspecies)
+        weights of sites that are fitting variables: those that vary between
+        the structures, less one species per site (the weights of a site sum
+        to one, so it would duplicate the constant) and duplicates """
+        Nspecies = len(self.species)
+        flat = self.wts.reshape(len(self.wts), -1)
+        varies = []
+        for site in sites:
+            cols = [site*Nspecies + k for k in range(Nspecies)
+                    if np.ptp(flat[:, site*Nspecies + k]) > 1e-8]
+            varies += cols[:-1] if len(cols) > 1 else cols
+        varies = np.array(varies, dtype=int)
+        unique, index = np.unique(flat[:, varies], axis=1, return_index=True)
+        return varies[np.sort(index)]
+
+    def neighbours(self, site):
+        """ returns
+        list sites : sites within self.local (Ang) of site (itself included)
+        in the reference structure """
+        diff = self.reffracs - self.reffracs[site]
+        diff -= np.round(diff)
+        dists = np.linalg.norm(np.dot(diff, self.cells[0]), axis=1)
+        return list(np.where(dists <= self.local)[0])
+
+    def design(self, wts, varcols):
+        """ Design matrix (polynomial features of the varying weights)
+        np.array(Nstructures, Nsites, Nspecies) wts : site weights
+        np.array(int) varcols : columns of the weights used (see variables)
+        """
+        x = wts.reshape(len(wts), -1)[:, varcols]
+        cols = [np.ones(len(x))] + [x[:, i] for i in range(x.shape[1])]
+        if self.deg == 2:
+            for i in range(x.shape[1]):
+                for j in range(i, x.shape[1]):
+                    cols += [x[:, i]*x[:, j]]
+        return np.array(cols).T
+
+    def fit(self):
+        """ Least squares fits of the cell vectors and fractional coordinates
+        (a single solve with many right hand sides for all outputs that
+        depend on the same weights: everything unless local is given) """
+        Nstruc = len(self.wts)
+        y = np.concatenate([self.cells.reshape(Nstruc, -1),
+                            self.fracs.reshape(Nstruc, -1)], axis=1)
+        allsites = list(range(self.Nsites))
+        groups = {tuple(self.variables(allsites)): list(range(9))}
+        for site in allsites:
+            sites = allsites if self.local is None else self.neighbours(site)
+            outputs = groups.setdefault(tuple(self.variables(sites)), [])
+            outputs += [9 + 3*site + i for i in range(3)]
+        self.models = []
+        self.rms = np.zeros(y.shape[1])
+        for varcols, outputs in groups.items():
+            varcols = np.array(varcols, dtype=int)
+            A = self.design(self.wts, varcols)
+            coeffs, res, rank, sv = np.linalg.lstsq(A, y[:, outputs],
+                                                    rcond=None)
+            if rank < A.shape[1]:
+                raise ValueError(
+                    'Too few structures (' + str(Nstruc) + ') to fit '
+                    + str(A.shape[1]) + ' coefficients of degree '
+                    + str(self.deg) + ' in the varying site weights (use '
+                    + 'more compositions or deg=1).')
+            self.models += [(varcols, outputs, coeffs)]
+            self.rms[outputs] = np.sqrt(np.mean(
+                (np.dot(A, coeffs) - y[:, outputs])**2, axis=0))
+
+    def evaluate(self, wts):
+        """ returns
+        np.array(9 + 3*Nsites) y : fitted cell vectors and fractional
+        coordinates (flattened) for site weights wts (Nsites, Nspecies) """
+        y = np.zeros(9 + 3*self.Nsites)
+        for varcols, outputs, coeffs in self.models:
+            y[outputs] = np.dot(self.design(wts[None, :, :], varcols),
+                                coeffs)[0]
+        return y
+
+    def predict(self, mixkey):
+        """ Predict the pure structure for a new composition
+
+        dict/MixKey mixkey : mixkey (site or elem format) of the composition
+        for the reference (first) structure
+
+        returns
+        ase.Atoms pureatoms : predicted structure (reference site order)
+        np.array(Nsites, Nspecies) wts : weights on each site """
+        refatoms = ase.Atoms(symbols=self.refelems,
+                             scaled_positions=self.reffracs % 1.0,
+                             cell=self.cells[0], pbc=True)
+        mixatoms = mixmap.create_mixture(refatoms, mixkey)
+        mapping = mixmap.mixmap(mixatoms, mixkey)
+        purefracs = mapping.mix2pure(mixatoms).get_scaled_positions()
+        order = matchorder(self.reffracs % 1.0, purefracs, self.cells[0])
+        sitewts = siteweights(mapping)
+        wts = self.weightmatrix([sitewts[i] for i in order])
+        y = self.evaluate(wts)
+        cell = y[:9].reshape(3, 3)
+        fracs = y[9:].reshape(self.Nsites, 3) % 1.0
+        pureelems = [mapping.pureelems[i] for i in order]
+        pureatoms = ase.Atoms(symbols=pureelems, scaled_positions=fracs,
+                              cell=cell, pbc=True)
+        return pureatoms, wts
+
+    def predict_mix(self, mixkey):
+        """ Predict the mixed structure for a new composition
+        returns
+        ase.Atoms mixatoms : predicted structure with mixed atoms
+        mixmap.mixmap mapping : mapping for mixatoms """
+        pureatoms, wts = self.predict(mixkey)
+        mixatoms = mixmap.create_mixture(pureatoms, mixkey)
+        mapping = mixmap.mixmap(mixatoms, mixkey)
+        return mixatoms, mapping
+
+    def write(self, mixkeys, **cellparams):
+        """ Write predicted starting .cell files for new compositions
+
+        dict mixkeys : {cellfile: mixkey} compositions to predict
+        cellparams : passed on to mixmap.setcellparams (kpoints etc.)
+
+        returns
+        list cellfiles : files written """
+        for cellfile, mixkey in mixkeys.items():
+            mixatoms, mapping = self.predict_mix(mixkey)
+            mapping.setcellparams(**cellparams)
+            mapping.casprint(mixatoms, cellfile)
+        return list(mixkeys.keys())